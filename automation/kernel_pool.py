@@ -0,0 +1,173 @@
+"""A pool of prestarted python3 kernels for running notebooks, to save kernel startup and import time.
+"""
+import logging
+import os
+import queue
+import time
+from contextlib import contextmanager
+
+from jupyter_client import KernelManager
+
+# Run in each kernel when it starts, so notebooks find these already imported
+PRELOAD_CODE = """
+import boto3
+import datadotworld
+import numpy
+import pandas
+try:
+    get_ipython().run_line_magic('load_ext', 'watermark')
+except Exception:
+    pass
+"""
+
+# Environment variables that tell notebooks what to write where (see SheetChecker.set_up_environment)
+ENV_PREFIXES = ('CLEAN_', 'COMPRESS_')
+
+# Longest to wait for a kernel to start or to run setup code, in seconds
+KERNEL_TIMEOUT = 120
+
+
+@contextmanager
+def fresh_kernel(cwd, env=None):
+    """Starts a python3 kernel for one notebook, and shuts it down afterwards
+
+    Args:
+        cwd (string): Directory the kernel runs the notebook in
+        env (dict): Environment variables to set in the kernel, besides this process's
+
+    Yields:
+        KernelManager: For ExecutePreprocessor.preprocess(..., km=km)
+    """
+    km = KernelManager(kernel_name='python3')
+    km.start_kernel(cwd=os.path.abspath(cwd), env=dict(os.environ, **(env or {})))
+    try:
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=KERNEL_TIMEOUT)
+        finally:
+            kc.stop_channels()
+        yield km
+    finally:
+        km.shutdown_kernel(now=True)
+
+
+class KernelPool(object):
+
+    """ Keeps a fixed number of warm python3 kernels. A notebook borrows one, and when it is returned its variables
+    are cleared with %reset -f; imported modules stay loaded. A kernel whose notebook failed is restarted instead,
+    since it may still be busy with a cell that timed out.
+    """
+
+    def __init__(self, size, cwd, preload_code=PRELOAD_CODE, logger=None):
+        """ Constructor for KernelPool object.
+
+        Args:
+            size (int): Number of kernels; notebooks wait for a free one
+            cwd (string): Directory the kernels run notebooks in
+            preload_code (string): Code run in each kernel when it starts
+            logger (Logger): Where to log kernel startup
+        """
+        self.size = size
+        self.cwd = os.path.abspath(cwd)
+        self.preload_code = preload_code
+        self.logger = logger or logging.getLogger('kernel_pool')
+        self.idle = queue.Queue()
+        self.kernels = []
+        # Names of the extra environment variables notebooks have been given, to unset for the next one
+        self._extra_env_keys = set()
+
+    def start(self):
+        """Starts all the kernels and runs the preload code in them
+        """
+        for _ in range(self.size):
+            start = time.time()
+            km = KernelManager(kernel_name='python3')
+            km.start_kernel(cwd=self.cwd)
+            self._execute(km, self.preload_code)
+            self.kernels.append(km)
+            self.idle.put(km)
+            self.logger.info("Started warm kernel in %.1fs." % (time.time() - start))
+
+    def shutdown(self):
+        """Shuts down all the kernels
+        """
+        for km in self.kernels:
+            km.shutdown_kernel(now=True)
+        self.kernels = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    @contextmanager
+    def kernel(self, env=None):
+        """Borrows a kernel, waiting for one to be free, with its environment variables synced to this process's.
+
+        Args:
+            env (dict): Environment variables to set in the kernel for this notebook, besides this process's
+
+        Yields:
+            KernelManager: For ExecutePreprocessor.preprocess(..., km=km)
+        """
+        km = self.idle.get()
+        healthy = False
+        try:
+            self._sync_environment(km, env or {})
+            yield km
+            healthy = True
+        finally:
+            self._recycle(km, healthy)
+
+    def _recycle(self, km, healthy):
+        try:
+            if healthy and km.is_alive():
+                self._execute(km, "get_ipython().run_line_magic('reset', '-f')\n__import__('os').chdir(%r)" % self.cwd)
+            else:
+                km.restart_kernel(now=True)
+                self._execute(km, self.preload_code)
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error("Could not reset a warm kernel; starting a new one.")
+            km.shutdown_kernel(now=True)
+            self.kernels.remove(km)
+            km = KernelManager(kernel_name='python3')
+            km.start_kernel(cwd=self.cwd)
+            self._execute(km, self.preload_code)
+            self.kernels.append(km)
+        self.idle.put(km)
+
+    def _sync_environment(self, km, extra_env):
+        """Kernels inherit the environment they were started with, so set and unset the notebook's environment
+        variables to match this process's, and then set extra_env (which the next notebook's replaces)
+        """
+        env = dict((k, v) for k, v in os.environ.items() if k.startswith(ENV_PREFIXES))
+        env.update(extra_env)
+        self._extra_env_keys.update(extra_env)
+        prefixes = ENV_PREFIXES + tuple(sorted(self._extra_env_keys))
+        code = ("import os\n"
+                "for k in [k for k in os.environ if k.startswith(%r)]:\n"
+                "    del os.environ[k]\n"
+                "os.environ.update(%r)" % (prefixes, env))
+        self._execute(km, code)
+
+    def _execute(self, km, code):
+        """Runs code in the kernel and waits for it to finish; raises RuntimeError if it fails
+        """
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=KERNEL_TIMEOUT)
+            msg_id = kc.execute(code, silent=True, store_history=False)
+            while True:
+                reply = kc.get_shell_msg(timeout=KERNEL_TIMEOUT)
+                if reply['parent_header'].get('msg_id') == msg_id:
+                    break
+            if reply['content']['status'] != 'ok':
+                raise RuntimeError('Kernel setup code failed: %s: %s' % (
+                    reply['content'].get('ename'), reply['content'].get('evalue')))
+        finally:
+            kc.stop_channels()
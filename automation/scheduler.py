@@ -0,0 +1,215 @@
+"""Runs notebooks as a dependency graph, executing independent notebooks concurrently.
+"""
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Failure policies
+FAIL_FAST = 'fail fast'
+CONTINUE = 'continue'
+
+# Node statuses
+PENDING = 'pending'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+SKIPPED = 'skipped'
+
+
+def notebook_spec(entry):
+    """Parses a notebook entry from config.yaml.
+
+    Entries are either a notebook filename, or a mapping with the filename under 'notebook' and the notebooks it
+    waits for under 'depends on'.
+
+    Args:
+        entry (string or dict): Notebook entry
+
+    Returns:
+        (string, [] of strings): Notebook filename and the notebooks it depends on
+    """
+    if isinstance(entry, dict):
+        return entry['notebook'], list(entry.get('depends on') or [])
+    return entry, []
+
+
+class NotebookNode(object):
+
+    """ A notebook to run, the notebooks it waits for, and the datasets it belongs to.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.depends_on = set()
+        self.datasets = set()
+        # dataset -> the notebooks this one waits for on that dataset's behalf
+        self.depends_on_by_dataset = {}
+        self.status = PENDING
+        self.exception = None
+        self.seconds = None
+
+
+class NotebookDAG(object):
+
+    """ The notebooks to run this cycle. A notebook listed by several datasets (e.g. the website compression
+    notebook) is a single node, so it runs once, after everything any of those datasets needs it to wait for. It
+    runs as long as everything one of those datasets needs succeeded, so one dataset's failure doesn't hold back
+    another's.
+    """
+
+    def __init__(self):
+        self.nodes = OrderedDict()
+
+    def add(self, name, dataset, depends_on=()):
+        """Adds a notebook, or adds a dataset and dependencies to one already in the graph
+
+        Args:
+            name (string): Notebook filename
+            dataset (string): Name of the dataset the notebook belongs to
+            depends_on ([] of strings): Notebooks that must succeed before this one runs
+        """
+        if name not in self.nodes:
+            self.nodes[name] = NotebookNode(name)
+        node = self.nodes[name]
+        node.datasets.add(dataset)
+        node.depends_on.update(depends_on)
+        node.depends_on.discard(name)
+        node.depends_on_by_dataset.setdefault(dataset, set()).update(set(depends_on) - {name})
+        return node
+
+    def dependencies(self, node):
+        """Returns the dependencies of node that are in the graph. Notebooks not scheduled this cycle (e.g. those of
+        a dataset whose sheet has not changed) are not waited for.
+        """
+        return [self.nodes[name] for name in sorted(node.depends_on) if name in self.nodes]
+
+    def readiness(self, node):
+        """Returns whether node can run now (True), can never run (False) or must wait (None), going by the statuses
+        of its dependencies. It can run once, for one of its datasets, every dependency has succeeded, and it has
+        stopped waiting on those of its other datasets that might still succeed.
+        """
+        viable = []
+        for depends_on in node.depends_on_by_dataset.values():
+            statuses = [self.nodes[name].status for name in depends_on if name in self.nodes]
+            if all(status in (PENDING, SUCCEEDED) for status in statuses):
+                viable.append(statuses)
+        if not viable:
+            return False
+        if all(status == SUCCEEDED for statuses in viable for status in statuses):
+            return True
+        return None
+
+    def check(self):
+        """Raises ValueError if the graph has a cycle
+        """
+        visiting, visited = set(), set()
+
+        def visit(node, path):
+            if node.name in visited:
+                return
+            if node.name in visiting:
+                raise ValueError('Notebook dependencies form a cycle: %s' % ' -> '.join(path + [node.name]))
+            visiting.add(node.name)
+            for dependency in self.dependencies(node):
+                visit(dependency, path + [node.name])
+            visiting.discard(node.name)
+            visited.add(node.name)
+
+        for node in self.nodes.values():
+            visit(node, [])
+
+
+class NotebookScheduler(object):
+
+    """ Runs the notebooks of a NotebookDAG on a bounded pool of workers. Each worker runs one notebook, in its own
+    kernel, at a time; a notebook starts as soon as its dependencies have succeeded (see NotebookDAG.readiness).
+    """
+
+    def __init__(self, run_notebook, max_workers=2, timeout=None, policy=FAIL_FAST, logger=None):
+        """ Constructor for NotebookScheduler object.
+
+        Args:
+            run_notebook (function): Called as run_notebook(name, timeout) to run one notebook; raises on failure
+            max_workers (int): Most notebooks to run at once
+            timeout (int): Seconds each notebook may run for, or None for no limit
+            policy (string): FAIL_FAST to start no more notebooks after a failure, or CONTINUE to keep running
+                those that do not depend on the failed one
+            logger (Logger): Where to log progress
+        """
+        if policy not in (FAIL_FAST, CONTINUE):
+            raise ValueError("Unknown failure policy %r, expected %r or %r" % (policy, FAIL_FAST, CONTINUE))
+        self.run_notebook = run_notebook
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.policy = policy
+        self.logger = logger or logging.getLogger('scheduler')
+
+    @classmethod
+    def from_config(cls, config, run_notebook, logger=None):
+        """Creates a scheduler from the 'Scheduler' section of config.yaml
+
+        Args:
+            config (dict): The 'Scheduler' section, or None for the defaults
+            run_notebook (function): See __init__
+            logger (Logger): See __init__
+        """
+        config = config or {}
+        return cls(run_notebook,
+                   max_workers=config.get('max workers', 2),
+                   timeout=config.get('notebook timeout'),
+                   policy=config.get('on failure', FAIL_FAST),
+                   logger=logger)
+
+    def run(self, dag):
+        """Runs every notebook in dag, setting each node's status, exception and seconds
+
+        Returns:
+            boolean: Whether every notebook succeeded
+        """
+        dag.check()
+        pending = list(dag.nodes.values())
+        running = {}
+        stopping = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for node in list(pending):
+                    ready = dag.readiness(node)
+                    if stopping or ready is False:
+                        node.status = SKIPPED
+                        self.logger.info("Skipping %s." % node.name)
+                    # Submit no more than there are workers, so nothing is left queued when failing fast
+                    elif ready and len(running) < self.max_workers:
+                        self.logger.info("Running %s..." % node.name)
+                        running[pool.submit(self._run_node, node)] = node
+                    else:
+                        continue
+                    pending.remove(node)
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    if node.status != SUCCEEDED:
+                        self.logger.error("%s %s after %.0fs." % (node.name, node.status, node.seconds))
+                        stopping = stopping or self.policy == FAIL_FAST
+                    else:
+                        self.logger.info("%s succeeded in %.0fs." % (node.name, node.seconds))
+
+        return all(node.status == SUCCEEDED for node in dag.nodes.values())
+
+    def _run_node(self, node):
+        start = time.time()
+        try:
+            self.run_notebook(node.name, self.timeout)
+            node.status = SUCCEEDED
+        except TimeoutError as e:
+            node.exception = e
+            node.status = TIMED_OUT
+        except Exception as e:
+            self.logger.exception(e)
+            node.exception = e
+            node.status = FAILED
+        finally:
+            node.seconds = time.time() - start
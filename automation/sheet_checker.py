@@ -3,9 +3,9 @@
 import argparse
 import os
 import sys
+import time
 from datetime import datetime
 
-import boto3
 import dateutil.parser
 import nbformat
 import pygsheets
@@ -15,8 +15,25 @@ from botocore.exceptions import ClientError
 from nbconvert.preprocessors import ExecutePreprocessor, CellExecutionError
 
 import tji_utils
+from kernel_pool import KernelPool, fresh_kernel
+from scheduler import SUCCEEDED, NotebookDAG, NotebookScheduler, notebook_spec
 from tji_emailer import TJIEmailer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_cleaning'))
+from lib.instrumentation import read_metrics, slowest_stages, stage  # noqa: E402
+from lib.pipelines import pipeline_for_notebook, prefetch_pipelines, run_pipeline  # noqa: E402
+from lib.storage import get_storage  # noqa: E402
+
+# Longest any one cell may run for, in seconds
+CELL_TIMEOUT = 600
+
+NOTEBOOK_DIR = '../data_cleaning/'
+
+# How many of the slowest stages success emails list
+SLOWEST_STAGES = 10
+# Stages that wrap a whole notebook, which success emails leave out in favor of the stages within
+WRAPPER_STAGES = ('notebook', 'pipeline')
+
 
 class SheetChecker(object):
 
@@ -27,22 +44,25 @@ class SheetChecker(object):
     Author: Aiden Yang <aiden.yang@texasjusticeinitiative.org>
     """
 
-    def __init__(self, dataset, emailer, sheet_key, cleaning_nbs, compression_nbs, force, sync):
+    def __init__(self, dataset, emailer, sheet_key, cleaning_nbs, compression_nbs, force, sync, incremental=False):
         """ Constructor for Sheet Checker object.
 
         Args:
             dataset (string): Name of dataset
             emailer (TJIEmailer): Emailer obj used for sending success and failures emails through SES
             sheet_key (string): Google Sheets key
-            cleaning_nbs ([] of strings): List of cleaning notebooks to run
-            compression_nbs ([] of strings): List of compression notebooks to run
+            cleaning_nbs ([] of strings or dicts): List of cleaning notebooks to run (see scheduler.notebook_spec)
+            compression_nbs ([] of strings or dicts): List of compression notebooks to run, after all the
+                cleaning notebooks
             force (boolean): Controls whether or not to run cleaning and compression nbs even if sheet has not been updated
             sync (bolean): Controls whether or not notebooks will sync data to Data.world
+            incremental (boolean): Controls whether or not cleaning notebooks only reclean rows that changed
         """
-        self.s3_client = boto3.client('s3')
+        self.storage = get_storage()
         self.emailer = emailer
         self.force_full_update = force
         self.sync_dw = sync
+        self.incremental = incremental
         self.dataset = dataset
         self.sheet_key = sheet_key
         self.cleaning_nbs = cleaning_nbs
@@ -53,64 +73,77 @@ class SheetChecker(object):
         self.logger = tji_utils.set_up_logger(name=dataset, log_file=log_file)
 
     def run(self):
+        if not run_checkers([self], NotebookScheduler(self.run_notebook, logger=self.logger)):
+            sys.exit('Exiting: encountered an issue while cleaning or compressing.')
+
+    def check_for_update(self):
+        """Checks whether this dataset needs cleaning and compressing, and if not, updates the timestamp
+
+        Returns:
+            boolean
+        """
         if self.is_sheet_updated() or self.force_full_update:
             self.logger.info("Cleaning and compressing...")
-            self.set_up_environment()
-            self.clean()
-            self.compress()
-            self.update_last_ran_ts()
-            self.clean_up_environment()
-        else:
-            self.logger.info("Sheet has not been updated since last run."
-                             "Set force=True if you want to clean and compress anyway. Exiting.")
-            self.update_last_ran_ts()
+            return True
+        self.logger.info("Sheet has not been updated since last run."
+                         "Set force=True if you want to clean and compress anyway. Exiting.")
+        self.update_last_ran_ts()
+        return False
+
+    def add_to_dag(self, dag):
+        """Adds this dataset's notebooks to dag. Compression notebooks depend on all the cleaning notebooks. One shared
+        with other datasets runs if this dataset's cleaning notebooks, or another dataset's, all succeed.
 
-    def clean(self):
-        """ Runs cleaning notebooks
+        Args:
+            dag (NotebookDAG): Notebooks to run this cycle
         """
-        try:
-            for cleaning_nb in self.cleaning_nbs:
-                self.run_notebook(cleaning_nb)
-            self.emailer.send_email(action="Cleaning", dataset=self.dataset)
-        except Exception as e:
-            self.logger.exception(e)
-            self.emailer.send_email(action="Cleaning", dataset=self.dataset, exception=e)
-            self.logger.error('Cleaning failed.')
-            sys.exit('Exiting: encountered an issue while cleaning.')
-
-    def compress(self):
-        """ Runs compression notebooks
+        cleaning_names = [notebook_spec(entry)[0] for entry in self.cleaning_nbs]
+        for entry in self.cleaning_nbs:
+            name, depends_on = notebook_spec(entry)
+            dag.add(name, self.dataset, depends_on)
+        for entry in self.compression_nbs:
+            name, depends_on = notebook_spec(entry)
+            dag.add(name, self.dataset, cleaning_names + depends_on)
+
+    def report(self, dag):
+        """Emails the outcome of this dataset's cleaning and compression notebooks, and updates the timestamp if
+        they all succeeded
+
+        Args:
+            dag (NotebookDAG): Notebooks run this cycle
+
+        Returns:
+            boolean: Whether they all succeeded
         """
-        try:
-            for compression_nb in self.compression_nbs:
-                self.run_notebook(compression_nb)
-            self.emailer.send_email(action="Compressing", dataset=self.dataset)
-        except Exception as e:
-            self.logger.exception(e)
-            self.logger.error('Compressing failed.')
-            self.emailer.send_email(action="Compressing", dataset=self.dataset, exception=e)
-            sys.exit('Exiting: encountered an issue while compressing.')
+        for action, entries in (("Cleaning", self.cleaning_nbs), ("Compressing", self.compression_nbs)):
+            nodes = [dag.nodes[notebook_spec(entry)[0]] for entry in entries]
+            failed = [node for node in nodes if node.status != SUCCEEDED]
+            if not failed:
+                names = set(node.name for node in nodes)
+                # The metrics file has every dataset's stages, tagged with the notebook they ran in
+                records = [record for record in read_metrics(os.environ.get('TJI_METRICS_FILE'))
+                           if record.get('notebook') in names and record['stage'] not in WRAPPER_STAGES]
+                stages = slowest_stages(records, n=SLOWEST_STAGES)
+                self.emailer.send_email(action=action, dataset=self.dataset, stages=stages)
+                continue
+            errors = [node.exception for node in failed if node.exception]
+            exception = errors[0] if errors else RuntimeError(
+                '%s was %s because a notebook it depends on failed.' % (failed[0].name, failed[0].status))
+            self.logger.error('%s failed.' % action, exc_info=exception)
+            self.emailer.send_email(action=action, dataset=self.dataset, exception=exception)
+            return False
         self.logger.info("Successfully cleaned and compressed data.")
+        self.update_last_ran_ts()
+        return True
 
-    def run_notebook(self, nb_name):
+    def run_notebook(self, nb_name, timeout=None):
         """Runs a notebook and write out the output notebook
 
         Args:
             nb_name (string): notebook filename
+            timeout (int): Seconds the whole notebook may run for, or None for no limit
         """
-        out_notebook_name = 'output_notebooks/%s_result_nb.ipynb' % nb_name
-        nb = nbformat.read('../data_cleaning/%s' % nb_name, as_version=4)
-        ep = ExecutePreprocessor(timeout=600, kernel_name='python3')
-        try:
-            ep.preprocess(nb, {'metadata': {'path': '../data_cleaning/'}})
-        except CellExecutionError:
-            msg = 'Error executing the notebook'
-            msg += 'See notebook "%s" for the traceback.' % out_notebook_name
-            self.logger.info(msg)
-            raise
-        finally:
-            with open(out_notebook_name, mode='wt') as f:
-                nbformat.write(nb, f)
+        run_notebook(nb_name, self.logger, timeout)
 
     def is_sheet_updated(self):
         """Checks if google sheet has been updated since the last time this job ran
@@ -142,7 +175,7 @@ class SheetChecker(object):
         """Drops current time as timestamp in s3, to be used next time this job runs
         """
         timestamp = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
-        self.s3_client.put_object(Body=timestamp, Bucket='tji-timestamps', Key=self.dataset)
+        self.storage.upload_bytes('tji-timestamps', self.dataset, timestamp.encode(), skip_unchanged=False)
         self.logger.info("Updated %s timestamp." % self.dataset)
 
     def fetch_last_run_ts(self):
@@ -152,9 +185,7 @@ class SheetChecker(object):
             last_run_ts: Last time this job ran
         """
         try:
-            timestamp = self.s3_client.get_object(Bucket='tji-timestamps', Key=self.dataset)
-            body = timestamp['Body']
-            last_run_ts = body.read()
+            last_run_ts = self.storage.download_bytes('tji-timestamps', self.dataset)
             return last_run_ts
         except ClientError as e:
             if e.response['Error']['Code'] == "404":
@@ -169,6 +200,8 @@ class SheetChecker(object):
         dataset = self.dataset.upper()
         if self.sync_dw:
             os.environ['CLEAN_%s_DW' % dataset] = 'TRUE'
+        if self.incremental:
+            os.environ['CLEAN_%s_INCREMENTAL' % dataset] = 'TRUE'
         os.environ['CLEAN_%s_S3' % dataset] = 'TRUE'
         os.environ['COMPRESS_%s_S3' % dataset] = 'TRUE'
 
@@ -177,10 +210,107 @@ class SheetChecker(object):
         """
         dataset = self.dataset.upper()
         os.unsetenv('CLEAN_%s_DW' % dataset)
+        os.unsetenv('CLEAN_%s_INCREMENTAL' % dataset)
         os.unsetenv('CLEAN_%s_S3' % dataset)
         os.unsetenv('COMPRESS_%s_S3' % dataset)
 
 
+def run_notebook(nb_name, logger, timeout=None, kernel_pool=None, in_process=False):
+    """Runs a notebook and write out the output notebook
+
+    Args:
+        nb_name (string): notebook filename
+        logger (Logger): Where to log kernel startup time and failures
+        timeout (int): Seconds the whole notebook may run for, or None for no limit. Raises TimeoutError when
+            exceeded.
+        kernel_pool (KernelPool): Warm kernels to run the notebook in, or None to start a new kernel
+        in_process (boolean): Whether to run the notebook's pipeline (see data_cleaning/lib/pipelines.py) in this
+            process instead, if it has one. No output notebook is written, and timeout is not enforced.
+    """
+    pipeline = pipeline_for_notebook(nb_name) if in_process else None
+    if pipeline:
+        logger.info("Running %s in-process, as pipeline %s." % (nb_name, pipeline.name))
+        with stage('notebook', notebook=nb_name):
+            run_pipeline(pipeline.name)
+        return
+
+    out_notebook_name = 'output_notebooks/%s_result_nb.ipynb' % nb_name
+    nb = nbformat.read(NOTEBOOK_DIR + nb_name, as_version=4)
+    start = time.time()
+    # Tags the stages the notebook records with its name (see data_cleaning/lib/instrumentation.py)
+    env = {'TJI_METRICS_NOTEBOOK': nb_name}
+    with stage('notebook', notebook=nb_name), \
+            (kernel_pool.kernel(env) if kernel_pool else fresh_kernel(NOTEBOOK_DIR, env)) as km:
+        logger.info("Kernel for %s ready in %.1fs (%s)." % (
+            nb_name, time.time() - start, 'warm' if kernel_pool else 'new'))
+        ep = ExecutePreprocessor(timeout=CELL_TIMEOUT, kernel_name='python3')
+        if timeout:
+            deadline = time.time() + timeout
+            ep.timeout_func = lambda cell: max(1, int(min(CELL_TIMEOUT, deadline - time.time())))
+        try:
+            ep.preprocess(nb, {'metadata': {'path': NOTEBOOK_DIR}}, km=km)
+        except CellExecutionError:
+            msg = 'Error executing the notebook'
+            msg += 'See notebook "%s" for the traceback.' % out_notebook_name
+            logger.info(msg)
+            raise
+        finally:
+            with open(out_notebook_name, mode='wt') as f:
+                nbformat.write(nb, f)
+
+
+def prefetch_inputs(dag, logger):
+    """Downloads the data.world files the DAG's cleaning notebooks read, several projects at once. The notebooks
+    (or their pipelines, when run in-process) then read them from the cache.
+
+    Args:
+        dag (NotebookDAG): The notebooks about to run
+        logger (Logger): Where to log how it went
+    """
+    pipelines = [pipeline_for_notebook(nb_name) for nb_name in dag.nodes]
+    names = [pipeline.name for pipeline in pipelines if pipeline]
+    if not names:
+        return
+    start = time.time()
+    try:
+        files = prefetch_pipelines(names)
+    except Exception:
+        # The notebooks will try again themselves
+        logger.exception("Could not prefetch the data.world files of %s." % ', '.join(names))
+        return
+    logger.info("Prefetched %d data.world files in %.1fs." % (len(files), time.time() - start))
+
+
+def run_checkers(checkers, scheduler):
+    """Cleans and compresses every dataset whose sheet has been updated. Their notebooks run as one dependency
+    graph, so notebooks shared between datasets run once.
+
+    Args:
+        checkers ([] of SheetChecker): One per dataset
+        scheduler (NotebookScheduler): Runs the notebooks
+
+    Returns:
+        boolean: Whether every dataset was cleaned and compressed successfully
+    """
+    updated = [sc for sc in checkers if sc.check_for_update()]
+    if not updated:
+        return True
+
+    dag = NotebookDAG()
+    for sc in updated:
+        # Kernels inherit these, so set them all before any notebook starts
+        sc.set_up_environment()
+        sc.add_to_dag(dag)
+    prefetch_inputs(dag, scheduler.logger)
+    scheduler.run(dag)
+
+    succeeded = True
+    for sc in updated:
+        succeeded = sc.report(dag) and succeeded
+        sc.clean_up_environment()
+    return succeeded
+
+
 def is_valid_file(argument_parser, file_name):
     """
     Checks if file exists and returns open file object; displays an error message and usage information if it does not.
@@ -211,16 +341,44 @@ if __name__ == '__main__':
     email_config = config['Email Settings']
     emailer = TJIEmailer(sender=email_config['sender'],
                          recipients=email_config['recipients'],
-                         aws_region=email_config['region'])
+                         aws_region=email_config['region'],
+                         mode=email_config.get('mode', 'sync'))
 
-    # Create and run sheet checker for one dataset
+    # Create a sheet checker for each dataset
+    checkers = []
     for dataset, settings in config['Datasets'].items():
         if settings['enabled']:
-            sc = SheetChecker(dataset=dataset,
-                              emailer=emailer,
-                              sheet_key=settings['sheet key'],
-                              cleaning_nbs=settings['cleaning notebooks'],
-                              compression_nbs=settings['compression notebooks'],
-                              force=settings['force'],
-                              sync=settings['sync'])
-            sc.run()
+            checkers.append(SheetChecker(dataset=dataset,
+                                         emailer=emailer,
+                                         sheet_key=settings['sheet key'],
+                                         cleaning_nbs=settings['cleaning notebooks'],
+                                         compression_nbs=settings['compression notebooks'],
+                                         force=settings['force'],
+                                         sync=settings['sync'],
+                                         incremental=settings.get('incremental', False)))
+
+    # Run all their notebooks together
+    timestamp = datetime.now().strftime('%Y-%m-%d')
+    # Notebook kernels inherit this, so they record their stages in the same file
+    os.environ.setdefault('TJI_METRICS_FILE', os.path.abspath(
+        'logs/metrics+%s.jsonl' % datetime.now().strftime('%Y-%m-%d_%H%M%S')))
+    logger = tji_utils.set_up_logger(name='scheduler', log_file='logs/scheduler+%s.log' % timestamp)
+    scheduler_config = config.get('Scheduler') or {}
+    kernel_pool = None
+    if scheduler_config.get('warm kernels'):
+        kernel_pool = KernelPool(size=scheduler_config.get('max workers', 2), cwd=NOTEBOOK_DIR, logger=logger)
+        kernel_pool.start()
+    try:
+        scheduler = NotebookScheduler.from_config(
+            scheduler_config,
+            lambda nb_name, timeout: run_notebook(nb_name, logger, timeout, kernel_pool=kernel_pool,
+                                                  in_process=scheduler_config.get('in process', False)),
+            logger=logger)
+        succeeded = run_checkers(checkers, scheduler)
+    finally:
+        if kernel_pool:
+            kernel_pool.shutdown()
+        # Send whatever is still queued (the emailer also does at exit, as a fallback)
+        emailer.flush()
+    if not succeeded:
+        sys.exit('Exiting: encountered an issue while cleaning or compressing.')
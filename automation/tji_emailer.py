@@ -1,58 +1,155 @@
+import atexit
+import html
 import logging
+import queue
+import threading
+import time
 from datetime import datetime
 
 import boto3
 from botocore.exceptions import ClientError
 
 import tji_utils
-from sys import exc_info
 import traceback
 
 CHARSET = "UTF-8"
 
+# How emails are sent: one at a time as they happen, from a background thread, or all together at exit
+SYNC = 'sync'
+ASYNC = 'async'
+DIGEST = 'digest'
+MODES = (SYNC, ASYNC, DIGEST)
+
+# Longest flush waits for queued emails to be sent, in seconds
+FLUSH_TIMEOUT = 60
+
 
 class TJIEmailer():
     # TJIEmailer sends success and failure emails via Amazon SES during cleaning
     # and compressing of a TJI dataset.
 
-    def __init__(self, sender, recipients, aws_region):
+    def __init__(self, sender, recipients, aws_region, mode=SYNC):
         """Constructor for TJIEmailer object
 
         Args:
             sender (string): Email of sender
             recipients ([] of strings): List of recipient emails
             aws_region (string): AWS region associated with SES
+            mode (string): 'sync' to send each email as send_email is called, 'async' to send them from a
+                background thread, or 'digest' to send one email covering all of them when flushed. Queued
+                emails are flushed at exit, including after sys.exit.
         """
+        if mode not in MODES:
+            raise ValueError('Unknown email mode %s, expected one of %s' % (mode, ', '.join(MODES)))
         self.sender = sender
         self.recipients = recipients
+        self.mode = mode
         self.logger = logging.getLogger('em')
         self.client = boto3.client('ses', region_name=aws_region)
         timestamp = datetime.now().strftime('%Y-%m-%d')
         log_file = 'logs/emailer+%s.log' % timestamp
         self.logger = tji_utils.set_up_logger(name='emailer', log_file=log_file)
 
-    def send_email(self, action, dataset, exception=None):
-        """Composes and sends a single email
+        self.started = time.time()
+        self._queue = queue.Queue()
+        # (action, dataset, exception, stages, when) of each email to include in the digest
+        self._digest = []
+        self._lock = threading.Lock()
+        self._worker = None
+        if mode == ASYNC:
+            self._worker = threading.Thread(target=self._send_queued, name='emailer', daemon=True)
+            self._worker.start()
+        if mode != SYNC:
+            atexit.register(self.flush)
+
+    def send_email(self, action, dataset, exception=None, stages=None):
+        """Composes and sends (or, unless in sync mode, queues) a single email
 
         Args:
             action (string): "cleaning" or "compression"
             dataset (string): Dataset name
             exception (Exception): If processing failed, the cause.
+            stages ([] of dicts): Instrumentation records of the slowest stages (see lib/instrumentation.py), to
+                list in a success email
         """
+        if self.mode == ASYNC:
+            self._queue.put(TJIEmailer.get_message(action, dataset, exception, stages))
+        elif self.mode == DIGEST:
+            with self._lock:
+                self._digest.append((action, dataset, exception, stages, time.time()))
+        else:
+            self._send(TJIEmailer.get_message(action, dataset, exception, stages))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Sends whatever is queued: waits for the background thread to send its emails, or sends the digest
+
+        Args:
+            timeout (float): Seconds to wait for the background thread before giving up on its emails
+        """
+        if self.mode == DIGEST:
+            with self._lock:
+                notifications, self._digest = self._digest, []
+            if notifications:
+                self._send(TJIEmailer.get_digest_message(notifications, self.started))
+        elif self.mode == ASYNC and self._worker.is_alive():
+            deadline = time.time() + timeout
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks and time.time() < deadline:
+                    self._queue.all_tasks_done.wait(deadline - time.time())
+            if self._queue.unfinished_tasks:
+                self.logger.error("Gave up on %d unsent emails after %ds." % (self._queue.unfinished_tasks, timeout))
+
+    def _send_queued(self):
+        while True:
+            message = self._queue.get()
+            try:
+                self._send(message)
+            except Exception:
+                self.logger.exception("Could not send email %s." % message['Subject']['Data'])
+            finally:
+                self._queue.task_done()
+
+    def _send(self, message):
         try:
             self.client.send_email(
                 Destination={
                     'ToAddresses': self.recipients
                 },
-                Message=TJIEmailer.get_message(action, dataset, exception),
+                Message=message,
                 Source=self.sender
             )
         except ClientError as e:
             self.logger.exception(e.response['Error']['Message'])
 
-    def get_message(action, dataset, exception):
+    def get_message(action, dataset, exception, stages=None):
         subject = TJIEmailer.get_subject(action, dataset, exception)
-        body = TJIEmailer.get_body(subject, exception)
+        body = TJIEmailer.get_body(subject, exception, stages)
+        return TJIEmailer.wrap_message(subject, body)
+
+    def get_digest_message(notifications, started):
+        failures = sum(1 for notification in notifications if notification[2])
+        subject = "TJI run {0}: {1} notifications, {2} failed".format(
+            "FAILURE" if failures else "SUCCESS", len(notifications), failures)
+        sections = []
+        for action, dataset, exception, stages, when in notifications:
+            section = """<h2>{0}</h2>
+                     <p>After {1:.0f}s</p>""".format(
+                html.escape(TJIEmailer.get_subject(action, dataset, exception)), when - started)
+            if exception:
+                section += "<p>Error:<pre>{0}</pre>".format(html.escape(TJIEmailer.format_exception(exception)))
+            elif stages:
+                section += TJIEmailer.format_stages(stages)
+            sections.append(section)
+        body = """<html>
+                   <head></head>
+                   <body>
+                     <h1>{0}</h1>
+                     {1}
+                   </body>
+                   </html> """.format(subject, '\n'.join(sections))
+        return TJIEmailer.wrap_message(subject, body)
+
+    def wrap_message(subject, body):
         return {
             'Body': {
                 'Html': {
@@ -66,7 +163,7 @@ class TJIEmailer():
             },
         }
 
-    def get_body(subject, exception):
+    def get_body(subject, exception, stages=None):
         if exception:
             formatted_exception = TJIEmailer.format_exception(exception)
             return """<html>
@@ -82,12 +179,34 @@ class TJIEmailer():
                    <head></head>
                    <body>
                      <h1>{0}</h1>
+                     {1}
                    </body>
-                   </html> """.format(subject)
+                   </html> """.format(subject, TJIEmailer.format_stages(stages) if stages else '')
 
     def get_subject(action, dataset, exception):
         indicator = "SUCCESS" if not exception else "FAILURE"
         return "{0} {1} {2}".format(action.capitalize(), dataset, indicator)
 
+    def format_stages(stages):
+        def cell(value, fmt):
+            return '' if value is None else fmt % value
+
+        rows = ''.join(
+            '<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td></tr>'.format(
+                html.escape(str(stage['stage'])),
+                html.escape(str(stage.get('notebook') or '')),
+                cell(stage.get('wall_s'), '%.1f'),
+                cell(stage.get('cpu_s'), '%.1f'),
+                cell(stage.get('peak_rss_mb'), '%.0f'),
+                cell(stage.get('rss_delta_mb'), '%+.0f'),
+                cell(stage.get('rows'), '%d'))
+            for stage in stages)
+        return """<h2>Slowest stages</h2>
+                     <table>
+                       <tr><th>Stage</th><th>Notebook</th><th>Wall (s)</th><th>CPU (s)</th><th>Peak RSS (MB)</th><th>RSS change (MB)</th><th>Rows</th></tr>
+                       {0}
+                     </table>""".format(rows)
+
     def format_exception(exception):
-        return ''.join(traceback.format_exception(*exc_info()))
+        # Use the exception's own traceback, since it may be reported after it was handled
+        return ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
@@ -0,0 +1,179 @@
+'''Benchmarks for the data cleaning library, on synthetic data (see lib/synthetic_data.py).
+
+Run from this directory:
+
+    python benchmarks.py                            # at 10k, 100k and 1M rows
+    python benchmarks.py -rows 10000 100000
+    python benchmarks.py -compare <commit> [<commit>]
+
+Each run appends its timings to benchmark_results.jsonl, tagged with the current git commit,
+so that commits can be compared offline with -compare.
+'''
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import timeit
+
+import pandas as pd
+
+from lib import cleaning_tools
+from lib import compression_tools
+from lib import standardize_police_agency_names as agency_names
+from lib.agency_resolver import AgencyCountyResolver
+from lib.synthetic_data import random_agency_names, synthetic_cdr, synthetic_ois, synthetic_website_frame
+
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.jsonl')
+DEFAULT_ROWS = [10000, 100000, 1000000]
+# Slowdowns bigger than this are flagged by -compare
+REGRESSION_RATIO = 1.2
+
+CLEANING_COLS_FUNCTIONS = [
+    'upcase_strip_string_cells', 'standardize_race_cols', 'standardize_gender_cols', 'numericalize_age_cols',
+    'convert_date_cols',
+]
+
+
+def time_once(func):
+    # The cleaning functions print progress for every column
+    with contextlib.redirect_stdout(io.StringIO()):
+        return timeit.timeit(func, number=1)
+
+
+def time_on_copy(func, df):
+    '''Times func on a copy of df, since the cleaning functions modify their input.'''
+    df = df.copy()
+    return time_once(lambda: func(df))
+
+
+def bench_cleaning_tools(n):
+    results = {}
+    for dataset, df in (('cdr', synthetic_cdr(n)), ('ois', synthetic_ois(n))):
+        for name in CLEANING_COLS_FUNCTIONS:
+            results['%s %s' % (dataset, name)] = time_on_copy(getattr(cleaning_tools, name), df)
+        results['%s to_intermediate_frame' % dataset] = time_once(lambda: cleaning_tools.to_intermediate_frame(df))
+    names = synthetic_cdr(n)['name_full']
+    results['standardize_name_series'] = time_once(lambda: cleaning_tools.standardize_name_series(names))
+    return results
+
+
+def bench_agency_names(n):
+    names = random_agency_names(n)
+    uncached = agency_names._standardize_agency_name.__wrapped__
+    results = {
+        'scalar apply (uncached)': time_once(
+            lambda: names.apply(lambda a: uncached(a) if isinstance(a, str) else None)),
+    }
+    agency_names._standardize_agency_name.cache_clear()
+    results['standardize_agency_names (cold cache)'] = time_once(
+        lambda: agency_names.standardize_agency_names(names))
+    results['standardize_agency_names (warm cache)'] = time_once(
+        lambda: agency_names.standardize_agency_names(names))
+    return results
+
+
+def bench_agency_counties(n):
+    names = agency_names.standardize_agency_names(random_agency_names(n))
+    # Index half the distinct names, so the other half are looked up fuzzily
+    distinct = names.dropna().unique()
+    resolver = AgencyCountyResolver(pd.DataFrame({'agency': distinct[::2], 'county': 'TRAVIS'}))
+    return {
+        'resolve (exact)': time_once(lambda: resolver.resolve(names)),
+        'resolve (within 2 edits)': time_once(lambda: resolver.resolve(names, max_distance=2)),
+    }
+
+
+def bench_compression(n):
+    df = synthetic_website_frame(n)
+    results = {
+        'compress_original': time_once(lambda: compression_tools.compress_original(df, id_col='record_id')),
+        'compress_new': time_once(lambda: compression_tools.compress_new(df, id_col='record_id')),
+    }
+    encoded = compression_tools.encode_new(df, id_col='record_id')
+
+    def write_gzipped():
+        with compression_tools.open_encoded(io.BytesIO(), 'gzip') as out:
+            compression_tools.write_compact_json(encoded, out)
+
+    results['write_compact_json (gzip)'] = time_once(write_gzipped)
+    return results
+
+
+BENCHMARKS = [
+    ('cleaning_tools', bench_cleaning_tools),
+    ('agency names', bench_agency_names),
+    ('agency counties', bench_agency_counties),
+    ('compression', bench_compression),
+]
+
+
+def git_commit():
+    '''Returns the current commit, with '-dirty' appended if there are uncommitted changes.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def run(rows_list, results_file):
+    commit = git_commit()
+    date = datetime.datetime.now().isoformat(timespec='seconds')
+    with open(results_file, 'a') as f:
+        for rows in rows_list:
+            for group, bench in BENCHMARKS:
+                print('%s, %d rows' % (group, rows))
+                for name, seconds in bench(rows).items():
+                    print('  %-45s %8.3fs' % (name, seconds))
+                    f.write(json.dumps({
+                        'commit': commit, 'date': date, 'rows': rows, 'benchmark': '%s: %s' % (group, name),
+                        'seconds': seconds, 'python': platform.python_version(), 'pandas': pd.__version__,
+                    }) + '\n')
+                f.flush()
+
+
+def latest_results(records, commit):
+    '''Returns {(benchmark, rows): seconds} from the latest run of each benchmark at commit (or a prefix of it).'''
+    results = {}
+    for r in records:
+        if r['commit'].startswith(commit):
+            results[(r['benchmark'], r['rows'])] = r['seconds']
+    return results
+
+
+def compare(base, head, results_file):
+    with open(results_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    base_results = latest_results(records, base)
+    head_results = latest_results(records, head)
+    if not base_results or not head_results:
+        print('No results for %s' % (base if not base_results else head))
+        return
+    print('%-65s %9s %9s %9s %7s' % ('benchmark', 'rows', base[:9], head[:9], 'ratio'))
+    for key in sorted(set(base_results) & set(head_results)):
+        before, after = base_results[key], head_results[key]
+        ratio = after / before if before else float('inf')
+        flag = '  REGRESSION' if ratio > REGRESSION_RATIO else ''
+        print('%-65s %9d %8.3fs %8.3fs %6.2fx%s' % (key[0], key[1], before, after, ratio, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the data cleaning library on synthetic data.')
+    parser.add_argument('-rows', type=int, nargs='+', default=DEFAULT_ROWS, help='Numbers of rows to benchmark with')
+    parser.add_argument('-results', default=RESULTS_FILE, help='JSON lines file to append results to')
+    parser.add_argument('-compare', nargs='+', metavar='COMMIT',
+                        help='Instead of benchmarking, compare the results of a commit with those of another '
+                             '(default: the current commit)')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare[0], args.compare[1] if len(args.compare) > 1 else git_commit(), args.results)
+    else:
+        run(args.rows, args.results)
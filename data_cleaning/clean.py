@@ -0,0 +1,46 @@
+'''Runs cleaning pipelines headlessly, without notebooks (see lib/pipelines.py).
+
+Run from this directory:
+
+    python clean.py                       # every pipeline
+    python clean.py ois_civilians ois_officers
+
+Outputs are written as the notebooks write them, so set CLEAN_<DATASET>_DW and
+CLEAN_<DATASET>_S3 to 'TRUE' to write to data.world and S3.
+'''
+import argparse
+import sys
+import traceback
+
+from lib.pipelines import PIPELINES, prefetch_pipelines, run_pipeline
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean datasets without running their notebooks.')
+    parser.add_argument('pipelines', nargs='*', metavar='PIPELINE',
+                        help='Pipelines to run, of: %s (default: all)' % ', '.join(PIPELINES))
+    args = parser.parse_args()
+    unknown = [name for name in args.pipelines if name not in PIPELINES]
+    if unknown:
+        parser.error('Unknown pipeline(s): %s' % ', '.join(unknown))
+
+    names = args.pipelines or list(PIPELINES)
+    try:
+        # Download every pipeline's inputs up front, concurrently
+        prefetch_pipelines(names)
+    except Exception:
+        # Each pipeline will try again, and fail on its own if it has to
+        traceback.print_exc()
+
+    failed = []
+    for name in names:
+        print('==== %s (%s)' % (name, PIPELINES[name].notebook or 'no notebook'))
+        try:
+            df = run_pipeline(name)
+        except Exception:
+            traceback.print_exc()
+            failed.append(name)
+            continue
+        print('%s: %d rows' % (name, len(df)))
+    if failed:
+        sys.exit('Failed: %s' % ', '.join(failed))
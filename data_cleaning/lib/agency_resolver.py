@@ -0,0 +1,125 @@
+'''Resolves standardized agency names to their counties, with a fuzzy fallback for near misses.
+
+AgencyCountyResolver indexes the agencies_and_counties auxiliary dataset. Exact matches are found
+with a single merge over the distinct names. Names with no exact match can optionally be matched
+to the agency within a few edits of them: a trigram index narrows the agencies down to the few that
+could be that close, and only those are compared, with an edit distance that gives up as soon as
+it exceeds the bound.
+'''
+
+import collections
+
+import numpy as np
+import pandas as pd
+
+
+# Near misses further than this many edits away are not suggested by near_misses
+NEAR_MISS_MAX_DISTANCE = 3
+
+
+def trigrams(name):
+    '''Returns the distinct trigrams of a name, padded so its first and last letters get their own.'''
+    padded = '  %s ' % name
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def bounded_edit_distance(a, b, max_distance):
+    '''Returns the Levenshtein distance between a and b, or None if it is more than max_distance.'''
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class AgencyCountyResolver(object):
+    '''Index over the agencies_and_counties dataset, for looking up the counties of agency names.
+
+    Names should already be standardized (see standardize_police_agency_names.py), as the dataset's are.
+    When an agency is listed more than once, its last county is used.
+    '''
+
+    def __init__(self, agencies):
+        self.agencies = agencies[['agency', 'county']].dropna(subset=['agency']).drop_duplicates(
+            'agency', keep='last').reset_index(drop=True)
+        self.names = self.agencies['agency'].tolist()
+        self.trigram_index = collections.defaultdict(list)
+        for i, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.trigram_index[gram].append(i)
+
+    def resolve(self, names, max_distance=0):
+        '''Resolves each name to an agency in the dataset, and its county.
+
+        Args:
+            names: Series of standardized agency names
+            max_distance: Names with no exact match are matched to the closest agency at most this many
+                edits away, if any. 0 (the default) only matches exactly.
+
+        Returns:
+            A dataframe with the same index as names, and columns agency (the agency matched), county,
+            distance (the edits between the name and the agency) and confidence (1 for exact matches,
+            down to 0 as the edits approach the length of the name). All of them are NaN for names
+            that don't match.
+        '''
+        codes, uniques = pd.factorize(names)
+        table = pd.DataFrame({'name': pd.Series(uniques, dtype=object)}).merge(
+            self.agencies, how='left', left_on='name', right_on='agency')
+        table['distance'] = np.where(table['agency'].notnull(), 0, np.nan)
+        if max_distance:
+            for i in np.flatnonzero(table['agency'].isnull().values):
+                match = self.closest(table.at[i, 'name'], max_distance)
+                if match is not None:
+                    table.loc[i, ['agency', 'county', 'distance']] = match
+        lengths = table['name'].str.len().combine(table['agency'].str.len(), max)
+        table['confidence'] = 1 - table['distance'] / lengths
+        # The -1 code (null) picks up an all-NaN row
+        result = table.reindex(codes).drop('name', axis=1)
+        result.index = names.index
+        return result.infer_objects()
+
+    def counties(self, names):
+        '''Returns the county of each (exactly matching) agency name, or NaN if unknown.'''
+        return self.resolve(names)['county']
+
+    def closest(self, name, max_distance):
+        '''Returns (agency, county, distance) for the agency fewest edits away from name, or None if none
+        are within max_distance. Ties go to the agency that shares the most trigrams with name.
+        '''
+        grams = trigrams(name)
+        shared = collections.Counter(i for gram in grams for i in self.trigram_index.get(gram, ()))
+        # Each edit changes at most 3 of name's trigrams, so an agency within max_distance edits shares
+        # all but 3 * max_distance of them. Short names can be that close to agencies sharing none.
+        min_shared = len(grams) - 3 * max_distance
+        candidates = [i for i, count in shared.most_common() if count >= min_shared]
+        if min_shared <= 0:
+            candidates += [i for i in range(len(self.names)) if i not in shared]
+        best = None
+        for i in candidates:
+            distance = bounded_edit_distance(name, self.names[i], max_distance)
+            if distance is not None:
+                best = (self.names[i], self.agencies.at[i, 'county'], distance)
+                # Only look for closer agencies from here on
+                max_distance = distance - 1
+                if max_distance < 0:
+                    break
+        return best
+
+
+def near_misses(names, agencies, max_distance=NEAR_MISS_MAX_DISTANCE):
+    '''Returns the distinct agency names with no county, the agency each most likely meant, and how often it occurs.
+
+    For reviewing unmatched agency names: suggestions with high confidence are probably typos, and
+    can be added to MANUAL_RENAMINGS in standardize_police_agency_names.py.
+    '''
+    counts = names.value_counts()
+    resolved = AgencyCountyResolver(agencies).resolve(pd.Series(counts.index, index=counts.index), max_distance)
+    missed = resolved[resolved['distance'] != 0].rename(columns={'agency': 'suggestion'})
+    missed['count'] = counts
+    return missed.sort_values(['confidence', 'count'], ascending=False)
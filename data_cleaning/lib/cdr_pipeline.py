@@ -0,0 +1,657 @@
+'''The custodial death reports (CDR) cleaning pipeline, as plain stage functions.
+
+clean_cdr.ipynb runs these one by one, with a look at the data (and the reasoning behind
+each step) along the way; run_cdr runs them all headlessly.
+
+Inputs:
+  * tji/raw-and-processing/CDR Reports All.xlsx
+  * tji/raw-and-processing/reformatted_cdr_2017_master_file
+  * tji/auxiliary-datasets/agencies_and_counties
+Output:
+  * tji/deaths-in-custody/cleaned_custodial_death_reports.csv
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from lib.agency_resolver import AgencyCountyResolver
+from lib.cleaning_tools import (
+    CleaningError, ColumnPlan, convert_date_cols, load_dtw_dataset, map_unique, read_dtw_excel,
+    standardize_gender_cols, standardize_race_cols, upcase_strip_string_cells)
+from lib.incremental import library_context, merge_incremental, plan_incremental, with_raw_index
+from lib.instrumentation import instrumented
+from lib.pipelines import (
+    AGENCIES_TABLE, DW_PROJECT_AUXILIARY_DATASETS, DW_PROJECT_CDR, DW_PROJECT_RAW_AND_PROCESSING, read_agencies,
+    write_outputs)
+from lib.schemas import CDR, CDR_RAW, DATE, FLOAT, GENDER, RACE
+from lib.standardize_police_agency_names import standardize_agency_names
+
+
+RAW_FILENAME = 'original/CDR Reports All.xlsx'
+OLD_MASTER_TABLE = 'reformatted_cdr_2017_master_file'
+OUTPUT_FILENAME = 'cleaned_custodial_death_reports.csv'
+
+# What run_cdr reads from data.world (see prefetch_pipelines)
+DW_INPUTS = [
+    (DW_PROJECT_RAW_AND_PROCESSING, RAW_FILENAME),
+    (DW_PROJECT_RAW_AND_PROCESSING, OLD_MASTER_TABLE),
+    (DW_PROJECT_AUXILIARY_DATASETS, AGENCIES_TABLE),
+]
+
+# Records on the 'Older Forms' sheet (pre-2005) are ignored, so that sheet isn't parsed at all.
+FORM_VERSION_SHEETS = [('Form Version 2005', 'V_2005'), ('Form Version 2016', 'V_2016')]
+
+OTHER_SPECIFY = 'OTHER, SPECIFY'
+
+# Columns we keep. The others we either don't need or haven't written code to clean yet.
+KEEP_COLUMNS = [
+    # Both forms
+    'Age At Time Of Death', 'Agency Address', 'Agency City', 'Agency Name', 'Agency Zip', 'CDR: CDR Name', 'City',
+    'County', 'Date of Birth', 'Date/Time of Custody or Incident', 'Death Date and Time', 'Death Location',
+    'Death Location Elsewhere', 'Entry Date Time', 'Entry Date Time N/A', 'First Name', 'Middle Name', 'Last Name',
+    'Suffix', 'Manner of Death', 'Manner of Death Description', 'Means of Death', 'Means of Death Other',
+    'Medical Cause of Death', 'Medical Examinor/Coroner Evalution?', 'Medical Treatment', 'Offense 1', 'Offense 2',
+    'Offense 3', 'Pre existing medical condition?', 'Report Date', 'Sex', 'Specific Type of Custody/Facility',
+    'Street Address', 'Type of Custody', 'Type of Offense', 'Type of Offense, Other', 'Version Number',
+    'Version Type', 'Were the Charges:', 'Who caused the death?', 'form_version', 'Type of Restraint',
+    'Under Restraint',
+    # 2005 form only
+    'Agency County', 'Custody Date NA', 'Death Causer Other', 'Department Type', 'Entry Behavior', 'Ethnicity',
+    'Ethnicity Other', 'Other Behavior', 'Specify Other Behavior',
+    # 2016 form only
+    'Exhibit any medical problems?', 'Exhibit any mental health problems?', 'Make suicidal statements?', 'Race',
+]
+
+# The two form versions offer slightly different options for the death-related questions
+# (e.g. V_2005 has 'AT MEDICAL FACILITY' where V_2016 has 'MEDICAL FACILITY'). These collapse
+# them into one set of options.
+DEATH_LOCATION_REPLACEMENTS = {
+    'AT MEDICAL FACILITY': 'MEDICAL FACILITY',
+    'AT LAW ENFORCEMENT FACILITY': 'LAW ENFORCEMENT FACILITY',
+    'AT THE CRIME/ARREST SCENE': 'CRIME/ARREST SCENE',
+    'SCENE OF INCIDENT': 'CRIME/ARREST SCENE',
+    'LAW ENFORCEMENT FACILITY/BOOKING CENTER': 'LAW ENFORCEMENT FACILITY',
+    'DEAD ON ARRIVAL AT MEDICAL FACILITY': 'EN ROUTE TO MEDICAL FACILITY',
+    'EN ROUTE TO BOOKING CENTER/POLICE LOCKUP': 'EN ROUTE TO LAW ENFORCEMENT FACILITY',
+    'ELSEWHERE': OTHER_SPECIFY,
+    'ELSEWHERE, SPECIFY': OTHER_SPECIFY,
+}
+MEANS_OF_DEATH_REPLACEMENTS = {
+    'NOT APPLICABLE, CAUSE OF DEATH WAS ILLNESS/NATURAL CAUSE': 'NOT APPLICABLE',
+    'NOT APPLICABLE; CAUSE OF DEATH WAS INTOXICATION OR ILLNESS/NATURAL CAUSES': 'NOT APPLICABLE',
+    'OTHER': OTHER_SPECIFY,
+    'KNIFE, CUTTING INSTRUMENT': 'KNIFE / EDGED INSTRUMENT',
+    'BLUNT INSTRUMENT': 'BATON / BLUNT INSTRUMENT',
+    "DON'T KNOW": 'UNKNOWN',
+    "DON\\'T KNOW": 'UNKNOWN',
+    'RIFLE/SHOTGUN': 'FIREARM',
+}
+# Rare and 'unknown'-type means of death, rolled into OTHER_SPECIFY. 'VEHICLE ACCIDENT' in
+# particular is new in the 2016 form, and only indicated as 'other' in older forms.
+MEANS_OF_DEATH_OTHER = ['UNKNOWN', 'VEHICLE ACCIDENT', 'KNIFE / EDGED INSTRUMENT', 'BATON / BLUNT INSTRUMENT']
+MANNER_OF_DEATH_REPLACEMENTS = {
+    'NATURAL': 'NATURAL CAUSES/ILLNESS',
+    'JUSTIFIABLE HOMICIDE': 'HOMICIDE',
+    'HOMICIDE BY LAW ENFORCEMENT/CORRECTIONAL STAFF': 'HOMICIDE',
+    'OTHER HOMICIDE': 'HOMICIDE',
+    'HOMICIDE (INCLUDES JUSTIFIABLE HOMICIDE)': 'HOMICIDE',
+    'ACCIDENTAL INJURY CAUSED BY OTHERS': 'ACCIDENTAL',
+    'ACCIDENTAL INJURY TO SELF': 'ACCIDENTAL',
+    'OTHER': OTHER_SPECIFY,
+    'OTHER - SPECIFY': OTHER_SPECIFY,
+}
+# In past versions "pending autopsy results" was not an option, and reports had "other" checked
+# with some mention of a pending autopsy in the free field. This emulates that, to be consistent
+# across form versions.
+MANNER_OF_DEATH_OTHER = ['PENDING AUTOPSY RESULTS', 'COULD NOT BE DETERMINED']
+PRE_EXISTING_MEDICAL_CONDITION_REPLACEMENTS = {
+    'DECEASED DEVELOPED CONDITION AFTER ADMISSION': 'DEVELOPED CONDITION AFTER ADMISSION',
+    "DON'T KNOW": 'UNKNOWN',
+    "DON\\'T KNOW": 'UNKNOWN',
+    'NOT APPLICABLE; CAUSE OF DEATH WAS ACCIDENTAL INJURY, INTOXICATION, SUICIDE OR HOMICIDE': 'NOT APPLICABLE',
+    'COULD NOT BE DETERMINED': 'UNKNOWN',
+    'PRE-EXISTING MEDICAL CONDITION': 'YES',
+}
+WHO_CAUSED_THE_DEATH_REPLACEMENTS = {
+    'DECEASED': 'DECEDENT',
+    "DON'T KNOW": 'UNKNOWN',
+    "DON\\'T KNOW": 'UNKNOWN',
+    'LAW ENFORCEMENT/CORRECTIONAL STAFF': 'LAW ENFORCEMENT/CORRECTIONAL PERSONNEL',
+    'NOT APPLICABLE; CAUSE OF DEATH WAS SUICIDE, INTOXICATION OR ILLNESS/NATURAL CAUSES': 'NOT APPLICABLE',
+    'OTHER DETAINEES': 'OTHER DETAINEE(S)',
+    'OTHER PERSONS': 'OTHER CIVILIAN(S)',
+    'ACCIDENTAL INJURY TO SELF': 'ACCIDENTAL',
+    'UNKNOWN PERSON(S) CAUSED THE INJURY': 'UNKNOWN',
+    'UNKNOWN WHETHER DECEDENT SUSTAINED A FATAL INJURY': 'UNKNOWN',
+}
+WERE_THE_CHARGES_REPLACEMENTS = {
+    'CAPITAL MURDER': 'CONVICTED',
+    'PROBATION/PAROLE': 'PROBATION/PAROLE VIOLATION',
+    'A PROBATION/PAROLE VIOLATION': 'PROBATION/PAROLE VIOLATION',
+}
+TYPE_OF_CUSTODY_REPLACEMENTS = {
+    'PRE-CUSTODIAL USE OF FORCE': 'POLICE CUSTODY (PRE-BOOKING)',
+    'PRIVATE CORRECTIONAL FACILITY': 'PRIVATE FACILITY',
+    'COUNTY JAIL': 'JAIL - COUNTY',
+    'MUNICIPAL JAIL': 'JAIL - MUNICIPAL',
+    'PENITENTIARY': 'PRISON',
+}
+SPECIFIC_TYPE_OF_CUSTODY_FACILITY_REPLACEMENTS = {
+    'TDCJ, SPECIFY': 'TDCJ',
+    'CUSTODY OF PEACE OFFICER DURING/FLEEING ARREST': 'CUSTODY OF LAW ENFORCEMENT PERSONNEL DURING/FLEEING ARREST',
+    'CUSTODY OF PEACE OFFICER SUBSEQUENT TO ARREST': 'CUSTODY OF LAW ENFORCEMENT PERSONNEL AFTER ARREST',
+    'CUSTODY OF LAW ENFORCEMENT PERSONNEL SUBSEQUENT TO ARREST': 'CUSTODY OF LAW ENFORCEMENT PERSONNEL AFTER ARREST',
+    'TEXAS-JUVENILE JUSTICE DEPARTMENT - FACILITY/DETENTION CENTER, SPECIFY': 'OTHER',
+    'TJPC': 'OTHER',
+    'TYC': 'OTHER',
+    'HALFWAY HOUSE/RESTITUTION CENTER': 'OTHER',
+    'CORRECTIONAL/REHABILITATION FACILITY': 'OTHER',
+    'NON-LAW ENFORCEMENT DETOX FACILITY': 'OTHER',
+}
+
+# Each round of deduplication treats records agreeing on these columns as duplicates
+DEDUP_ROUNDS = [
+    ['cdr_cdr_name'],
+    ['first_name', 'last_name', 'date_of_birth'],
+    ['first_name', 'last_name', 'death_date'],
+]
+
+FINAL_RENAMES = {
+    'first_name': 'name_first',
+    'middle_name': 'name_middle',
+    'last_name': 'name_last',
+    'suffix': 'name_suffix',
+    'cdr_cdr_name': 'record_id',
+    'death_causer_other': 'who_caused_death_in_homicide_or_accident_other',
+    'who_caused_the_death': 'who_caused_death_in_homicide_or_accident',
+    'death_location': 'death_location_type',
+    'death_location_elsewhere': 'death_location_type_other',
+    'city': 'death_location_city',
+    'county': 'death_location_county',
+    'street_address': 'death_location_street_address',
+    'entry_date_time': 'facility_entry_date_time',
+    'pre_existing_medical_condition': 'death_from_pre_existing_medical_condition',
+}
+
+FINAL_ORDER = [
+    # Record indexing columns
+    'record_id',
+    'num_revisions',
+    'form_version',
+    'report_date',
+    'date_time_of_custody_or_incident',
+
+    # Deceased personal information, demographics
+    'name_first',
+    'name_last',
+    'name_middle',
+    'name_suffix',
+    'name_full',
+    'date_of_birth',
+    'age_at_time_of_death',
+    'sex',
+    'race',
+
+    # Death event information
+    'death_date',
+    'death_date_and_time',
+    'death_location_county',
+    'death_location_city',
+    'death_location_street_address',
+    'death_location_type',
+    'death_location_type_other',
+    'death_from_pre_existing_medical_condition',
+    'manner_of_death',
+    'manner_of_death_description',
+    'means_of_death',
+    'means_of_death_other',
+    'medical_cause_of_death',
+    'medical_examinor_coroner_evalution',
+    'medical_treatment',
+    'days_from_custody_to_death',
+    'who_caused_death_in_homicide_or_accident',
+    'who_caused_death_in_homicide_or_accident_other',
+
+    # Criminal information on deceased
+    'offense_1',
+    'offense_2',
+    'offense_3',
+    'type_of_offense',
+    'type_of_offense_other',
+    'were_the_charges',
+
+    # Facility and agency information
+    'facility_entry_date_time',
+    'type_of_custody',
+    'specific_type_of_custody_facility',
+    'agency_address',
+    'agency_city',
+    'agency_county',
+    'agency_name',
+    'agency_zip',
+
+    # Deceased behavior upon entry or custody
+    'type_of_restraint',
+    'under_restraint',
+    'entry_behavior',
+    'other_behavior',
+    'exhibit_any_medical_problems',
+    'exhibit_any_mental_health_problems',
+    'make_suicidal_statements',
+]
+
+
+def snake_case(column):
+    '''Returns a column name lowercased, in snake_case, with non-alphanumeric characters removed.'''
+    name = ''.join([ch if ch.isalnum() else ' ' for ch in column.lower()])
+    return '_'.join(name.strip().split())
+
+
+def replace_values(series, replacements):
+    '''Replaces (stripped) values found in replacements, leaving nulls and other values as they are.'''
+    return map_unique(series, lambda x: replacements.get(x.strip(), x), keep_null=True)
+
+
+def incremental_context(agencies):
+    '''Returns everything besides the raw records that cleaned records depend on (see lib/incremental.py).'''
+    return library_context(frames=[agencies])
+
+
+def read_raw_cdr():
+    '''Reads the 2005 and 2016 form version sheets into one frame, with a form_version column.'''
+    sheets = read_dtw_excel(DW_PROJECT_RAW_AND_PROCESSING, RAW_FILENAME,
+                            select_sheet=[sheet for sheet, _ in FORM_VERSION_SHEETS], usecols=KEEP_COLUMNS)
+    for sheet, version in FORM_VERSION_SHEETS:
+        sheets[sheet]['form_version'] = version
+    cdr = pd.concat([sheets[sheet] for sheet, _ in FORM_VERSION_SHEETS])
+    print('Keeping %d records using form version 2005, and %d using version 2016 (keeping %d in total)' % (
+        len(sheets['Form Version 2005']), len(sheets['Form Version 2016']), len(cdr)))
+    return cdr
+
+
+def read_old_master():
+    '''Reads the "old master" file used by the first TJI website, which has BJS inpatient deaths the reports lack.'''
+    old_master = load_dtw_dataset(DW_PROJECT_RAW_AND_PROCESSING).dataframes[OLD_MASTER_TABLE]
+    old_master['form_version'] = 'V_BJS'
+    return old_master
+
+
+@instrumented()
+def drop_deaths_before_2005(cdr):
+    '''In theory all the reports are for deaths in 2005 or later. Drops any that aren't.'''
+    if cdr['Death Date and Time'].isnull().any():
+        raise CleaningError('Some reports have no death date')
+    cdr['Death Date and Time'] = pd.to_datetime(cdr['Death Date and Time'])
+    before = len(cdr)
+    cdr = cdr[cdr['Death Date and Time'].dt.year >= 2005]
+    print('Dropped %d (of %d) reports for deaths before 2005, leaving %d' % (before - len(cdr), before, len(cdr)))
+    return cdr
+
+
+@instrumented()
+def select_columns(cdr):
+    '''Keeps only KEEP_COLUMNS, renamed to snake_case.'''
+    missing = [c for c in KEEP_COLUMNS if c not in cdr.columns]
+    if missing:
+        raise CleaningError('Columns missing from the CDR reports: %s' % ', '.join(missing))
+    return cdr[KEEP_COLUMNS].rename(columns=dict((c, snake_case(c)) for c in KEEP_COLUMNS))
+
+
+@instrumented()
+def add_old_master(cdr, old_master):
+    '''Adds the old master file's records, to get BJS inpatient deaths (duplicates are dropped later).
+
+    The old master file may lack a few columns, but must not have any the reports don't.
+    '''
+    novel = set(old_master.columns) - set(cdr.columns)
+    if novel:
+        raise CleaningError('The old master file has columns the reports do not: %s' % ', '.join(sorted(novel)))
+    cdr = pd.concat([cdr, old_master])
+    cdr.reset_index(inplace=True, drop=True)
+    cdr.sort_values('form_version', inplace=True)
+    return cdr
+
+
+def float_or_nan(val):
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        pass
+    print("- BAD VALUE (returning NaN):", val)
+    return np.nan
+
+
+@instrumented()
+def convert_column_types(cdr):
+    '''Converts date and float columns (as declared in CDR_RAW), upcases strings, and adds death_date
+    (death_date_and_time without the time).
+    '''
+    before = cdr.dtypes
+    rejected = convert_date_cols(cdr, CDR_RAW.find(DATE, cdr.columns))
+    changed = before[before != cdr.dtypes].index.tolist()
+    print("Changed %d cols to datetime (from some other dtype):" % len(changed), changed)
+    for c, values in rejected.items():
+        print("- %d values of %s could not be parsed as dates" % (values.sum(), c))
+
+    # Some floats are stored as strings
+    for c in CDR_RAW.find(FLOAT, cdr.columns):
+        print("Converting", c)
+        cdr[c] = cdr[c].apply(float_or_nan).astype(float)
+
+    upcase_strip_string_cells(cdr)
+    cdr['death_date'] = cdr['death_date_and_time'].dt.normalize()
+    return cdr
+
+
+@instrumented()
+def merge_race_and_ethnicity(cdr):
+    '''Merges the 2005 form's 'ethnicity' into the 2016 form's 'race', and standardizes race values.'''
+    # Collapse the various OTHER-like values
+    cdr.loc[cdr['ethnicity'].fillna('').str.contains('OTHER'), 'ethnicity'] = 'OTHER'
+    # 'OTHER' ethnicities are specified in 'ethnicity_other', where 0 is nonsensical
+    cdr.loc[cdr['ethnicity_other'].astype(str) == '0', 'ethnicity_other'] = None
+    misused = (~(cdr['ethnicity'] == 'OTHER') & cdr['ethnicity_other'].notnull()).sum()
+    if misused:
+        print("Warning: dropping %d 'ethnicity_other' values given for an ethnicity besides 'OTHER'" % misused)
+    other_eth = (cdr['ethnicity'] == 'OTHER')
+    print('Merging %d "ethnicity_other" values into the main "ethnicity" column' % other_eth.sum())
+    cdr.loc[other_eth, 'ethnicity'] = cdr['ethnicity_other'][other_eth]
+    cdr = cdr.drop('ethnicity_other', axis=1)
+
+    # Only one of race and ethnicity should be set
+    if (cdr['race'].notnull() & cdr['ethnicity'].notnull()).any():
+        raise CleaningError('Some records have both a race and an ethnicity')
+    cdr['race'] = cdr['race'].where(cdr['race'].notnull(), cdr['ethnicity'])
+    cdr = cdr.drop('ethnicity', axis=1)
+    standardize_race_cols(cdr, CDR_RAW.find(RACE, cdr.columns))
+    return cdr
+
+
+@instrumented()
+def standardize_agencies(cdr, agencies):
+    '''Standardizes agency names, looks up their counties, and drops the test agency's records.'''
+    cdr['agency_name'] = standardize_agency_names(cdr['agency_name'])
+
+    # Look up the county by agency name, falling back on the county given in the form, if any
+    cdr['agency_county'] = cdr['agency_county'].str.upper()
+    cdr['agency_county'] = AgencyCountyResolver(agencies).counties(cdr['agency_name']).fillna(cdr['agency_county'])
+    # Manually handle one major agency
+    cdr.loc[cdr['agency_name'] == 'TEXAS DEPT OF CRIMINAL JUSTICE', 'agency_county'] = 'STATE'
+
+    test_agencies = cdr['agency_name'] == 'TEST CDR AGENCY'
+    cdr = cdr[~test_agencies]
+    print("Dropping %d records from 'TEST CDR AGENCY', leaving %d records" % (test_agencies.sum(), len(cdr)))
+    return cdr
+
+
+def fix_coroner(result):
+    if pd.isnull(result):
+        return None
+    result = result.strip()
+    if result.startswith('YES'):
+        return 'YES'
+    elif result.startswith('NO'):
+        return 'NO'
+    return None
+
+
+def _move_to_other(cdr, col, other_col, values):
+    '''Moves the given values of col into other_col, setting col to OTHER_SPECIFY instead.'''
+    indices = cdr[col].isin(values)
+    cdr.loc[indices, other_col] = cdr.loc[indices, col]
+    cdr.loc[indices, col] = OTHER_SPECIFY
+
+
+@instrumented()
+def fix_death_columns(cdr):
+    '''Collapses the death-related columns' values to one set of options across form versions.'''
+    # Some are 0/1, which would throw an error
+    cdr['death_location'] = np.where(cdr['death_location'].isin([0, 1]), np.nan, cdr['death_location'])
+    cdr['death_location'] = replace_values(cdr['death_location'], DEATH_LOCATION_REPLACEMENTS)
+
+    # Officers sometimes pick 'other' when another category is more appropriate
+    cdr['means_of_death'] = replace_values(cdr['means_of_death'], MEANS_OF_DEATH_REPLACEMENTS)
+    _move_to_other(cdr, 'means_of_death', 'means_of_death_other', MEANS_OF_DEATH_OTHER)
+
+    cdr['manner_of_death'] = replace_values(cdr['manner_of_death'], MANNER_OF_DEATH_REPLACEMENTS)
+    _move_to_other(cdr, 'manner_of_death', 'manner_of_death_description', MANNER_OF_DEATH_OTHER)
+
+    # A few suicides by hanging have the wrong means_of_death
+    suicides = cdr['manner_of_death'] == 'SUICIDE'
+    hanging = (cdr['medical_cause_of_death'].fillna('').str.contains('HANGING') |
+               cdr['manner_of_death_description'].fillna('').str.contains('HANGING'))
+    cdr.loc[suicides & hanging, 'means_of_death'] = 'HANGING, STRANGULATION'
+    # For a few suicides means_of_death is 'NOT APPLICABLE', which makes no sense
+    cdr.loc[suicides & (cdr['means_of_death'] == 'NOT APPLICABLE'), 'means_of_death'] = OTHER_SPECIFY
+
+    cdr['pre_existing_medical_condition'] = replace_values(
+        cdr['pre_existing_medical_condition'], PRE_EXISTING_MEDICAL_CONDITION_REPLACEMENTS)
+
+    # The 2016 form asks who caused deaths by suicide too, but earlier forms only ask about
+    # accidents and homicides
+    cdr['who_caused_the_death'] = replace_values(cdr['who_caused_the_death'], WHO_CAUSED_THE_DEATH_REPLACEMENTS)
+    cdr.loc[~cdr['manner_of_death'].isin(['HOMICIDE', 'ACCIDENTAL', OTHER_SPECIFY]),
+            'who_caused_the_death'] = 'NOT APPLICABLE'
+
+    cdr['medical_examinor_coroner_evalution'] = cdr['medical_examinor_coroner_evalution'].apply(fix_coroner)
+    return cdr
+
+
+def other_behavior(other, specify):
+    '''Merges the 2005 form's 'other behavior' checkbox with the behavior it specifies, if any.'''
+    if pd.notnull(specify):
+        return specify
+    try:
+        if float(other) == 0.0:
+            return None
+    except (TypeError, ValueError):
+        pass
+    return other
+
+
+@instrumented()
+def fix_other_columns(cdr):
+    '''Standardizes gender, charges and custody types, and merges other_behavior with specify_other_behavior.'''
+    standardize_gender_cols(cdr, CDR_RAW.find(GENDER, cdr.columns))
+    cdr['were_the_charges'] = replace_values(cdr['were_the_charges'], WERE_THE_CHARGES_REPLACEMENTS)
+    cdr['type_of_custody'] = replace_values(cdr['type_of_custody'], TYPE_OF_CUSTODY_REPLACEMENTS)
+    cdr['specific_type_of_custody_facility'] = replace_values(
+        cdr['specific_type_of_custody_facility'], SPECIFIC_TYPE_OF_CUSTODY_FACILITY_REPLACEMENTS)
+
+    cdr['other_behavior'] = pd.Series(
+        [other_behavior(o, s) for o, s in zip(cdr['other_behavior'], cdr['specify_other_behavior'])],
+        index=cdr.index)
+    return cdr.drop('specify_other_behavior', axis=1)
+
+
+@instrumented()
+def drop_unneeded_columns(cdr):
+    '''Drops columns that can be inferred from others (e.g. entry_date_time_n_a) or are inconsistently present.'''
+    return cdr.drop(['entry_date_time_n_a', 'custody_date_na', 'department_type'], axis=1)
+
+
+def merge_dup_records(frame):
+    '''Master merge function. Creates one record from several that are known duplicates.
+
+    Returns the record, and a description of how it was made.
+    '''
+    # Ignore BJS records (these are from and old data dump), unless there is no other option.
+    form_versions_seen = set(frame['form_version'])
+    if 'V_BJS' in form_versions_seen and len(form_versions_seen) > 1:
+        frame = frame[frame['form_version'] != 'V_BJS']
+        if len(frame) == 1:
+            return frame.iloc[0], 'Keeping the only non-BJS record'
+
+    # If one record has a higher version_number than the rest, keep that one.
+    # If one record has a more recent report_date than the rest, keep that one.
+    for c in ['version_number', 'report_date']:
+        maxval = frame[c].max()  # Implicitly ignores missing values, unless only missing values exist
+        if pd.notnull(maxval):
+            frame = frame[frame[c] == maxval]
+            if len(frame) == 1:
+                return frame.iloc[0], 'Keeping the record with greatest %s' % c
+
+    # Otherwise, there's no way to flag the "one" right record, so merge them.
+    merged_rec = pd.Series(index=frame.columns, dtype=object,
+                           name=1000000 + frame.index[0])  # Give it a new, unique index
+    awk = False
+    for c in frame.columns:
+        notnull = frame[c][frame[c].notnull()]
+
+        # If all records have NA for this column, leave it as NA
+        if len(notnull) == 0:
+            merged_rec[c] = frame[c].iloc[0]
+            continue
+
+        # Only 1 unique not-null value? Keep that one.
+        if len(notnull) == 1 or len(set(notnull)) == 1:
+            merged_rec[c] = notnull.iloc[0]
+            continue
+
+        # Record IDs can't be merged, so concatenate them.
+        if c == 'cdr_cdr_name':
+            merged_rec[c] = '-'.join(notnull)
+            continue
+
+        # Multiple unique values for this column. Take the most popular one
+        # (which will just be an arbitrary one if there's a tie).
+        awk = True
+        vc = notnull.value_counts()
+        keeper = vc.index[0]
+        if vc.iloc[0] > vc.iloc[1]:
+            print("  > Problem with column %s, keeping the most popular value, '%s'"
+                  % (c, keeper), notnull.values)
+        else:
+            print("  > Problem with column %s, keeping an arbitrary tied-for-most-popular value, '%s'"
+                  % (c, keeper), notnull.values)
+        merged_rec[c] = keeper
+
+    merged_rec['cdr_cdr_name'] = 'MERGED-DUPLICATES-%s' % merged_rec['cdr_cdr_name']
+    if awk:
+        return merged_rec, 'Merged awkwardly'
+    else:
+        return merged_rec, 'Merged smoothly enough'
+
+
+def dedup_cdr_by(cdr, cols):
+    '''Merges records that agree on cols.
+
+    Returns the deduplicated frame, the frames of duplicates that were merged, the merged
+    records, and how each was merged.
+    '''
+    dups = cdr[cdr.duplicated(subset=cols, keep=False)]
+    if not len(dups):
+        return cdr, [], [], []
+    unmerged_frames = []
+    merged_records = []
+    merge_methods = []
+    for _, frame in dups.groupby(cols):
+        rec, meth = merge_dup_records(frame)
+        unmerged_frames.append(frame)
+        merged_records.append(rec)
+        merge_methods.append(meth)
+        if 'awkward' in meth:
+            print("...awkward merge complete for records at indices", frame.index)
+
+    merged = pd.DataFrame(merged_records)[list(cdr.columns)]
+    return pd.concat([cdr.drop(dups.index), merged]), unmerged_frames, merged_records, merge_methods
+
+
+@instrumented()
+def dedup_cdr(cdr, merges=None):
+    '''Drops exact duplicate rows, then merges duplicate records over each of DEDUP_ROUNDS.
+
+    In theory records could be deduplicated by record id (cdr_cdr_name), but records with the
+    same id sometimes differ, and the same death is sometimes reported under several ids.
+
+    Args:
+        cdr: The records
+        merges: If a list, each round's (unmerged_frames, merged_records, merge_methods) are appended
+            to it, to inspect the merges with
+    '''
+    pure_dups = cdr.duplicated()
+    cdr = cdr[~pure_dups]
+    print("Dropping %d rows that are 100%% duplicates of another row, leaving %d rows" % (pure_dups.sum(), len(cdr)))
+
+    before = len(cdr)
+    for i, cols in enumerate(DEDUP_ROUNDS):
+        print('**** Dedup step %d: find duplicates on these columns:' % (i + 1), cols)
+        cdr, unmerged_frames, merged_records, merge_methods = dedup_cdr_by(cdr, cols)
+        if merges is not None:
+            merges.append((unmerged_frames, merged_records, merge_methods))
+        print("Dropping %d duplicates and adding %d merged records, yielding %d records" % (
+            sum(len(f) for f in unmerged_frames), len(merged_records), len(cdr)))
+    print("Ultimately removing %d duplicate records, leaving %d" % (before - len(cdr), len(cdr)))
+    return cdr
+
+
+def get_days(dt):
+    '''Days in a timedelta from custody (or the incident) to death.
+
+    When death is a day before custody, that's taken to be a minor error and the days are 0.
+    When it's more than a day before, the days are None.
+    '''
+    if dt.days < -1:
+        return None
+    elif dt.days == -1:
+        return 0
+    else:
+        return dt.days
+
+
+@instrumented()
+def finalize_columns(cdr):
+    '''Adds days_from_custody_to_death, name_full and num_revisions, then renames and reorders the columns.'''
+    delta = cdr['death_date_and_time'] - cdr['date_time_of_custody_or_incident']
+    print("For %d records with death date before custody date, setting the days_from_custody_to_death to NaN"
+          % (delta.dt.days < -1).sum())
+    cdr['days_from_custody_to_death'] = delta.apply(get_days)
+
+    name_full = cdr['first_name'].fillna('')
+    for col in ['middle_name', 'last_name', 'suffix']:
+        name_full = name_full + ' ' + cdr[col].fillna('')
+    name_full = name_full.str.split().str.join(' ')
+    cdr['name_full'] = name_full.where(name_full != '', np.nan)
+
+    cdr['num_revisions'] = cdr['version_number'] - 1
+    # Renaming in place, and dropping and reordering in one go, copies the frame once instead of three times
+    cdr.columns = [FINAL_RENAMES.get(c, c) for c in cdr.columns]
+    return ColumnPlan(cdr).drop(['version_type', 'version_number']).reorder(FINAL_ORDER).apply()
+
+
+def clean_cdr(raw, old_master, agencies, merges=None, incremental=False):
+    '''Runs every cleaning stage.
+
+    Args:
+        raw: The reports, as read by read_raw_cdr
+        old_master: The old master file, as read by read_old_master
+        agencies: The agencies_and_counties auxiliary dataset
+        merges: See dedup_cdr
+        incremental: Whether to only clean records that changed since the last run (see lib/incremental.py)
+    '''
+    cdr = drop_deaths_before_2005(raw)
+    cdr = select_columns(cdr)
+    cdr = add_old_master(cdr, old_master)
+    plan = plan_incremental(cdr, 'cdr_cdr_name', OUTPUT_FILENAME, context=incremental_context(agencies),
+                            enabled=incremental)
+    print("Cleaning %d of %d records" % (len(plan.to_clean), len(plan.keys)))
+    cdr = convert_column_types(plan.to_clean)
+    cdr = merge_race_and_ethnicity(cdr)
+    cdr = standardize_agencies(cdr, agencies)
+    cdr = fix_death_columns(cdr)
+    cdr = fix_other_columns(cdr)
+    cdr = drop_unneeded_columns(cdr)
+    # Deduplication looks across records, so it needs all of them (indexed as before, for its merged records)
+    cdr = with_raw_index(merge_incremental(cdr, plan), plan)
+    cdr = dedup_cdr(cdr, merges)
+    return finalize_columns(cdr)
+
+
+def run_cdr():
+    '''Reads, cleans and writes the CDR dataset. Returns the cleaned dataframe.'''
+    cdr = clean_cdr(read_raw_cdr(), read_old_master(), read_agencies(),
+                    incremental=os.environ.get('CLEAN_CDR_INCREMENTAL') == 'TRUE')
+    write_outputs(cdr, OUTPUT_FILENAME, DW_PROJECT_CDR, 'cdr', schema=CDR)
+    return cdr
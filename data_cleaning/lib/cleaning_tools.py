@@ -1,22 +1,159 @@
 '''Shared utilities for data cleaning.'''
 
 
+import collections
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 import datadotworld as dw
 import numpy as np
 import pandas as pd
 
+from lib.instrumentation import instrumented
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    # pandas < 2.0
+    from pandas._libs.tslibs.parsing import _guess_datetime_format as guess_datetime_format
+
+try:
+    from pandas._libs.parsers import STR_NA_VALUES as CSV_NA_VALUES
+except ImportError:
+    # pandas < 1.0
+    from pandas.io.common import _NA_VALUES as CSV_NA_VALUES
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the data.world cache is then only safe to share between threads, not processes
+    fcntl = None
+
+try:
+    from urllib3.exceptions import HTTPError as Urllib3Error
+except ImportError:
+    Urllib3Error = OSError
+
 
 class CleaningError(Exception):
     pass
 
 
+def _broadcast_lookup(series, codes, lookup_values, null_value=None, keep_null=False):
+    '''Expands per-distinct-value results back out to a full series, given factorize() codes.'''
+    # The extra trailing slot is what the -1 code (null) that factorize assigns picks up.
+    if isinstance(series.dtype, pd.api.types.CategoricalDtype):
+        # Series.apply only maps a categorical's categories, leaving missing values NaN
+        null_value = np.nan
+    lookup = np.empty(len(lookup_values) + 1, dtype=object)
+    lookup[:-1] = lookup_values
+    lookup[-1] = null_value
+    values = lookup[codes]
+    if keep_null:
+        nulls = codes == -1
+        values[nulls] = np.asarray(series, dtype=object)[nulls]
+    # Mirror the dtype inference Series.apply does on its results
+    return pd.Series(values, index=series.index, name=series.name).infer_objects()
+
+
+def map_unique(series, func, keep_null=False):
+    '''Equivalent to series.apply(func), but calls func once per distinct value instead of once per cell.
+
+    Null cells become func(None), or are left untouched if keep_null is True.
+    '''
+    codes, uniques = pd.factorize(series)
+    return _broadcast_lookup(series, codes, [func(v) for v in uniques],
+                             null_value=None if keep_null else func(None), keep_null=keep_null)
+
+
+# parallel_apply only uses worker processes for frames with at least this many rows, below which
+# starting them costs more than it saves
+PARALLEL_MIN_ROWS = int(os.environ.get('TJI_PARALLEL_MIN_ROWS', 100000))
+PARALLEL_WORKERS = int(os.environ.get('TJI_PARALLEL_WORKERS', os.cpu_count() or 1))
+
+# The function and columns of the running parallel_apply, which forked workers inherit
+_parallel_task = None
+_parallel_lock = threading.Lock()
+
+
+def _apply_rows(func, arrays, start, stop):
+    return [func(*values) for values in zip(*[a[start:stop] for a in arrays])]
+
+
+def _apply_parallel_chunk(bounds):
+    func, arrays = _parallel_task
+    return _apply_rows(func, arrays, *bounds)
+
+
+def parallel_apply(df, func, columns, n_workers=None, chunk_size=None):
+    '''Returns func(*row) for the values of columns in each row of df, as a series with df's index.
+
+    The rows are split into chunks of chunk_size (by default, 4 per worker) and spread over
+    n_workers processes (PARALLEL_WORKERS by default). The workers are forked, so they share
+    the columns (and func, which needn't be picklable) with this process instead of having
+    them pickled, and only send their results back. Frames with fewer than PARALLEL_MIN_ROWS
+    rows, and platforms that can't fork, are done in this process.
+
+    So are frames applied to while other threads are running (e.g. prefetch_dtw's, background
+    S3 uploads, or notebooks run in-process by the automation): a forked worker only gets the
+    calling thread, and would deadlock on any lock another thread held at the time of the fork.
+    '''
+    global _parallel_task
+    n_workers = n_workers or PARALLEL_WORKERS
+    arrays = [df[c].values for c in columns]
+    if (n_workers <= 1 or len(df) < PARALLEL_MIN_ROWS or
+            'fork' not in multiprocessing.get_all_start_methods()):
+        values = _apply_rows(func, arrays, 0, len(df))
+    elif threading.active_count() > 1:
+        print('Applying %s to %d rows in this process, since other threads are running' % (
+            getattr(func, '__name__', 'function'), len(df)))
+        values = _apply_rows(func, arrays, 0, len(df))
+    else:
+        chunk_size = chunk_size or -(-len(df) // (n_workers * 4))
+        bounds = [(start, min(start + chunk_size, len(df))) for start in range(0, len(df), chunk_size)]
+        with _parallel_lock:
+            _parallel_task = (func, arrays)
+            try:
+                with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                    values = [v for chunk in pool.map(_apply_parallel_chunk, bounds) for v in chunk]
+            finally:
+                _parallel_task = None
+    return pd.Series(values, index=df.index, dtype=None if values else object)
+
+
+def _upcase_strip(x):
+    return x if not isinstance(x, str) else x.strip().upper()
+
+
+def upcase_strip_series(series):
+    '''Vectorized version of upcasing and stripping every string cell in a series.'''
+    if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if isinstance(series.dtype, pd.api.types.CategoricalDtype):
+        # Categoricals already only map each category once
+        return series.apply(_upcase_strip)
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    is_str = uniques.map(lambda x: isinstance(x, str)).astype(bool)
+    uniques[is_str] = uniques[is_str].str.strip().str.upper()
+    return _broadcast_lookup(series, codes, uniques.values, keep_null=True)
+
+
+@instrumented()
 def upcase_strip_string_cells(df):
     for c in df.columns:
-        df[c] = df[c].apply(lambda x: x if not isinstance(x, str) else x.strip().upper())
+        df[c] = upcase_strip_series(df[c])
 
 
 WHITE, BLACK, HISPANIC, OTHER = 'WHITE,BLACK,HISPANIC,OTHER'.split(',')
@@ -39,10 +176,36 @@ def standardize_race(race):
         return OTHER
 
 
-def standardize_race_cols(df):
-    cols = [c for c in df.columns if 'race' in c.split('_') or 'ethnicity' in c.split('_')]
+def standardize_race_series(series):
+    '''Vectorized version of standardize_race over a whole series.'''
+    codes, uniques = pd.factorize(series)
+    if not len(uniques):
+        return _broadcast_lookup(series, codes, [])
+    uniques = pd.Series(uniques, dtype=object)
+    lowered = uniques.str.lower()
+
+    def has(word):
+        return lowered.str.contains(word, regex=False, na=False)
+
+    white = has('anglo') | has('white') | has('caucasian') | (lowered == 'ao')
+    black = has('black') | has('african')
+    hispanic = (has('hispanic') | has('latino')) & ~has('non hispanic') & ~has('not hispanic')
+    races = np.select([white, black, hispanic], [WHITE, BLACK, HISPANIC], default=OTHER).astype(object)
+    # Empty strings are treated as missing
+    races[(lowered == '').values] = None
+    # Leave anything that isn't a string to the scalar version (and its errors)
+    not_str = lowered.isnull().values
+    races[not_str] = [standardize_race(r) for r in uniques[not_str]]
+    return _broadcast_lookup(series, codes, races)
+
+
+@instrumented()
+def standardize_race_cols(df, cols=None):
+    '''Standardizes race columns in place: cols, or if None, those with race or ethnicity in their names.'''
+    if cols is None:
+        cols = [c for c in df.columns if 'race' in c.split('_') or 'ethnicity' in c.split('_')]
     for col in cols:
-        df[col] = df[col].apply(standardize_race)
+        df[col] = standardize_race_series(df[col])
 
 
 MALE = 'MALE'
@@ -67,57 +230,142 @@ def standardize_gender(gender):
         raise CleaningError('Unrecognized gender: "%s"' % gender)
 
 
-def standardize_gender_cols(df):
-    cols = [c for c in df.columns if 'gender' in c.split('_') or 'sex' in c.split('_')]
+GENDER_LOOKUP = {'m': MALE, 'male': MALE, 'man': MALE, 'f': FEMALE, 'female': FEMALE, 'woman': FEMALE}
+GENDER_LOOKUP.update((g, None) for g in GENDERS_UNKNOWN + [''])
+
+
+def standardize_gender_series(series):
+    '''Vectorized version of standardize_gender over a whole series.'''
+    codes, uniques = pd.factorize(series)
+    if not len(uniques):
+        return _broadcast_lookup(series, codes, [])
+    normalized = pd.Series(uniques, dtype=object).str.strip().str.lower()
+    unrecognized = ~normalized.isin(list(GENDER_LOOKUP))
+    if unrecognized.any():
+        # Same error the scalar version raises on the first bad value it sees
+        standardize_gender(uniques[unrecognized.values.argmax()])
+    return _broadcast_lookup(series, codes, [GENDER_LOOKUP[g] for g in normalized])
+
+
+@instrumented()
+def standardize_gender_cols(df, cols=None):
+    '''Standardizes gender columns in place: cols, or if None, those with gender or sex in their names.'''
+    if cols is None:
+        cols = [c for c in df.columns if 'gender' in c.split('_') or 'sex' in c.split('_')]
     for col in cols:
-        df[col] = df[col].apply(standardize_gender)
+        df[col] = standardize_gender_series(df[col])
+
+
+def rejected_values(before, after):
+    '''Returns counts of the values that were present before a conversion but missing after it.'''
+    rejected = before[before.notnull() & after.isnull()]
+    return rejected.astype(object).value_counts()
+
 
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
 
-def numericalize_age_cols(df):
-    cols = [c for c in df.columns if 'age' in c.split('_')]
+
+@instrumented()
+def numericalize_age_cols(df, cols=None):
+    '''Converts age columns to floats in place: cols, or if None, those with age in their names.
+
+    Returns a dict mapping column name to counts of the values that could not be
+    converted (and were replaced with NaN), for columns that had any.
+    '''
+    if cols is None:
+        cols = [c for c in df.columns if 'age' in c.split('_')]
+    report = {}
     for c in cols:
         print("Numericalizing column %s" % c)
-        bad_values = []
-        new_values = []
-        for value in df[c]:
-            if pd.isnull(value):
-                new_values.append(value)
-            else:
-                try:
-                    newval = float(value)
-                except ValueError:
-                    newval = np.nan
-                    bad_values.append(value)
-                new_values.append(newval)
-        df[c] = new_values
-        df[c] = df[c].astype(float)
-        if bad_values:
-            print("Replaced %d bad values with NA:" % len(bad_values))
-            print("Unique bad values:", set(bad_values))
-
-
-def convert_date_cols(df):
-    cols = [c for c in df.columns if 'date' in c.split('_')]
-    cols = [c for c in cols if '_n_a' not in c and 'na' not in c.split('_')]
+        before = df[c]
+        if pd.api.types.is_numeric_dtype(before):
+            df[c] = before.astype(float)
+            continue
+        codes, uniques = pd.factorize(before)
+        df[c] = _broadcast_lookup(before, codes, [_float_or_nan(v) for v in uniques],
+                                  null_value=np.nan).astype(float)
+        rejected = rejected_values(before, df[c])
+        if len(rejected):
+            report[c] = rejected
+    return report
+
+
+# Parsing formats inferred so far, keyed on the shape of the value, e.g. '99/99/9999 99:99'.
+_DATE_FORMAT_CACHE = {}
+
+
+def _date_pattern_format(pattern, example):
+    if pattern not in _DATE_FORMAT_CACHE:
+        fmt = guess_datetime_format(example)
+        if fmt and '%d' in fmt and '%m' in fmt and fmt.index('%d') < fmt.index('%m'):
+            # A day-first guess (e.g. from "13/02/2016"). Parsing a single value is month-first
+            # whenever that works, so use the month-first format and let the values that
+            # don't fit it fall back to being parsed one at a time.
+            fmt = fmt.replace('%d', '%_').replace('%m', '%d').replace('%_', '%m')
+        _DATE_FORMAT_CACHE[pattern] = fmt
+    return _DATE_FORMAT_CACHE[pattern]
+
+
+def _to_datetime_or_nat(value):
+    try:
+        return pd.to_datetime(value)
+    except ValueError:
+        return pd.NaT
+
+
+def to_datetime_series(series):
+    '''Converts a series to datetimes, turning unparseable values into NaT.
+
+    Gives the same result as calling pd.to_datetime on each value separately, but
+    parses each distinct value once, and parses strings in bulk: values are grouped by
+    their shape, and each group is parsed in one call with a format inferred (and cached)
+    for that shape. Values that don't fit their group's format fall back to being parsed
+    one at a time.
+    '''
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    strings = uniques[uniques.map(lambda x: isinstance(x, str)).astype(bool)]
+    patterns = strings.str.replace(r'\d', '9', regex=True).str.replace('[A-Za-z]', 'a', regex=True)
+    for pattern, group in strings.groupby(patterns):
+        fmt = _date_pattern_format(pattern, group.iloc[0])
+        if fmt:
+            parsed[group.index] = pd.to_datetime(group, format=fmt, errors='coerce')
+    is_datetime = uniques.map(lambda x: isinstance(x, (datetime.date, np.datetime64))).astype(bool)
+    if is_datetime.any():
+        parsed[is_datetime] = pd.to_datetime(uniques[is_datetime].tolist())
+    leftover = parsed.isnull()
+    parsed[leftover] = pd.to_datetime([_to_datetime_or_nat(v) for v in uniques[leftover]])
+    # The trailing NaT is what the -1 code (null) picks up, even when there are no other values
+    values = np.append(parsed.values, np.datetime64('NaT'))[codes]
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+@instrumented()
+def convert_date_cols(df, cols=None):
+    '''Converts date columns to datetimes in place: cols, or if None, those with date in their names.
+
+    Returns a dict mapping column name to counts of the values that could not be
+    parsed (and were replaced with NaT), for columns that had any.
+    '''
+    if cols is None:
+        cols = [c for c in df.columns if 'date' in c.split('_')]
+        cols = [c for c in cols if '_n_a' not in c and 'na' not in c.split('_')]
+    report = {}
     for c in cols:
         print("Converting column %s to datetime" % c)
-        bad_values = []
-        new_values = []
-        for value in df[c]:
-            if pd.isnull(value):
-                new_values.append(value)
-            else:
-                try:
-                    newval = pd.to_datetime(value)
-                except ValueError:
-                    newval = np.nan
-                    bad_values.append(value)
-                new_values.append(newval)
-        df[c] = new_values
-        df[c] = pd.to_datetime(df[c])
-        if bad_values:
-            print("Replaced %d bad values with NaT:" % len(bad_values))
-            print("Unique bad values:", set(bad_values))
+        before = df[c]
+        if pd.api.types.is_datetime64_any_dtype(before):
+            continue
+        df[c] = to_datetime_series(before)
+        rejected = rejected_values(before, df[c])
+        if len(rejected):
+            report[c] = rejected
+    return report
 
 
 def standardize_name(name):
@@ -130,6 +378,11 @@ def standardize_name(name):
     return name if name else None
 
 
+def standardize_name_series(series):
+    '''Vectorized version of standardize_name over a whole series.'''
+    return map_unique(series, standardize_name)
+
+
 def insert_col_after(df, to_insert, name, after):
     cols = list(df.columns)
     i = cols.index(after)
@@ -138,53 +391,526 @@ def insert_col_after(df, to_insert, name, after):
     return df[newcols]
 
 
-def read_dtw_excel(project_key, filename, select_sheet=None):
-    '''Reads a dataframe from a raw Excel file on data.world (circumventing DTW's preprocessing).'''
-    datasets = dw.load_dataset(project_key, force_update=True)
-    data_bytes = datasets.raw_data[filename]
-    new_file, tmpfilename = tempfile.mkstemp()
-    print('Writing excel file to temp file:', tmpfilename)
-    os.write(new_file, data_bytes)
-    os.close(new_file)
-    xl = pd.ExcelFile(tmpfilename)
+DTW_CACHE_DIR = os.environ.get('TJI_DTW_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.tji', 'dtw_cache'))
+DTW_CACHE_MAX_BYTES = int(os.environ.get('TJI_DTW_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# Set TJI_DTW_OFFLINE to 'TRUE' to only read from the cache, never from data.world.
+DTW_OFFLINE = os.environ.get('TJI_DTW_OFFLINE') == 'TRUE'
+# A project's version is checked with data.world at most this often per process.
+DTW_REVALIDATE_SECONDS = float(os.environ.get('TJI_DTW_REVALIDATE_SECONDS', 300))
+# How many projects prefetch_dtw downloads at once, and how often it retries a failed download.
+DTW_MAX_WORKERS = int(os.environ.get('TJI_DTW_MAX_WORKERS', 4))
+DTW_RETRIES = int(os.environ.get('TJI_DTW_RETRIES', 3))
+DTW_RETRY_BACKOFF_SECONDS = 2
+# What data.world calls raise when it can't be reached (requests' and socket errors are OSErrors)
+DTW_NETWORK_ERRORS = (OSError, Urllib3Error)
+
+
+class DtwClient(object):
+    '''The data.world calls DtwCache relies on. Pass a stand-in with the same methods to test without a network.'''
+
+    def project_version(self, project_key):
+        '''Returns a value that changes whenever any file in the project changes.'''
+        return dw.api_client().get_dataset(project_key)['updated']
+
+    def load_dataset(self, project_key, force_update):
+        return dw.load_dataset(project_key, force_update=force_update)
+
+
+class DtwCache(object):
+    '''On-disk cache of raw data.world files, so that reruns don't re-download unchanged projects.
+
+    File contents are stored once per distinct SHA-256 under cache_dir/blobs. An index maps
+    each (project, filename) to its content hash and the project version it was fetched at.
+    A lookup costs one metadata request to revalidate that version (none when offline), and
+    the project is only downloaded again if it changed. Once the blobs outgrow max_bytes,
+    the least recently used files are evicted.
+
+    A project's version is remembered for revalidate_seconds, so reading several of its files
+    (or reading them again after prefetch_dtw) costs a single metadata request. The cache can be
+    used from several threads at once; each project is downloaded by one thread at a time.
+    Processes sharing a cache_dir take turns updating the index through a lock file next to it.
+
+    If data.world can't be reached to revalidate a project, its cached files are used with a
+    warning. Any other error revalidating is raised.
+    '''
+
+    def __init__(self, cache_dir=DTW_CACHE_DIR, max_bytes=DTW_CACHE_MAX_BYTES, offline=DTW_OFFLINE, client=None,
+                 revalidate_seconds=DTW_REVALIDATE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.client = client or DtwClient()
+        self.revalidate_seconds = revalidate_seconds
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.lock_file = os.path.join(cache_dir, 'index.lock')
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # project_key -> (version, when data.world was asked for it)
+        self._versions = {}
+        # Held while reading and rewriting the index (along with the lock file, see _locked_index)
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+        self._project_locks = collections.defaultdict(threading.Lock)
+
+    def get(self, project_key, filename):
+        '''Returns the raw bytes of a file in a data.world project.'''
+        key = '%s/%s' % (project_key, filename)
+        with self._project_lock(project_key):
+            version = self._current_version(project_key)
+            entry = self._read_index()['files'].get(key)
+            if entry is None or (version is not None and entry['version'] != version):
+                if self.offline:
+                    raise CleaningError('Offline, and "%s" is not in the data.world cache' % key)
+                print('Downloading data.world project %s' % project_key)
+                dataset = self.client.load_dataset(project_key, force_update=True)
+                self._store_project(project_key, version, dataset.raw_data)
+        with self._locked_index():
+            index = self._read_index()
+            entry = index['files'].get(key)
+            if entry is None:
+                raise CleaningError('No file "%s" in data.world project %s' % (filename, project_key))
+            entry['last_used'] = time.time()
+            self._write_index(index)
+            with open(self._blob_path(entry['sha256']), 'rb') as f:
+                return f.read()
+
+    def load_dataset(self, project_key):
+        '''Like dw.load_dataset, but only forces an update if the project changed since our last download.'''
+        with self._project_lock(project_key):
+            version = self._current_version(project_key)
+            with self._locked_index():
+                stale = version is not None and self._read_index()['projects'].get(project_key) != version
+            dataset = self.client.load_dataset(project_key, force_update=stale)
+            if stale:
+                with self._locked_index():
+                    index = self._read_index()
+                    index['projects'][project_key] = version
+                    self._write_index(index)
+        return dataset
+
+    def forget_version(self, project_key):
+        '''Makes the next lookup in project_key revalidate, e.g. after writing to the project.'''
+        with self._lock:
+            self._versions.pop(project_key, None)
+
+    def _project_lock(self, project_key):
+        with self._lock:
+            return self._project_locks[project_key]
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        '''Holds the index for this thread, and for this process through an exclusive lock on lock_file.'''
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                self._lock_file = open(self.lock_file, 'a')
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    # Closing the file releases the lock
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def _current_version(self, project_key):
+        '''Returns the project's current version, or None if we shouldn't (offline) or can't (no network) ask.'''
+        if self.offline:
+            return None
+        with self._lock:
+            checked = self._versions.get(project_key)
+        if checked is not None and time.time() - checked[1] < self.revalidate_seconds:
+            return checked[0]
+        try:
+            version = self.client.project_version(project_key)
+        except DTW_NETWORK_ERRORS as e:
+            warnings.warn('Could not reach data.world to revalidate %s, so its cached files may be out of date '
+                          '(set TJI_DTW_OFFLINE to TRUE to skip revalidating): %s' % (project_key, e))
+            return None
+        with self._lock:
+            self._versions[project_key] = (version, time.time())
+        return version
+
+    def _store_project(self, project_key, version, raw_data):
+        with self._locked_index():
+            index = self._read_index()
+            for filename in raw_data:
+                data_bytes = raw_data[filename]
+                sha256 = hashlib.sha256(data_bytes).hexdigest()
+                path = self._blob_path(sha256)
+                if not os.path.exists(path):
+                    self._write_atomic(path, data_bytes)
+                index['files']['%s/%s' % (project_key, filename)] = {
+                    'version': version,
+                    'sha256': sha256,
+                    'size': len(data_bytes),
+                    'last_used': time.time(),
+                }
+            index['projects'][project_key] = version
+            self._evict(index, keep_project=project_key)
+            self._write_index(index)
+            return index
+
+    def _evict(self, index, keep_project):
+        '''Drops least recently used files (other than keep_project's) until the blobs fit in max_bytes.
+
+        Only call with the index locked, so that other processes don't read blobs as they're removed.
+        '''
+        by_age = sorted(index['files'].items(), key=lambda item: item[1]['last_used'])
+        for key, entry in by_age:
+            sizes = dict((e['sha256'], e['size']) for e in index['files'].values())
+            if sum(sizes.values()) <= self.max_bytes:
+                break
+            if not key.startswith(keep_project + '/'):
+                del index['files'][key]
+        # Remove blobs nothing points to anymore, including old versions of updated files
+        referenced = set(e['sha256'] for e in index['files'].values())
+        for sha256 in os.listdir(self.blob_dir):
+            if sha256 not in referenced:
+                os.remove(self._blob_path(sha256))
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_file):
+            return {'files': {}, 'projects': {}}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        self._write_atomic(self.index_file, json.dumps(index, indent=1).encode('utf-8'))
+
+    def _write_atomic(self, path, data_bytes):
+        # Write then rename, so concurrent readers never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data_bytes)
+        os.replace(tmp_path, path)
+
+
+_dtw_cache = None
+_dtw_cache_lock = threading.Lock()
+
+
+def get_dtw_cache():
+    '''Returns the shared DtwCache, configured from the TJI_DTW_* environment variables.'''
+    global _dtw_cache
+    with _dtw_cache_lock:
+        if _dtw_cache is None:
+            _dtw_cache = DtwCache()
+    return _dtw_cache
+
+
+@instrumented()
+def load_dtw_dataset(project_key):
+    '''Drop-in replacement for dw.load_dataset(project_key, force_update=True) that skips unchanged projects.'''
+    return get_dtw_cache().load_dataset(project_key)
+
+
+@instrumented()
+def read_dtw_excel(project_key, filename, select_sheet=None, usecols=None):
+    '''Reads a dataframe from a raw Excel file on data.world (circumventing DTW's preprocessing).
+
+    select_sheet may be a sheet name, or a list of sheet names to get back a dict of
+    name -> dataframe. Only the selected sheets are parsed, and of those, only the columns
+    named in usecols (if given) that the sheet has.
+    '''
+    xl = pd.ExcelFile(io.BytesIO(get_dtw_cache().get(project_key, filename)))
+
+    def parse(name):
+        if usecols is None:
+            return xl.parse(name)
+        # Older pandas only takes positions for Excel usecols
+        header = xl.parse(name, nrows=0).columns
+        return xl.parse(name, usecols=[i for i, c in enumerate(header) if c in usecols])
+
+    if isinstance(select_sheet, (list, tuple)):
+        return dict((name, parse(name)) for name in select_sheet)
     if select_sheet:
-        return xl.parse(select_sheet)
+        return parse(select_sheet)
     sheet_names = xl.sheet_names
     if len(sheet_names) == 1:
-        return xl.parse(sheet_names[0])
-    return dict((name, xl.parse(name)) for name in sheet_names)
+        return parse(sheet_names[0])
+    return dict((name, parse(name)) for name in sheet_names)
+
+
+@instrumented()
+def read_dtw_csv(project_key, filename, schema=None, usecols=None, **kwargs):
+    '''Reads a dataframe from a raw CSV file on data.world (circumventing DTW's preprocessing).
+
+    With a schema (see lib/schemas.py), its columns are read with the declared dtypes and dates
+    parsed, rather than inferred. usecols restricts them to the given columns.
+    '''
+    data = get_dtw_cache().get(project_key, filename)
+    if schema is not None:
+        header = pd.read_csv(io.BytesIO(data), nrows=0, **kwargs).columns
+        kwargs.update(schema.read_csv_kwargs(header, usecols))
+    elif usecols is not None:
+        kwargs['usecols'] = usecols
+    return pd.read_csv(io.BytesIO(data), **kwargs)
+
+
+DTW_RAW_EXTENSIONS = ('.xlsx', '.xls', '.csv')
+
+
+def read_dtw_file(project_key, name, **kwargs):
+    '''Reads a dataframe from data.world.
+
+    name is either a raw file (ending in .xlsx, .xls or .csv), read with read_dtw_excel or
+    read_dtw_csv and the given keyword arguments, or a table of the project, as found in
+    load_dtw_dataset(project_key).dataframes. Given keyword arguments (e.g. a schema), a
+    table is read from its CSV (name + '.csv') with read_dtw_csv instead.
+    '''
+    extension = os.path.splitext(name)[1].lower()
+    if extension in ('.xlsx', '.xls'):
+        return read_dtw_excel(project_key, name, **kwargs)
+    if extension == '.csv':
+        return read_dtw_csv(project_key, name, **kwargs)
+    if kwargs:
+        return read_dtw_csv(project_key, name + '.csv', **kwargs)
+    return load_dtw_dataset(project_key).dataframes[name]
+
+
+def retry_dtw(func, retries=DTW_RETRIES, backoff_seconds=DTW_RETRY_BACKOFF_SECONDS):
+    '''Calls func, retrying with exponential backoff if it fails. CleaningErrors (e.g. a missing file) aren't retried.'''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except CleaningError:
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff_seconds * 2 ** attempt
+            print('data.world request failed (%s), retrying in %ds' % (e, wait))
+            time.sleep(wait)
+
+
+def _fetch_dtw_file(project_key, name, kwargs, parse):
+    if parse:
+        return read_dtw_file(project_key, name, **kwargs)
+    if os.path.splitext(name)[1].lower() in DTW_RAW_EXTENSIONS:
+        get_dtw_cache().get(project_key, name)
+    else:
+        load_dtw_dataset(project_key)
+    return None
+
+
+def prefetch_dtw(files, parse=True, max_workers=DTW_MAX_WORKERS, retries=DTW_RETRIES):
+    '''Fetches the data.world files a run needs, several projects at once.
+
+    Each project is fetched on its own thread (at most max_workers at a time), its files one
+    after another, since the first one downloads the whole project into the cache. Failed
+    downloads are retried (see retry_dtw). Once all projects are done, the first error any of
+    them raised is raised.
+
+    Args:
+        files: (project_key, name) or (project_key, name, read_kwargs) tuples, as passed to read_dtw_file
+        parse: Whether to read each file into a dataframe, or only fill the cache (and revalidate
+            its projects) for reading them later
+        max_workers: How many projects are fetched at once
+        retries: How often to retry each file
+
+    Returns:
+        An OrderedDict of (project_key, name) -> dataframe (or None, without parse), grouped by project
+    '''
+    by_project = collections.OrderedDict()
+    for f in files:
+        project_key, name = f[:2]
+        by_project.setdefault(project_key, collections.OrderedDict())[name] = f[2] if len(f) > 2 else {}
+
+    def fetch(project_key, names):
+        return [retry_dtw(lambda: _fetch_dtw_file(project_key, name, kwargs, parse), retries)
+                for name, kwargs in names.items()]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(by_project)))) as executor:
+        futures = [(project_key, names, executor.submit(fetch, project_key, names))
+                   for project_key, names in by_project.items()]
+    frames = collections.OrderedDict()
+    for project_key, names, future in futures:
+        for name, frame in zip(names, future.result()):
+            frames[(project_key, name)] = frame
+    print('Fetched %d files from %d data.world projects in %.1fs' % (len(frames), len(by_project), time.time() - start))
+    return frames
+
+
+# Where cleaning stages leave typed copies of their output for the compression stage.
+INTERMEDIATE_DIR = os.environ.get(
+    'TJI_INTERMEDIATE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'intermediate'))
+# Older intermediates are ignored, so a dataset that wasn't cleaned recently is read from data.world instead.
+INTERMEDIATE_MAX_AGE_HOURS = float(os.environ.get('TJI_INTERMEDIATE_MAX_AGE_HOURS', 24))
+# String columns with at most this fraction of distinct values are stored as categoricals.
+CATEGORICAL_MAX_UNIQUE_FRACTION = 0.5
+
+
+def intermediate_path(name):
+    '''Returns the path of the Parquet intermediate for an output, e.g. 'shot_civilians.csv' or 'shot_civilians'.'''
+    return os.path.join(INTERMEDIATE_DIR, os.path.splitext(name)[0] + '.parquet')
+
+
+def _roundtrip_csv(series, dtype=None):
+    '''Returns what a column would look like after being written to and read back from a CSV (as dtype, if given).'''
+    buf = io.StringIO()
+    series.to_csv(buf, index=False, header=True)
+    buf.seek(0)
+    return pd.read_csv(buf, dtype=dtype, skip_blank_lines=False)[series.name]
+
+
+def to_intermediate_frame(df, schema=None):
+    '''Returns a copy of df with columns typed for Parquet, holding the same values as its CSV output.
+
+    Columns mixing strings with other types can't be stored as Parquet, so they are given
+    whatever type reading them back from the CSV output (with the schema) would give them.
+    In string columns, the strings a CSV reader takes for missing values (e.g. '' or 'NA')
+    become NaN. The categoricals the schema declares (see lib/schemas.py) become
+    (dictionary-encoded) categoricals, or without a schema, string columns with few distinct values.
+    '''
+    out = df.copy()
+    categories = set(schema.categories(out.columns)) if schema is not None else None
+    for c in out.columns:
+        if out[c].dtype != object:
+            continue
+        declared = categories is not None and c in categories
+        types = set(type(v) for v in out[c].dropna().values)
+        if len(types) > 1:
+            out[c] = _roundtrip_csv(out[c], 'category' if declared else None).values
+            continue
+        if types == {str}:
+            out[c] = out[c].where(~out[c].isin(CSV_NA_VALUES))
+        if declared:
+            out[c] = out[c].astype('category')
+        elif (categories is None and types == {str} and
+              out[c].nunique() <= CATEGORICAL_MAX_UNIQUE_FRACTION * len(out)):
+            out[c] = out[c].astype('category')
+    return out
+
+
+@instrumented()
+def write_intermediate(df, name, schema=None):
+    '''Writes a cleaned dataframe as a Parquet intermediate, keeping its dtypes for later stages.
+
+    The schema, if given, declares which columns are categoricals (see to_intermediate_frame).
+    Returns the path written, or None if pyarrow isn't installed.
+    '''
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print('pyarrow is not installed, not writing a Parquet intermediate for %s' % name)
+        return None
+    os.makedirs(INTERMEDIATE_DIR, exist_ok=True)
+    path = intermediate_path(name)
+    print('Writing intermediate file to', path)
+    to_intermediate_frame(df, schema).to_parquet(path, index=False)
+    return path
 
 
+def _age_hours(path):
+    return (time.time() - os.path.getmtime(path)) / 3600
 
-def read_dtw_csv(project_key, filename, **kwargs):
-    '''Reads a dataframe from a raw CSV file on data.world (circumventing DTW's preprocessing).'''
-    datasets = dw.load_dataset(project_key, force_update=True)
-    data_bytes = datasets.raw_data[filename]
-    new_file, tmpfilename = tempfile.mkstemp()
-    print('Writing CSV to temp file:', tmpfilename)
-    os.write(new_file, data_bytes)
-    os.close(new_file)
-    return pd.read_csv(tmpfilename, **kwargs)
 
+def has_intermediate(name):
+    '''Returns whether there is an intermediate for an output, recent enough for read_intermediate to read.'''
+    path = intermediate_path(name)
+    return os.path.exists(path) and _age_hours(path) <= INTERMEDIATE_MAX_AGE_HOURS
 
-def reorder_columns_and_check(df, new_order):
-    '''Return dataframe with reordered columns, making sure we didn't leave any columns out.'''
+
+@instrumented()
+def read_intermediate(name, columns=None):
+    '''Reads (only the given columns of) the Parquet intermediate for an output.
+
+    Returns None if there is no usable intermediate: it is missing, older than
+    INTERMEDIATE_MAX_AGE_HOURS, or pyarrow isn't installed.
+    '''
+    path = intermediate_path(name)
+    if not os.path.exists(path):
+        return None
+    age_hours = _age_hours(path)
+    if age_hours > INTERMEDIATE_MAX_AGE_HOURS:
+        print('Ignoring intermediate file %s, it is %.0f hours old' % (path, age_hours))
+        return None
+    try:
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+    except ImportError:
+        return None
+
+
+def _check_new_order(columns, new_order):
     if len(new_order) != len(set(new_order)):
         raise CleaningError("Duplicate columns in new_order! Plz fix.")
-    if len(df.columns) != len(set(df.columns)):
+    if len(columns) != len(set(columns)):
         raise CleaningError("Duplicate columns in original dataframe! Plz fix.")
 
     # Make sure we are only reordering columns, not dropping any
-    if set(new_order) != set(df.columns):
+    if set(new_order) != set(columns):
         # At least one column exists in the old but not the new order, or vice versa.
-        old_cols = list(df.columns)
         messages = []
-        for c in old_cols:
+        for c in columns:
             if c not in new_order:
                 messages.append("Column '%s' from the original dataframe is missing in new_order" % c)
         for c in new_order:
-            if c not in old_cols:
+            if c not in columns:
                 messages.append("Column '%s' in new_order does not exist in the original dataframe" % c)
         raise CleaningError('\n'.join(messages))
 
+
+def reorder_columns_and_check(df, new_order):
+    '''Return dataframe with reordered columns, making sure we didn't leave any columns out.'''
+    _check_new_order(list(df.columns), new_order)
     return df[new_order]
+
+
+class ColumnPlan(object):
+    '''Batches column insertions, drops and a final reordering of a dataframe into a single reindex.
+
+    insert_col_after and reorder_columns_and_check copy the whole dataframe on every call; a plan
+    only copies it once, when applied. E.g.
+
+        plan = ColumnPlan(df)
+        plan.insert_after(full_names, 'name_full', 'name_last')
+        plan.reorder(new_order)
+        df = plan.apply()
+
+    reorder raises the same CleaningErrors as reorder_columns_and_check, counting the columns
+    inserted and dropped so far. The dataframe passed in is left as it is.
+    '''
+
+    def __init__(self, df):
+        self.df = df
+        self.columns = list(df.columns)
+        self.inserted = []
+
+    def insert_after(self, to_insert, name, after):
+        '''Adds a column called name, with the values to_insert, after the column after (which may itself be planned).
+
+        Like insert_col_after, an existing column called name is overwritten, but it is also moved after after
+        rather than repeated there.
+        '''
+        if name == after:
+            raise CleaningError("Can't insert column '%s' after itself" % name)
+        self.columns = [c for c in self.columns if c != name]
+        self.columns.insert(self.columns.index(after) + 1, name)
+        self.inserted.append((name, to_insert))
+        return self
+
+    def drop(self, names):
+        '''Leaves out the given columns.'''
+        missing = [c for c in names if c not in self.columns]
+        if missing:
+            raise CleaningError("Can't drop columns that don't exist: %s" % missing)
+        self.columns = [c for c in self.columns if c not in names]
+        return self
+
+    def reorder(self, new_order):
+        '''Orders the columns as new_order, which must name each of them exactly once.'''
+        _check_new_order(self.columns, new_order)
+        self.columns = list(new_order)
+        return self
+
+    def apply(self):
+        '''Returns a new dataframe with the planned columns, in the planned order.'''
+        df = self.df.assign(**dict(self.inserted)) if self.inserted else self.df
+        return df.reindex(columns=self.columns)
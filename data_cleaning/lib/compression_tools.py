@@ -0,0 +1,306 @@
+'''Encoders and writers for the compressed datasets the website's explore-the-data page uses.
+
+See create_datasets_for_website.ipynb for a description of the formats.
+'''
+
+import contextlib
+import gzip
+import io
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+from lib.storage import get_storage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+AGE_COLS = ('age_at_time_of_death', 'civilian_age', 'officer_age')
+AGE_GROUP_BINS = [-np.inf, 18, 30, 40, 50, 60, np.inf]
+AGE_GROUP_LABELS = ['under 18', '18 to 29', '30 to 39', '40 to 49', '50 to 59', '60 and up']
+NOT_GIVEN = 'not given'
+
+
+def encode_column(series):
+    '''Returns (lookup, codes) for a column: its sorted distinct values, and each cell's index into them.
+
+    Missing values get the code -1.
+    '''
+    codes, uniques = pd.factorize(series, sort=True)
+    return list(uniques.tolist()), codes
+
+
+def encode_original(df, id_col=None):
+    '''Like compress_original, but leaves the id and code columns as numpy arrays.'''
+    js = {
+        'meta': {
+            'num_columns': len(df.columns),
+            'num_records': len(df),
+            'lookups': {},
+        },
+        'records': {},
+    }
+    if id_col:
+        js['meta']['record_ids'] = {
+            'field_name': id_col,
+            'values': df[id_col].values
+        }
+        df = df.drop(id_col, axis=1)
+    for col in df.columns:
+        lookup, codes = encode_column(df[col])
+        js['meta']['lookups'][col] = lookup
+        js['records'][col] = codes
+
+    return js
+
+
+def compress_original(df, id_col=None):
+    return _arrays_to_lists(encode_original(df, id_col=id_col))
+
+
+def age_groups(ages):
+    '''Buckets a column of ages into the age groups the website shows.'''
+    groups = pd.cut(ages, AGE_GROUP_BINS, right=False, labels=AGE_GROUP_LABELS).astype(object)
+    # Missing (and infinite) ages have always fallen through to the last group.
+    return groups.where(groups.notnull(), AGE_GROUP_LABELS[-1])
+
+
+def encode_new(df, id_col=None):
+    '''Like compress_new, but leaves the columns as numpy arrays.'''
+    js = {'records': {}}
+    if id_col:
+        df = df.drop(id_col, axis=1)
+    for col in df.columns:
+        js['records'][col] = df[col].astype(object).where(df[col].notnull(), NOT_GIVEN).values
+        if col in AGE_COLS:
+            js['records']['age_group'] = age_groups(df[col]).values
+
+    return js
+
+
+def compress_new(df, id_col=None):
+    return _arrays_to_lists(encode_new(df, id_col=id_col))
+
+
+def encode_cube(df, columns):
+    '''Counts df's records by each combination of values of columns that occurs, in one pass.
+
+    Values are those encode_new gives: missing values are NOT_GIVEN, and ages are bucketed
+    into age groups (under the column name 'age_group'). Only combinations with records are
+    kept, as one cell each. Returns {'meta': {...}, 'cells': {...}}, where meta has the
+    'dimensions' (column names), their 'lookups', 'num_records' and 'num_cells', and cells
+    has each dimension's lookup codes plus the 'count' of records, one array element per cell.
+    '''
+    dimensions = []
+    lookups = {}
+    codes = []
+    for col in columns:
+        if col in AGE_COLS:
+            name, values = 'age_group', age_groups(df[col])
+        else:
+            name, values = col, df[col].astype(object).where(df[col].notnull(), NOT_GIVEN)
+        lookup, col_codes = encode_column(values)
+        dimensions.append(name)
+        lookups[name] = lookup
+        codes.append(col_codes)
+
+    # Number every possible combination, and count those that occur
+    shape = [max(len(lookups[name]), 1) for name in dimensions]
+    if np.prod(shape, dtype=float) >= np.iinfo(np.int64).max:
+        raise ValueError('Too many combinations of %s to count' % ', '.join(dimensions))
+    cells, counts = np.unique(np.ravel_multi_index(codes, shape), return_counts=True)
+    cell_codes = np.unravel_index(cells, shape)
+
+    js = {
+        'meta': {
+            'dimensions': dimensions,
+            'lookups': lookups,
+            'num_records': len(df),
+            'num_cells': len(cells),
+        },
+        'cells': dict(zip(dimensions, cell_codes)),
+    }
+    js['cells']['count'] = counts
+    return js
+
+
+def _arrays_to_lists(obj):
+    if isinstance(obj, dict):
+        return dict((k, _arrays_to_lists(v)) for k, v in obj.items())
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj
+
+
+# How many array elements to encode at a time when streaming JSON
+JSON_CHUNK_SIZE = 100000
+
+
+def write_compact_json(obj, f):
+    '''Writes obj as compact JSON to the text stream f, a piece at a time.
+
+    obj may contain numpy arrays (as encode_original and encode_new return), which are
+    encoded JSON_CHUNK_SIZE elements at a time, so the document is never held in memory
+    as a single string.
+    '''
+    if isinstance(obj, dict):
+        f.write('{')
+        for i, (key, value) in enumerate(obj.items()):
+            if i:
+                f.write(',')
+            f.write(json.dumps(key))
+            f.write(':')
+            write_compact_json(value, f)
+        f.write('}')
+    elif isinstance(obj, np.ndarray):
+        f.write('[')
+        for start in range(0, len(obj), JSON_CHUNK_SIZE):
+            if start:
+                f.write(',')
+            chunk = json.dumps(obj[start:(start + JSON_CHUNK_SIZE)].tolist(), separators=(',', ':'))
+            f.write(chunk[1:-1])
+        f.write(']')
+    else:
+        f.write(json.dumps(obj, separators=(',', ':')))
+
+
+class _BrotliWriter(io.RawIOBase):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = brotli.Compressor()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.fileobj.write(self.compressor.process(bytes(b)))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.write(self.compressor.finish())
+        super(_BrotliWriter, self).close()
+
+
+@contextlib.contextmanager
+def open_encoded(fileobj, encoding=None):
+    '''Yields a text stream writing UTF-8 to the binary fileobj, compressed if encoding is 'gzip' or 'br'.
+
+    fileobj is left open.
+    '''
+    if encoding == 'gzip':
+        # mtime=0 so the same content always gives the same bytes
+        raw = gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+    elif encoding == 'br':
+        if brotli is None:
+            raise ValueError('brotli encoding requires the brotli package')
+        raw = io.BufferedWriter(_BrotliWriter(fileobj))
+    elif encoding is None:
+        raw = fileobj
+    else:
+        raise ValueError('Unknown encoding: %s' % encoding)
+    text = io.TextIOWrapper(raw, encoding='utf-8')
+    try:
+        yield text
+    finally:
+        text.flush()
+        text.detach()
+        if raw is not fileobj:
+            raw.close()
+
+
+def write_json_file(obj, filename, encoding=None):
+    '''Streams obj as compact JSON to a file, optionally compressed.'''
+    with open(filename, 'wb') as f, open_encoded(f, encoding) as out:
+        write_compact_json(obj, out)
+
+
+SIDECAR_MAGIC = b'TJIC'
+SIDECAR_VERSION = 1
+
+
+def code_dtype(lookup):
+    '''Returns the smallest signed integer type that holds codes into lookup (plus -1 for missing).'''
+    for dtype in (np.int8, np.int16, np.int32):
+        if len(lookup) <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def write_codes_sidecar(encoded, f):
+    '''Writes the output of encode_original to the binary stream f as typed code arrays.
+
+    Layout, all little-endian:
+      * b'TJIC', then the format version and the header length, as uint32s
+      * The header: UTF-8 JSON holding the 'meta' object of the compressed JSON, plus
+        'columns', a list of {name, dtype, offset, length} for each code array
+      * The code arrays, each starting at its offset (counted from the start of the
+        file, and a multiple of 8), holding length values of type dtype ('int8',
+        'int16', ...), with -1 for missing values
+    '''
+    meta = _arrays_to_lists(encoded['meta'])
+    columns = []
+    arrays = []
+    for name, codes in encoded['records'].items():
+        dtype = code_dtype(meta['lookups'][name])
+        arrays.append(codes.astype(dtype.newbyteorder('<')))
+        columns.append({'name': name, 'dtype': dtype.name, 'length': len(codes)})
+    header = dict(meta, columns=columns)
+    # Offsets depend on the header length and vice versa; fixing the width of every
+    # offset in the JSON breaks the cycle.
+    for column in columns:
+        column['offset'] = 0
+    header_len = len(json.dumps(header).encode('utf-8')) + len(columns) * 20
+    offset = _align8(12 + header_len)
+    for column, array in zip(columns, arrays):
+        column['offset'] = offset
+        offset = _align8(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8').ljust(header_len)
+    f.write(SIDECAR_MAGIC + struct.pack('<II', SIDECAR_VERSION, header_len) + header_bytes)
+    position = 12 + header_len
+    for column, array in zip(columns, arrays):
+        f.write(b'\0' * (column['offset'] - position))
+        f.write(array.tobytes())
+        position = column['offset'] + array.nbytes
+
+
+def _align8(n):
+    return (n + 7) // 8 * 8
+
+
+def write_sidecar_file(encoded, filename):
+    with open(filename, 'wb') as f:
+        write_codes_sidecar(encoded, f)
+
+
+def upload_json_to_s3(obj, bucket, key, encoding=None, content_encoding=True, background=False):
+    '''Streams obj as compact JSON to S3, optionally compressed.
+
+    With content_encoding, a compressed object is served with a matching Content-Encoding
+    header, so browsers decompress it transparently. Without it, the object is stored as
+    a compressed file (e.g. for a key ending in .gz). With background, the upload runs on
+    the shared storage's thread pool; call get_storage().wait() to wait for it.
+    Unchanged objects aren't uploaded again (see lib/storage.py).
+    '''
+    def write(f):
+        with open_encoded(f, encoding) as out:
+            write_compact_json(obj, out)
+
+    extra_args = {'ContentType': 'application/json'}
+    if encoding and content_encoding:
+        extra_args['ContentEncoding'] = encoding
+    elif encoding:
+        extra_args['ContentType'] = 'application/gzip' if encoding == 'gzip' else 'application/octet-stream'
+    return get_storage().upload(bucket, key, write, extra_args=extra_args, background=background)
+
+
+def upload_sidecar_to_s3(encoded, bucket, key, background=False):
+    '''Uploads the binary sidecar for the output of encode_original to S3, gzipped in transit.'''
+    return get_storage().upload(bucket, key, lambda f: write_codes_sidecar(encoded, f),
+                                extra_args={'ContentType': 'application/octet-stream'}, gzip_encode=True,
+                                background=background)
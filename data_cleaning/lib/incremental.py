@@ -0,0 +1,153 @@
+'''Incremental cleaning: fingerprint raw rows, so that a rerun only cleans the new and changed ones.
+
+A pipeline using this:
+  1. Calls plan_incremental on the raw rows, and cleans only plan.to_clean.
+  2. Before any step that looks across rows (e.g. counting rows per incident), calls
+     merge_incremental, which adds back the rows cleaned by the last run that haven't
+     changed, and saves the state for the next run.
+
+Civilians shot and officers shot (CLEAN_OIS_INCREMENTAL) are keyed by OIS report number,
+and custodial death reports (CLEAN_CDR_INCREMENTAL) by record id.
+
+Rows are identified by a key column plus their position among rows sharing that key, so
+duplicate keys are fine. Everything is recleaned if the cleaning code, the auxiliary data
+or the raw columns change (see plan_incremental's context).
+'''
+
+import collections
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from lib.cleaning_tools import INTERMEDIATE_DIR, CleaningError
+
+
+INCREMENTAL_DIR = os.path.join(INTERMEDIATE_DIR, 'incremental')
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+IncrementalPlan = collections.namedtuple(
+    'IncrementalPlan', ['name', 'keys', 'fingerprints', 'context', 'to_clean', 'reused', 'deleted', 'raw_index'])
+
+
+def row_keys(df, key_col):
+    '''Returns a unique key for each row: its key_col value and its position among rows with that value.'''
+    values = df[key_col].astype(str)
+    return values + '#' + values.groupby(values).cumcount().astype(str)
+
+
+def row_fingerprints(df):
+    '''Returns a 64-bit hash of each row's values.'''
+    return pd.util.hash_pandas_object(df, index=False)
+
+
+def context_fingerprint(files=(), frames=()):
+    '''Returns a hash of everything besides the raw rows that the cleaned rows depend on.
+
+    Args:
+        files: Paths of the notebook and library files doing the cleaning
+        frames: Auxiliary dataframes used in cleaning (e.g. agencies and counties)
+    '''
+    h = hashlib.sha256()
+    for path in files:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    for frame in frames:
+        h.update(repr(list(frame.columns)).encode('utf-8'))
+        h.update(row_fingerprints(frame).values.tobytes())
+    return h.hexdigest()
+
+
+def library_context(frames=()):
+    '''Returns the context_fingerprint of every module in lib/ and the given auxiliary frames.
+
+    That's all of lib/, rather than a list of the modules cleaning uses, which would fall out of
+    date as soon as one of them imports another (e.g. the column types in schemas.py).
+    '''
+    return context_fingerprint(files=sorted(glob.glob(os.path.join(LIB_DIR, '*.py'))), frames=frames)
+
+
+def _state_paths(name):
+    base = os.path.join(INCREMENTAL_DIR, os.path.splitext(name)[0])
+    return base + '.manifest.json', base + '.rows.pkl'
+
+
+def _load_state(name):
+    manifest_path, rows_path = _state_paths(name)
+    if not (os.path.exists(manifest_path) and os.path.exists(rows_path)):
+        return None, None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return manifest, pd.read_pickle(rows_path)
+
+
+def plan_incremental(raw, key_col, name, context='', enabled=True):
+    '''Works out which raw rows need cleaning, given the state saved by the last run.
+
+    Returns an IncrementalPlan. plan.to_clean holds the raw rows to clean, indexed by row
+    key; when not enabled, or nothing can be reused, that is all of them.
+
+    Args:
+        raw: The raw rows
+        key_col: The column identifying rows, e.g. 'ois report no.'
+        name: The output this cleans to, e.g. 'shot_civilians.csv'
+        context: See context_fingerprint
+        enabled: Whether to reuse rows from the last run at all
+    '''
+    keys = row_keys(raw, key_col)
+    fingerprints = pd.Series(['%016x' % v for v in row_fingerprints(raw).values], index=keys.values)
+    context = context + '|' + repr(list(raw.columns))
+    to_clean = raw.set_index(keys.values)
+    reused = to_clean.iloc[:0]
+    deleted = []
+
+    manifest, rows = _load_state(name) if enabled else (None, None)
+    if manifest is None:
+        if enabled:
+            print('Incremental cleaning: no saved state for %s, cleaning all %d rows' % (name, len(raw)))
+    elif manifest['context'] != context:
+        print('Incremental cleaning: the cleaning code, auxiliary data or raw columns changed, '
+              'cleaning all %d rows' % len(raw))
+    else:
+        previous = pd.Series(manifest['fingerprints'])
+        unchanged = fingerprints.index[previous.reindex(fingerprints.index) == fingerprints]
+        deleted = sorted(set(previous.index) - set(fingerprints.index))
+        num_new = (~fingerprints.index.isin(previous.index)).sum()
+        print('Incremental cleaning: %d new, %d changed, %d deleted and %d unchanged rows' % (
+            num_new, len(fingerprints) - num_new - len(unchanged), len(deleted), len(unchanged)))
+        # Always clean at least one row, so that no cleaning step has to cope with an empty frame
+        unchanged = unchanged[1:] if len(unchanged) == len(fingerprints) else unchanged
+        # Rows dropped during the last cleaning (e.g. empty ones) are not in rows
+        reused = rows[rows.index.isin(unchanged)]
+        to_clean = to_clean[~to_clean.index.isin(unchanged)]
+
+    return IncrementalPlan(name, keys.values, fingerprints, context, to_clean, reused, deleted, raw.index.values)
+
+
+def merge_incremental(cleaned, plan):
+    '''Adds back the reused rows to the newly cleaned ones, in raw order, and saves the state for the next run.
+
+    cleaned must still be indexed by row key, as plan.to_clean was.
+    '''
+    parts = [df for df in (plan.reused, cleaned) if len(df)]
+    if len(parts) > 1 and set(plan.reused.columns) != set(cleaned.columns):
+        raise CleaningError('Reused rows have different columns than newly cleaned ones')
+    merged = pd.concat(parts)[list(cleaned.columns)] if parts else cleaned
+    merged = merged.reindex([k for k in plan.keys if k in merged.index])
+
+    os.makedirs(INCREMENTAL_DIR, exist_ok=True)
+    manifest_path, rows_path = _state_paths(plan.name)
+    merged.to_pickle(rows_path)
+    with open(manifest_path, 'w') as f:
+        json.dump({'context': plan.context, 'fingerprints': plan.fingerprints.to_dict()}, f)
+    return merged
+
+
+def with_raw_index(merged, plan):
+    '''Returns the merged rows indexed as they were in the raw rows passed to plan_incremental, instead of by row key.'''
+    merged = merged.copy()
+    merged.index = pd.Index(plan.raw_index)[pd.Index(plan.keys).get_indexer(merged.index)]
+    return merged
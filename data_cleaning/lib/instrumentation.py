@@ -0,0 +1,172 @@
+'''Stage timing and memory instrumentation for the pipeline.
+
+Wrap a block in `with stage('name'):`, or a function in `@instrumented()`, to record its
+wall time, CPU time (of the thread running it), how the process's RSS rose during it and (optionally) a row count. Records are kept
+in RECORDS, and appended as JSON lines to TJI_METRICS_FILE when it is set, so that the
+notebooks' kernels and the automation all write to the same file.
+
+Each record is tagged with the notebook it ran in: that of the enclosing stage on the same
+thread, or else TJI_METRICS_NOTEBOOK, which the automation sets in each notebook's kernel.
+'''
+
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Every stage recorded by this process
+RECORDS = []
+_write_lock = threading.Lock()
+# The stages open on each thread, innermost last
+_open_stages = threading.local()
+
+# Stages run on several threads at once (e.g. the automation's in-process pipelines), so their CPU
+# time is their own thread's. Python < 3.7 only has the whole process's, which is only recorded
+# while no other thread is running.
+_thread_time = getattr(time, 'thread_time', None)
+
+
+def _cpu_time():
+    if _thread_time is not None:
+        return _thread_time()
+    return time.process_time() if threading.active_count() == 1 else None
+
+
+def peak_rss_mb():
+    '''Returns the most memory this process has used so far, in MB, or None if unknown.'''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def current_rss_mb():
+    '''Returns the memory this process uses right now, in MB, or None if unknown (only known on Linux).'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 ** 2
+
+
+def _stage_peak_mb(rss_start, rss_end, peak_start, peak_end):
+    '''The most memory the process used during a stage, as far as we can tell.
+
+    If the process reached a new peak during the stage, that is it. Otherwise the stage's own peak
+    was lower, and the most we know is that it was at least the RSS at its start or end.
+    '''
+    known = [mb for mb in (rss_start, rss_end) if mb is not None]
+    if peak_start is not None and peak_end is not None and peak_end > peak_start:
+        known.append(peak_end)
+    return max(known) if known else None
+
+
+def _round(mb):
+    return None if mb is None else round(mb, 1)
+
+
+@contextmanager
+def stage(name, rows=None, **fields):
+    '''Records how long the block takes, and the process's RSS during it.
+
+    The record has the RSS at the block's end (rss_mb), how much it grew over the block
+    (rss_delta_mb), and the most used during the block (peak_rss_mb, see _stage_peak_mb).
+    The process's lifetime peak alone would show the same number for every later stage.
+
+    Yields the record (a dict), so the block can set its row count once it's known:
+
+        with stage('merge shootings') as record:
+            merged = ...
+            record['rows'] = len(merged)
+
+    Extra keyword arguments are stored in the record as they are. A block that raises is
+    recorded too, with 'failed' set.
+    '''
+    record = dict(fields, stage=name, rows=rows, pid=os.getpid(),
+                  start=datetime.datetime.now().isoformat(timespec='seconds'))
+    if not hasattr(_open_stages, 'records'):
+        _open_stages.records = []
+    enclosing = _open_stages.records[-1] if _open_stages.records else {}
+    notebook = record.get('notebook') or enclosing.get('notebook') or os.environ.get('TJI_METRICS_NOTEBOOK')
+    if notebook:
+        record['notebook'] = notebook
+    _open_stages.records.append(record)
+    wall_start = time.time()
+    cpu_start = _cpu_time()
+    rss_start = current_rss_mb()
+    peak_start = peak_rss_mb()
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        _open_stages.records.pop()
+        record['wall_s'] = round(time.time() - wall_start, 3)
+        cpu_end = _cpu_time()
+        record['cpu_s'] = round(cpu_end - cpu_start, 3) if None not in (cpu_start, cpu_end) else None
+        rss_end = current_rss_mb()
+        record['rss_mb'] = _round(rss_end)
+        record['rss_delta_mb'] = _round(rss_end - rss_start) if None not in (rss_start, rss_end) else None
+        record['peak_rss_mb'] = _round(_stage_peak_mb(rss_start, rss_end, peak_start, peak_rss_mb()))
+        _emit(record)
+
+
+def _row_count(args, result):
+    for value in (result,) + tuple(args):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return len(value)
+    return None
+
+
+def instrumented(name=None):
+    '''Decorator recording each call of a function as a stage (named after the function by default).
+
+    The row count is the length of the result if it's a dataframe or series, and otherwise of
+    the first such argument.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__) as record:
+                result = func(*args, **kwargs)
+                record['rows'] = _row_count(args, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _emit(record):
+    RECORDS.append(record)
+    path = os.environ.get('TJI_METRICS_FILE')
+    if not path:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock, open(path, 'a') as f:
+        f.write(line)
+
+
+def read_metrics(path):
+    '''Returns the records in a metrics file, or [] if there is none.'''
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def slowest_stages(records, n=10):
+    '''Returns the n records with the longest wall time, slowest first.'''
+    return sorted(records, key=lambda r: r.get('wall_s') or 0, reverse=True)[:n]
@@ -0,0 +1,241 @@
+'''Links OIS civilians shot to the custodial death reports of the same deaths.
+
+The civilians shot data flags shootings that led to a custodial death report
+(custodial_death_report), but not which report. link_ois_to_cdr finds candidates for it
+without comparing every shooting with every report. Pairs are only considered within two
+kinds of blocks:
+
+  * name: the same standardized last name and first initial
+  * county: the same county, with the death at most LINK_MAX_DAYS after the shooting
+
+and only kept if the death falls within the same window of the shooting. Each remaining pair
+is then scored at once, column by column, on how well its names, dates, county, sex, race and
+age agree.
+'''
+
+import collections
+
+import numpy as np
+import pandas as pd
+
+from lib.agency_resolver import bounded_edit_distance
+from lib.cleaning_tools import standardize_name_series
+from lib.instrumentation import instrumented
+from lib.pipelines import DW_PROJECT_CDR, DW_PROJECT_OIS, read_output, write_outputs
+from lib.schemas import CDR, OIS_CIVILIANS_SHOT
+
+
+CDR_FILENAME = 'cleaned_custodial_death_reports.csv'
+OIS_FILENAME = 'shot_civilians.csv'
+OUTPUT_FILENAME = 'ois_cdr_links.csv'
+
+DW_INPUTS = [
+    (DW_PROJECT_CDR, CDR_FILENAME),
+    (DW_PROJECT_OIS, OIS_FILENAME),
+]
+
+# Deaths are looked for from the day before a shooting (for dates entered a day off) to this many days after
+LINK_MAX_DAYS = 30
+# Names this many edits apart still count as partly agreeing
+LINK_MAX_NAME_EDITS = 2
+# Ages this many years apart count as disagreeing
+LINK_MAX_AGE_DIFFERENCE = 5
+# Pairs scoring less than this are left out of the links. Pairs only agreeing on county, date, sex and
+# race, but not on names, score less.
+LINK_MIN_SCORE = 0.7
+
+# How much each column's agreement counts towards a pair's score
+LINK_WEIGHTS = collections.OrderedDict([
+    ('last_name', 3),
+    ('first_name', 2),
+    ('date', 2),
+    ('county', 1),
+    ('sex', 1),
+    ('race', 1),
+    ('age', 1),
+])
+
+OIS_COLUMNS = ['ois_report_no', 'date_incident', 'incident_county', 'civilian_name_first', 'civilian_name_last',
+               'civilian_name_full', 'civilian_gender', 'civilian_race', 'civilian_age', 'civilian_died',
+               'custodial_death_report']
+CDR_COLUMNS = ['record_id', 'date_time_of_custody_or_incident', 'death_date', 'death_location_county', 'agency_county',
+               'name_first', 'name_last', 'name_full', 'sex', 'race', 'age_at_time_of_death']
+
+
+def _standardize_names(series):
+    return standardize_name_series(series.astype(object).str.upper())
+
+
+def _upper(series):
+    return series.astype(object).str.strip().str.upper()
+
+
+def linkage_frame(df, first, last, date, counties):
+    '''Returns the columns the blocking and scoring use, with a positional index.
+
+    Args:
+        df: The OIS or CDR dataframe
+        first, last: The columns with first and last names
+        date: The column with the date the window is measured from (or to)
+        counties: The columns with counties, in order of preference
+    '''
+    out = pd.DataFrame({
+        'first': _standardize_names(df[first]).values,
+        'last': _standardize_names(df[last]).values,
+        'date': pd.to_datetime(df[date]).dt.normalize().values,
+    })
+    county = _upper(df[counties[0]])
+    for c in counties[1:]:
+        county = county.fillna(_upper(df[c]))
+    out['county'] = county.values
+    out['initial'] = out['first'].str[:1]
+    # Day buckets as wide as the window, so a death within it is in the shooting's bucket or a neighboring one
+    out['bucket'] = (out['date'].values.astype('datetime64[D]').astype('int64') // LINK_MAX_DAYS)
+    out.loc[out['date'].isnull(), 'bucket'] = np.nan
+    return out
+
+
+def _block_pairs(ois, cdr, keys, offsets=(0,)):
+    pairs = []
+    left = ois[keys].dropna().reset_index().rename(columns={'index': 'ois_row'})
+    right = cdr[keys].dropna().reset_index().rename(columns={'index': 'cdr_row'})
+    for offset in offsets:
+        shifted = left.copy()
+        if offset:
+            shifted['bucket'] = shifted['bucket'] + offset
+        pairs.append(shifted.merge(right, on=keys)[['ois_row', 'cdr_row']])
+    return pd.concat(pairs, ignore_index=True)
+
+
+@instrumented()
+def candidate_pairs(ois, cdr):
+    '''Returns the (ois_row, cdr_row) pairs in the same block, with the block that found each.
+
+    Args:
+        ois, cdr: Frames from linkage_frame
+    '''
+    blocks = [
+        ('name', _block_pairs(ois, cdr, ['last', 'initial'])),
+        ('county', _block_pairs(ois, cdr, ['county', 'bucket'], offsets=(-1, 0, 1))),
+    ]
+    pairs = pd.concat([p.assign(block=name) for name, p in blocks], ignore_index=True)
+    # Pairs found by both kinds of block are kept once, as found by name
+    pairs = pairs.drop_duplicates(['ois_row', 'cdr_row'])
+    deaths = cdr['date'].values[pairs['cdr_row'].values]
+    days = (deaths - ois['date'].values[pairs['ois_row'].values]) / np.timedelta64(1, 'D')
+    in_window = (days >= -1) & (days <= LINK_MAX_DAYS)
+    print('Found %d candidate pairs in blocks, %d of them with the death within %d days of the shooting' % (
+        len(pairs), in_window.sum(), LINK_MAX_DAYS))
+    return pairs[in_window].reset_index(drop=True)
+
+
+def name_similarity(a, b):
+    '''Returns 1 for equal names, down to 0 at LINK_MAX_NAME_EDITS + 1 edits apart, and NaN where either is missing.
+
+    Edit distances are only computed once per distinct pair of names that aren't equal.
+    '''
+    a = pd.Series(a, dtype=object)
+    b = pd.Series(b, dtype=object)
+    present = a.notnull() & b.notnull()
+    sim = pd.Series(np.where(present, 0.0, np.nan))
+    sim[present & (a == b)] = 1.0
+    differ = present & (a != b)
+    pairs = pd.DataFrame({'a': a[differ], 'b': b[differ]})
+    distinct = pairs.drop_duplicates()
+    scores = {}
+    for x, y in zip(distinct['a'], distinct['b']):
+        distance = bounded_edit_distance(x, y, LINK_MAX_NAME_EDITS)
+        scores[(x, y)] = 0.0 if distance is None else 1 - distance / float(LINK_MAX_NAME_EDITS + 1)
+    sim[differ] = [scores[(x, y)] for x, y in zip(pairs['a'], pairs['b'])]
+    return sim.values
+
+
+def _equal(a, b):
+    a = pd.Series(a, dtype=object)
+    b = pd.Series(b, dtype=object)
+    return np.where(a.notnull() & b.notnull(), (a == b).astype(float), np.nan)
+
+
+@instrumented()
+def score_pairs(pairs, ois, cdr):
+    '''Adds a column per LINK_WEIGHTS key with how well the pairs agree on it (0 to 1, or NaN if
+    unknown), and their score: the weighted mean of the known agreements.
+
+    The date agrees fully when the shooting was on the day of the custody or of the death, and
+    less the further away from the closer of the two it was.
+
+    Args:
+        pairs: From candidate_pairs
+        ois, cdr: Frames from linkage_frame, with sex, race, age and (for cdr) custody_date columns added
+    '''
+    o = ois.iloc[pairs['ois_row'].values].reset_index(drop=True)
+    c = cdr.iloc[pairs['cdr_row'].values].reset_index(drop=True)
+    to_death = np.abs((c['date'].values - o['date'].values) / np.timedelta64(1, 'D'))
+    to_custody = np.abs((c['custody_date'].values - o['date'].values) / np.timedelta64(1, 'D'))
+    days = np.fmin(to_death, to_custody)
+    age_difference = np.abs(o['age'].values - c['age'].values)
+
+    scored = pairs.copy()
+    scored['days_from_shooting_to_death'] = (c['date'].values - o['date'].values) / np.timedelta64(1, 'D')
+    scored['last_name'] = name_similarity(o['last'].values, c['last'].values)
+    scored['first_name'] = name_similarity(o['first'].values, c['first'].values)
+    scored['date'] = np.clip(1 - days / float(LINK_MAX_DAYS), 0, 1)
+    scored['county'] = _equal(o['county'].values, c['county'].values)
+    scored['sex'] = _equal(o['sex'].values, c['sex'].values)
+    scored['race'] = _equal(o['race'].values, c['race'].values)
+    scored['age'] = np.clip(1 - age_difference / float(LINK_MAX_AGE_DIFFERENCE), 0, 1)
+
+    agreements = scored[list(LINK_WEIGHTS)].values
+    weights = np.array(list(LINK_WEIGHTS.values()), dtype=float)
+    known = ~np.isnan(agreements)
+    scored['score'] = (np.nan_to_num(agreements) * weights).sum(axis=1) / (known * weights).sum(axis=1)
+    return scored
+
+
+@instrumented()
+def link_ois_to_cdr(ois, cdr, min_score=LINK_MIN_SCORE):
+    '''Returns the likely links between civilians shot and custodial death reports.
+
+    Args:
+        ois: The cleaned civilians shot dataset
+        cdr: The cleaned custodial death reports
+        min_score: Links scoring less are left out
+
+    Returns:
+        A dataframe with a row per link: identifying columns of both records, the block that found
+        it, the agreement on each column of LINK_WEIGHTS, the score, and the link's rank among those
+        of its shooting (1 for the best), sorted by shooting and rank.
+    '''
+    ois_keys = linkage_frame(ois, 'civilian_name_first', 'civilian_name_last', 'date_incident', ['incident_county'])
+    cdr_keys = linkage_frame(cdr, 'name_first', 'name_last', 'death_date', ['death_location_county', 'agency_county'])
+    for keys, df, columns in [(ois_keys, ois, ['civilian_gender', 'civilian_race', 'civilian_age']),
+                              (cdr_keys, cdr, ['sex', 'race', 'age_at_time_of_death'])]:
+        keys['sex'] = df[columns[0]].astype(object).values
+        keys['race'] = df[columns[1]].astype(object).values
+        keys['age'] = pd.to_numeric(df[columns[2]], errors='coerce').values
+    cdr_keys['custody_date'] = pd.to_datetime(cdr['date_time_of_custody_or_incident']).dt.normalize().values
+
+    pairs = candidate_pairs(ois_keys, cdr_keys)
+    scored = score_pairs(pairs, ois_keys, cdr_keys)
+    scored = scored[scored['score'] >= min_score]
+    scored['rank'] = scored.groupby('ois_row')['score'].rank(method='first', ascending=False).astype(int)
+
+    ois_columns = ois[OIS_COLUMNS].iloc[scored['ois_row'].values].reset_index(drop=True)
+    cdr_columns = cdr[CDR_COLUMNS].iloc[scored['cdr_row'].values].reset_index(drop=True)
+    cdr_columns.columns = ['cdr_' + c for c in cdr_columns.columns]
+    scored = scored.reset_index(drop=True)
+    links = pd.concat([ois_columns, cdr_columns, scored.drop(['ois_row', 'cdr_row'], axis=1)], axis=1)
+    links['_ois_row'] = scored['ois_row']
+    links = links.sort_values(['_ois_row', 'rank']).drop('_ois_row', axis=1).reset_index(drop=True)
+    print('Linked %d of %d civilians shot to custodial death reports (%d flagged as having one)' % (
+        (links['rank'] == 1).sum(), len(ois), ois['custodial_death_report'].fillna(False).astype(bool).sum()))
+    return links
+
+
+def run_links():
+    '''Reads the cleaned civilians shot and CDR datasets, and writes the links between them. Returns the links.'''
+    ois = read_output(OIS_FILENAME, DW_PROJECT_OIS, OIS_CIVILIANS_SHOT, columns=OIS_COLUMNS)
+    cdr = read_output(CDR_FILENAME, DW_PROJECT_CDR, CDR, columns=CDR_COLUMNS)
+    links = link_ois_to_cdr(ois, cdr)
+    write_outputs(links, OUTPUT_FILENAME, DW_PROJECT_OIS, 'ois')
+    return links
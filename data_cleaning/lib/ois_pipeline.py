@@ -0,0 +1,545 @@
+'''The officer-involved shootings (OIS) cleaning pipelines, as plain stage functions.
+
+clean_ois_civilians_shot.ipynb and clean_ois_officers_shot.ipynb run these one by one,
+with a look at the data (and the reasoning behind each step) along the way;
+run_civilians_shot and run_officers_shot run them all headlessly.
+
+Inputs:
+  * tji/raw-and-processing/OIS.xlsx
+  * tji/auxiliary-datasets/agencies_and_counties (used to add county information)
+Outputs:
+  * tji/officer-involved-shootings/shot_civilians.csv
+  * tji/officer-involved-shootings/shot_officers.csv
+'''
+
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+from lib.agency_resolver import AgencyCountyResolver
+from lib.cleaning_tools import (
+    CleaningError, ColumnPlan, convert_date_cols, map_unique, numericalize_age_cols, parallel_apply, read_dtw_excel,
+    reorder_columns_and_check, standardize_gender_cols, standardize_race_cols, upcase_strip_string_cells)
+from lib.incremental import library_context, merge_incremental, plan_incremental
+from lib.instrumentation import instrumented
+from lib.pipelines import (
+    AGENCIES_TABLE, DW_PROJECT_AUXILIARY_DATASETS, DW_PROJECT_OIS, DW_PROJECT_RAW_AND_PROCESSING, read_agencies,
+    write_outputs)
+from lib.schemas import (
+    AGE, DATE, GENDER, OIS_CIVILIANS_SHOT, OIS_CIVILIANS_SHOT_RAW, OIS_OFFICERS_SHOT, OIS_OFFICERS_SHOT_RAW, RACE,
+    ZIP)
+from lib.standardize_police_agency_names import standardize_agency_names
+
+
+RAW_FILENAME = 'original/OIS.xlsx'
+CIVILIANS_SHOT_FILENAME = 'shot_civilians.csv'
+OFFICERS_SHOT_FILENAME = 'shot_officers.csv'
+
+# What run_civilians_shot and run_officers_shot read from data.world (see prefetch_pipelines)
+DW_INPUTS = [
+    (DW_PROJECT_RAW_AND_PROCESSING, RAW_FILENAME),
+    (DW_PROJECT_AUXILIARY_DATASETS, AGENCIES_TABLE),
+]
+
+# Civilians shot reports have details for up to this many officers
+MAX_OFFICERS = 10
+
+CIVILIANS_SHOT_RENAMES = {
+    "ois report no.": "ois_report_no",
+    "number of reports filed": "num_reports_filed",
+    "date ag received": "date_ag_received",
+    "date of incident": "date_incident",
+    "time of incident": "time_incident",
+    "injured or deceased's first name": "civilian_name_first",
+    "injured or deceased's last name": "civilian_name_last",
+    "injured or deceased's gender": "civilian_gender",
+    "injured or deceased's age": "civilian_age",
+    "injured or deceased's race/ethnicity": "civilian_race",
+    "street address of incident": "incident_address",
+    "city of incident": "incident_city",
+    "county of incident": "incident_county",
+    "zip code of incident": "incident_zip",
+    "incident resulted in": "incident_resulted_in",
+    "carried, exhibited or used deadly weapon": "deadly_weapon",
+    "on duty or off duty": "officer_on_duty",
+    "peace officer responding with 1 or more officers": "multiple_officers_involved",
+    "incident occurred during or as a result of": "incident_result_of",
+    "if other, specify type of call": "incident_call_other",
+    "deadly weapon description": "weapon_reported_by_media",
+    "cdr?": "custodial_death_report",
+    "cdr narrative": "cdr_narrative",
+    "narrative published by law enforcement": "lea_narrative_published",
+    "shorter": "lea_narrative_shorter",
+}
+# Columns with a copy per officer (or per report): e.g. agency_name_1 for the first officer's
+# agency, agency_name_2 for the second's, etc.
+CIVILIANS_SHOT_NUMBERED_RENAMES = {
+    "date of report %d": "agency_report_date_%d",
+    "name of agency %d": "agency_name_%d",
+    "city of agency %d": "agency_city_%d",
+    "zip code of agency %d": "agency_zip_%d",
+    "name of person %d filling out form": "agency_name_person_filling_out_%d",
+    "email address of person %d filling out form": "agency_email_person_filling_out_%d",
+    "peace officer %d's gender": "officer_gender_%d",
+    "peace officer %d's age": "officer_age_%d",
+    "peace officer %d's race/ethnicity": "officer_race_%d",
+    "incident occurred during or as a result of %d": "officer_caused_injury_%d",
+    "news %d": "news_coverage_%d",
+}
+
+# Manual categorization of the weapons described by the media
+WEAPON_TYPES = {
+    'FIREARM': [
+        'handgun', 'sawed-off shotgun', 'revolver', 'rifle',
+        'assault rifle', 'firearm', 'shotgun', 'long gun', 'gun',
+        'glock 40', 'pistol', 'knife, gun', "deputy's gun",
+        'vehicle, gun', 'semi-automatic rifle'],
+    'KNIFE/CUTTING': [
+        'hatchet', 'butcher knife', 'knife', 'knives', 'box cutter',
+        'knife - not opened', 'machete', 'sword', 'axe', 'knives (2)',
+        "officer's gun", 'pickaxe', 'samurai sword', "took officer's knife",
+        'sharp metal object (piece of headphones)', 'scissors, screwdriver'],
+    'VEHICLE': ['car', 'truck', 'vehicle'],
+}
+
+# [city, wrong county, right county]. Officers from Baytown and Spring, which border Houston
+# (in Harris county, their emails are from hctx.net), are sometimes given agencies in Harrison
+# county, which is nowhere near.
+CITY_COUNTY_CORRECTIONS = [
+    ['BAYTOWN', 'HARRISON', 'HARRIS'],
+    ['SPRING', 'HARRISON', 'HARRIS'],
+]
+
+
+def _officer_columns(i):
+    cols = ['officer_age_%d', 'officer_race_%d', 'officer_gender_%d']
+    if i in (2, 3):
+        cols.append('officer_caused_injury_%d')
+    cols += ['agency_name_%d', 'agency_report_date_%d', 'agency_city_%d', 'agency_county_%d', 'agency_zip_%d',
+             'agency_name_person_filling_out_%d', 'agency_email_person_filling_out_%d']
+    return [c % i for c in cols]
+
+
+CIVILIANS_SHOT_ORDER = [
+    'ois_report_no', 'date_ag_received', 'date_incident', 'incident_address', 'incident_city', 'incident_county',
+    'incident_zip', 'incident_result_of', 'incident_call_other', 'civilian_name_first', 'civilian_name_last',
+    'civilian_name_full', 'civilian_gender', 'civilian_age', 'civilian_race', 'civilian_died',
+] + [c for i in range(1, MAX_OFFICERS + 1) for c in _officer_columns(i)] + [
+    'news_coverage_1', 'news_coverage_2', 'news_coverage_3', 'news_coverage_4',
+    'agency_city_11', 'agency_email_person_filling_out_11', 'agency_name_11', 'agency_name_person_filling_out_11',
+    'agency_report_date_11', 'agency_zip_11', 'cdr_narrative', 'custodial_death_report', 'deadly_weapon',
+    'lea_narrative_published', 'lea_narrative_shorter', 'multiple_officers_involved', 'num_officers_recorded',
+    'num_reports_filed', 'num_rows_about_this_incident', 'officer_age_11', 'officer_gender_11', 'officer_on_duty',
+    'officer_race_11', 'time_incident', 'weapon_reported_by_media', 'weapon_reported_by_media_category',
+]
+
+OFFICERS_SHOT_RENAMES = {
+    "ois report no.": "ois_report_no",
+    "date oag received": "date_ag_received",
+    "date of incident": "date_incident",
+    "officer first name": "officer_name_first",
+    "officer last name": "officer_name_last",
+    "injured or deceased's gender": "officer_gender",
+    "injured or deceased's age": "officer_age",
+    "injured or deceased's race/ethnicity": "officer_race",
+    "street address of incident": "incident_address",
+    "city of incident": "incident_city",
+    "county of incident": "incident_county",
+    "zip code of incident": "incident_zip",
+    "incident resulted in 1": "incident_result_1",
+    "incident resulted in 2": "incident_result_2",
+    "media": "media_link_1",
+    "column1": "media_link_2",
+    "column2": "media_link_3",
+}
+# For agencies 1 and 2
+OFFICERS_SHOT_AGENCY_RENAMES = {
+    "date of report %d": "agency_report_date_%d",
+    "name of agency %d": "agency_name_%d",
+    "city of agency %d": "agency_city_%d",
+    "zip code of agency %d": "agency_zip_%d",
+    "name of person %d filling out form": "agency_name_person_filling_out_%d",
+    "email address of person %d filling out form": "agency_email_person_filling_out_%d",
+}
+# For civilians 1 to 3
+OFFICERS_SHOT_CIVILIAN_RENAMES = {
+    "non-peace officer's gender %d": "civilian_gender_%d",
+    "non-peace officer's age %d": "civilian_age_%d",
+    "non-peace officer's race/ethnicity %d": "civilian_race_%d",
+    "non-officer first name %d": "civilian_name_first_%d",
+    "non-officer last name %d": "civilian_name_last_%d",
+}
+
+INCIDENT_COUNTY_FIXES = {
+    'COLIN': 'COLLIN',
+    'BELL COUNTY': 'BELL',
+}
+
+OFFICERS_SHOT_ORDER = [
+    'ois_report_no', 'date_ag_received', 'date_incident', 'incident_address', 'incident_city', 'incident_county',
+    'incident_zip', 'officer_harm', 'officer_name_first', 'officer_name_last', 'officer_age', 'officer_race',
+    'officer_gender',
+] + [c % i for i in (1, 2) for c in [
+    'agency_name_%d', 'agency_city_%d', 'agency_county_%d', 'agency_zip_%d', 'agency_report_date_%d',
+    'agency_name_person_filling_out_%d', 'agency_email_person_filling_out_%d']
+] + ['num_civilians_recorded', 'civilian_harm', 'civilian_suicide'] + [c % i for i in (1, 2, 3) for c in [
+    'civilian_name_first_%d', 'civilian_name_last_%d', 'civilian_age_%d', 'civilian_race_%d', 'civilian_gender_%d']
+] + ['media_link_1', 'media_link_2', 'media_link_3']
+
+
+def read_raw_ois(sheet):
+    '''Reads a sheet ('OISTable' for civilians shot, 'OfficersShot' for officers shot) of the raw OIS file.'''
+    shootings = read_dtw_excel(DW_PROJECT_RAW_AND_PROCESSING, RAW_FILENAME, select_sheet=sheet)
+    print("Found %d %s incidents from %s to %s" % (
+        len(shootings), sheet,
+        shootings['Date of Incident'].min().strftime('%Y-%m-%d'),
+        shootings['Date of Incident'].max().strftime('%Y-%m-%d')))
+    return shootings
+
+
+@instrumented()
+def normalize(shootings, drop):
+    '''Lowercases column names, upcases and strips string cells, and drops the given columns.'''
+    shootings.columns = [c.strip().lower() for c in shootings.columns]
+    upcase_strip_string_cells(shootings)
+    return shootings.drop(drop, axis=1)
+
+
+def lookup_counties(names, agencies):
+    '''Returns the county of each (standardized) agency name, or NaN if unknown.'''
+    return AgencyCountyResolver(agencies).counties(names)
+
+
+def yes_no_to_bool(series):
+    '''Converts yes/no answers to booleans, treating missing answers as no.'''
+    return map_unique(series.fillna('n'), lambda c: c.strip().lower()[0] == 'y', keep_null=True)
+
+
+# Civilians shot
+
+def incremental_context(agencies):
+    '''Returns everything besides the raw rows that cleaned OIS rows depend on (see lib/incremental.py).'''
+    return library_context(frames=[agencies])
+
+
+@instrumented()
+def rename_civilians_shot_columns(shootings):
+    '''Renames columns to machine-friendly names, e.g. "peace officer 2's age" to officer_age_2.'''
+    max_reports_per_incident = max(int(c.strip().split()[-1]) for c in shootings.columns
+                                   if c.startswith("date of report"))
+    print("Deaths may have as many as %d OIS reports filed" % max_reports_per_incident)
+    renames = dict(CIVILIANS_SHOT_RENAMES)
+    for i in range(1, max_reports_per_incident + 1):
+        for k, v in CIVILIANS_SHOT_NUMBERED_RENAMES.items():
+            renames[k % i] = v % i
+    shootings.columns = [renames[c] for c in shootings.columns]
+    return shootings
+
+
+@instrumented()
+def standardize_civilians_shot_columns(shootings):
+    '''Standardizes gender, race, age and date columns, and adds num_officers_recorded.'''
+    schema = OIS_CIVILIANS_SHOT_RAW
+    standardize_gender_cols(shootings, schema.find(GENDER, shootings.columns))
+    standardize_race_cols(shootings, schema.find(RACE, shootings.columns))
+    rejected = numericalize_age_cols(shootings, schema.find(AGE, shootings.columns))
+    rejected.update(convert_date_cols(shootings, schema.find(DATE, shootings.columns)))
+    for c, values in rejected.items():
+        print("- %d values of %s could not be converted" % (values.sum(), c))
+
+    # Not all incidents use a separate agency_name_X column per officer, so the presence of
+    # officer gender is used to count officers instead.
+    officer_gender_cols = ['officer_gender_%d' % i for i in range(1, MAX_OFFICERS + 1)]
+    shootings['num_officers_recorded'] = shootings[officer_gender_cols].notnull().sum(axis=1)
+    return shootings
+
+
+@instrumented()
+def convert_civilians_shot_answers(shootings):
+    '''Drops empty rows, and converts yes/no and other free text answers to booleans or lowercase.'''
+    shootings = shootings[shootings['num_reports_filed'].notnull()].copy()
+
+    shootings['custodial_death_report'] = yes_no_to_bool(shootings['custodial_death_report'])
+    shootings['multiple_officers_involved'] = yes_no_to_bool(shootings['multiple_officers_involved'])
+
+    shootings['civilian_died'] = map_unique(
+        shootings['incident_resulted_in'], lambda x: x.strip().lower(), keep_null=True)
+    shootings = shootings.drop('incident_resulted_in', axis=1)
+    shootings['incident_result_of'] = map_unique(
+        shootings['incident_result_of'], lambda x: x.strip().lower(), keep_null=True)
+
+    shootings['officer_on_duty'] = map_unique(
+        shootings['officer_on_duty'], lambda x: x.strip().lower().startswith('on '), keep_null=True)
+    shootings['weapon_reported_by_media'] = map_unique(
+        shootings['weapon_reported_by_media'], lambda w: w.strip().lower(), keep_null=True)
+    return shootings
+
+
+def weapon_category(has_weapon, description, type_lookup):
+    if pd.isnull(description) or not description:
+        return '(DETAILS MISSING)' if has_weapon else np.nan
+    return type_lookup.get(description, 'OTHER')
+
+
+@instrumented()
+def categorize_weapons(shootings):
+    '''Converts deadly_weapon to a boolean, and categorizes the weapons described by the media (see WEAPON_TYPES).
+
+    Sometimes there was no deadly weapon, yet a description of one is given.
+    '''
+    shootings['deadly_weapon'] = map_unique(
+        shootings['deadly_weapon'], lambda w: w.lower().strip() == 'yes', keep_null=True)
+
+    type_lookup = {}
+    for w_type, weapons in WEAPON_TYPES.items():
+        for w in weapons:
+            if w in type_lookup:
+                raise CleaningError('Weapon %s has more than one type' % w)
+            type_lookup[w] = w_type
+    shootings['weapon_reported_by_media_category'] = parallel_apply(
+        shootings, functools.partial(weapon_category, type_lookup=type_lookup),
+        ['deadly_weapon', 'weapon_reported_by_media'])
+    return shootings
+
+
+@instrumented()
+def uppercase_string_columns(shootings):
+    print('Uppercasing columns: ', end='')
+    for col, dt in shootings.dtypes.items():
+        if dt == 'object':
+            print(col, end=' ')
+            shootings[col] = map_unique(shootings[col], lambda s: s.upper() if isinstance(s, str) else s,
+                                        keep_null=True)
+    print()
+    return shootings
+
+
+def officers_long(shootings, fields):
+    '''Returns per-officer columns as a long table, with one row per officer and shootings row.
+
+    E.g. fields ['agency_name', 'agency_city'] gathers agency_name_1 to agency_name_10 and agency_city_1 to
+    agency_city_10 into two columns, indexed by officer (the N in the _N suffix) and row (shootings' index).
+    Per-officer transforms then run once over it instead of once per officer; officers_wide writes them back.
+    '''
+    slots = []
+    for i in range(1, MAX_OFFICERS + 1):
+        cols = ['%s_%d' % (f, i) for f in fields]
+        slots.append(shootings[cols].rename(columns=dict(zip(cols, fields))))
+    return pd.concat(slots, keys=range(1, MAX_OFFICERS + 1), names=['officer', 'row'])
+
+
+def officers_wide(shootings, officers, fields):
+    '''Writes columns of an officers_long table back to shootings' per-officer columns, adding any that are new.
+
+    New columns go at the end, to be put in place by the final reordering.
+    '''
+    wide = officers[fields].unstack('officer')
+    for f in fields:
+        for i in range(1, MAX_OFFICERS + 1):
+            # Each column gets the dtype it would have had if transformed on its own
+            shootings['%s_%d' % (f, i)] = wide[(f, i)].infer_objects()
+    return shootings
+
+
+@instrumented()
+def standardize_officer_agencies(officers, agencies):
+    '''Standardizes the agency names of an officers_long table, and adds their counties.'''
+    officers['agency_name'] = standardize_agency_names(officers['agency_name'])
+    officers['agency_county'] = lookup_counties(officers['agency_name'], agencies)
+    print("Missing county information for %d officers" % officers['agency_county'].isnull().sum())
+    return officers
+
+
+@instrumented()
+def correct_city_counties(officers, corrections=CITY_COUNTY_CORRECTIONS):
+    '''Fixes the county of, and in the agency name, officers' agencies known to be in the wrong county.
+
+    Takes an officers_long table with agency_name, agency_city and agency_county. Returns the corrected table,
+    and the indices of the shootings rows corrected.
+    '''
+    corrected = set()
+    for city, wrong_county, right_county in corrections:
+        wrong = (officers['agency_city'] == city) & (officers['agency_county'] == wrong_county)
+        officers.loc[wrong, 'agency_county'] = right_county
+        officers.loc[wrong, 'agency_name'] = officers.loc[wrong, 'agency_name'].str.replace(
+            wrong_county, right_county, regex=False)
+        corrected.update(officers.index[wrong].get_level_values('row'))
+    print("Corrected the agency county of %d records" % len(corrected))
+    return officers, sorted(corrected)
+
+
+@instrumented()
+def count_incident_rows(shootings):
+    '''Adds num_rows_about_this_incident, counting the rows with the same address and date.
+
+    Rows missing either count as their own incident.
+    '''
+    known = shootings['incident_address'].notnull() & shootings['date_incident'].notnull()
+    sizes = shootings[known].groupby(['incident_address', 'date_incident'])['incident_address'].transform('size')
+    shootings['num_rows_about_this_incident'] = sizes.reindex(shootings.index).fillna(1).astype(int)
+    return shootings
+
+
+def full_names(first, last):
+    '''Returns first and last names joined, with extra whitespace removed, or NaN if both are missing.'''
+    s = (first.fillna('') + ' ' + last.fillna('')).str.split().str.join(' ')
+    return s.where(s != '', np.nan)
+
+
+@instrumented()
+def finalize_civilians_shot(shootings):
+    '''Adds civilian_name_full, reorders the columns and sorts the rows.'''
+    plan = ColumnPlan(shootings)
+    plan.insert_after(full_names(shootings['civilian_name_first'], shootings['civilian_name_last']),
+                      'civilian_name_full', 'civilian_name_last')
+    shootings = plan.reorder(CIVILIANS_SHOT_ORDER).apply()
+    return shootings.sort_values(['date_incident', 'incident_county', 'agency_county_1'])
+
+
+def clean_civilians_shot(shootings, agencies, incremental=False):
+    '''Runs every cleaning stage for civilians shot.
+
+    Args:
+        shootings: The 'OISTable' sheet of the raw OIS file
+        agencies: The agencies_and_counties auxiliary dataset
+        incremental: Whether to only clean rows that changed since the last run (see lib/incremental.py)
+    '''
+    shootings = normalize(shootings, ['no.', 'column1', 'column2', 'extras'])
+    plan = plan_incremental(shootings, 'ois report no.', CIVILIANS_SHOT_FILENAME,
+                            context=incremental_context(agencies), enabled=incremental)
+    print("Cleaning %d of %d rows" % (len(plan.to_clean), len(plan.keys)))
+    shootings = rename_civilians_shot_columns(plan.to_clean)
+    shootings = standardize_civilians_shot_columns(shootings)
+    shootings = convert_civilians_shot_answers(shootings)
+    shootings = categorize_weapons(shootings)
+    shootings = uppercase_string_columns(shootings)
+    officers = standardize_officer_agencies(officers_long(shootings, ['agency_name', 'agency_city']), agencies)
+    officers, _ = correct_city_counties(officers)
+    shootings = officers_wide(shootings, officers, ['agency_name', 'agency_county'])
+    # Everything from here on looks across rows, so it needs all of them
+    shootings = merge_incremental(shootings, plan)
+    shootings = count_incident_rows(shootings)
+    return finalize_civilians_shot(shootings)
+
+
+def run_civilians_shot():
+    '''Reads, cleans and writes the civilians shot dataset. Returns the cleaned dataframe.'''
+    shootings = clean_civilians_shot(read_raw_ois('OISTable'), read_agencies(),
+                                     incremental=os.environ.get('CLEAN_OIS_INCREMENTAL') == 'TRUE')
+    write_outputs(shootings, CIVILIANS_SHOT_FILENAME, DW_PROJECT_OIS, 'ois', schema=OIS_CIVILIANS_SHOT)
+    return shootings
+
+
+# Officers shot
+
+@instrumented()
+def rename_officers_shot_columns(shootings):
+    '''Blanks out 'NOT AVAILABLE' values, and renames columns to machine-friendly names.'''
+    for c in shootings.columns:
+        if shootings[c].dtype == 'object':
+            shootings.loc[shootings[c] == 'NOT AVAILABLE', c] = None
+
+    renames = dict(OFFICERS_SHOT_RENAMES)
+    for i in range(1, 3):
+        for k, v in OFFICERS_SHOT_AGENCY_RENAMES.items():
+            renames[k % i] = v % i
+    for i in range(1, 4):
+        for k, v in OFFICERS_SHOT_CIVILIAN_RENAMES.items():
+            renames[k % i] = v % i
+    shootings.columns = [renames[c] for c in shootings.columns]
+    return shootings
+
+
+@instrumented()
+def count_civilians(shootings):
+    '''Adds num_civilians_recorded. Civilian N is counted if any of their civilian_*_N columns are filled out.'''
+    numbered = [c for c in shootings.columns if c.startswith('civilian_') and c[-1].isdigit()]
+    numbers = sorted(set(int(c.rsplit('_', 1)[1]) for c in numbered))
+    print("Data for up to %d civilians is recorded" % len(numbers))
+    recorded = [shootings[[c for c in numbered if int(c.rsplit('_', 1)[1]) == i]].notnull().any(axis=1)
+                for i in numbers]
+    shootings['num_civilians_recorded'] = pd.concat(recorded, axis=1).sum(axis=1)
+    return shootings
+
+
+def injury_type(s):
+    if pd.isnull(s):
+        return 'NONE'
+    s = s.upper()
+    for result in ('DEATH', 'INJURY'):
+        if result in s:
+            return result
+    if 'SUICIDE' in s:
+        return 'DEATH'
+    else:
+        raise CleaningError('Invalid incident result: ' + s)
+
+
+@instrumented()
+def standardize_officers_shot_columns(shootings):
+    '''Standardizes gender, race, age, harm, zip and date columns.'''
+    schema = OIS_OFFICERS_SHOT_RAW
+    standardize_gender_cols(shootings, schema.find(GENDER, shootings.columns))
+    standardize_race_cols(shootings, schema.find(RACE, shootings.columns))
+    numericalize_age_cols(shootings, schema.find(AGE, shootings.columns))
+
+    shootings['officer_harm'] = shootings['incident_result_1'].apply(injury_type)
+    shootings['civilian_harm'] = shootings['incident_result_2'].apply(injury_type)
+    shootings['civilian_suicide'] = (shootings['incident_result_2'].notnull() &
+                                     shootings['incident_result_2'].str.contains('SUICIDE'))
+    shootings = shootings.drop(['incident_result_1', 'incident_result_2'], axis=1)
+
+    for c in schema.find(ZIP, shootings.columns):
+        shootings[c] = map_unique(shootings[c], lambda z: str(z).split('-')[0], keep_null=True)
+    for c in schema.find(DATE, shootings.columns):
+        shootings[c] = pd.to_datetime(shootings[c])
+    return shootings
+
+
+@instrumented()
+def standardize_officers_shot_agencies(shootings, agencies):
+    '''Standardizes agency names, adds the agencies' counties, and fixes known typos in incident counties.
+
+    The county columns go at the end, to be put in place by the final reordering.
+    '''
+    for i in (1, 2):
+        c = 'agency_name_%d' % i
+        print("Standardizing", c)
+        shootings[c] = standardize_agency_names(shootings[c])
+        shootings['agency_county_%d' % i] = lookup_counties(shootings[c], agencies)
+    print('Missing county information for %d records' % shootings['agency_county_1'].isnull().sum())
+
+    for before, after in INCIDENT_COUNTY_FIXES.items():
+        shootings.loc[shootings['incident_county'] == before, 'incident_county'] = after
+    return shootings
+
+
+def clean_officers_shot(shootings, agencies, incremental=False):
+    '''Runs every cleaning stage for officers shot.
+
+    Args:
+        shootings: The 'OfficersShot' sheet of the raw OIS file
+        agencies: The agencies_and_counties auxiliary dataset
+        incremental: Whether to only clean rows that changed since the last run (see lib/incremental.py)
+    '''
+    shootings = normalize(shootings, ['no.', 'number of reports filed'])
+    plan = plan_incremental(shootings, 'ois report no.', OFFICERS_SHOT_FILENAME,
+                            context=incremental_context(agencies), enabled=incremental)
+    print("Cleaning %d of %d rows" % (len(plan.to_clean), len(plan.keys)))
+    shootings = rename_officers_shot_columns(plan.to_clean)
+    shootings = count_civilians(shootings)
+    shootings = standardize_officers_shot_columns(shootings)
+    shootings = standardize_officers_shot_agencies(shootings, agencies)
+    shootings = merge_incremental(shootings, plan)
+    shootings = reorder_columns_and_check(shootings, OFFICERS_SHOT_ORDER)
+    return shootings.sort_values(['date_incident', 'incident_county', 'agency_county_1'])
+
+
+def run_officers_shot():
+    '''Reads, cleans and writes the officers shot dataset. Returns the cleaned dataframe.'''
+    shootings = clean_officers_shot(read_raw_ois('OfficersShot'), read_agencies(),
+                                    incremental=os.environ.get('CLEAN_OIS_INCREMENTAL') == 'TRUE')
+    write_outputs(shootings, OFFICERS_SHOT_FILENAME, DW_PROJECT_OIS, 'ois', schema=OIS_OFFICERS_SHOT)
+    return shootings
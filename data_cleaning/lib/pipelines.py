@@ -0,0 +1,129 @@
+'''Runs the cleaning pipelines headlessly, without notebooks or kernels.
+
+Each dataset's cleaning lives in a module of plain stage functions (lib/cdr_pipeline.py and
+lib/ois_pipeline.py). Their run functions read the raw data, clean it and write the outputs
+just as the dataset's notebook does, and the notebooks are thin wrappers around the same
+stages. Run them from the data_cleaning directory with clean.py, or in-process from the
+automation.
+'''
+
+import collections
+import importlib
+import os
+
+import datadotworld as dw
+
+from lib.cleaning_tools import (
+    get_dtw_cache, load_dtw_dataset, prefetch_dtw, read_dtw_file, read_intermediate, write_intermediate)
+from lib.instrumentation import stage
+from lib.storage import get_storage
+
+
+DW_PROJECT_CDR = 'tji/deaths-in-custody'
+DW_PROJECT_OIS = 'tji/officer-involved-shootings'
+DW_PROJECT_AUXILIARY_DATASETS = 'tji/auxiliary-datasets'
+DW_PROJECT_RAW_AND_PROCESSING = 'tji/raw-and-processing'
+
+AGENCIES_TABLE = 'agencies_and_counties'
+
+S3_CLEANED_BUCKET = 'tji-public-cleaned-datasets'
+
+
+# Each pipeline's module lists the data.world files it reads as DW_INPUTS (see prefetch_pipelines)
+Pipeline = collections.namedtuple('Pipeline', ['name', 'notebook', 'module', 'function'])
+
+# In the order clean.py runs them by default
+PIPELINES = collections.OrderedDict((p.name, p) for p in [
+    Pipeline('cdr', 'clean_cdr.ipynb', 'lib.cdr_pipeline', 'run_cdr'),
+    Pipeline('ois_civilians', 'clean_ois_civilians_shot.ipynb', 'lib.ois_pipeline', 'run_civilians_shot'),
+    Pipeline('ois_officers', 'clean_ois_officers_shot.ipynb', 'lib.ois_pipeline', 'run_officers_shot'),
+    # Reads the outputs of cdr and ois_civilians, so runs after them
+    Pipeline('ois_cdr_links', None, 'lib.linkage', 'run_links'),
+])
+
+
+def pipeline_for_notebook(nb_name):
+    '''Returns the Pipeline a notebook wraps, or None if it has none.'''
+    for pipeline in PIPELINES.values():
+        if pipeline.notebook == os.path.basename(nb_name):
+            return pipeline
+    return None
+
+
+def _pipeline_module(name):
+    # Imported here, since the pipeline modules import this one
+    return importlib.import_module(PIPELINES[name].module)
+
+
+def run_pipeline(name):
+    '''Runs a pipeline by name (a key of PIPELINES), returning the cleaned dataframe.'''
+    func = getattr(_pipeline_module(name), PIPELINES[name].function)
+    with stage('pipeline', pipeline=name) as record:
+        df = func()
+        record['rows'] = len(df)
+    return df
+
+
+def prefetch_pipelines(names):
+    '''Downloads the data.world files the named pipelines read into the cache, several projects at once.
+
+    The pipelines then read them from disk. Returns the (project_key, name) of the files.
+    '''
+    files = []
+    for name in names:
+        files.extend(f for f in _pipeline_module(name).DW_INPUTS if f not in files)
+    with stage('prefetch', files=len(files)):
+        prefetch_dtw(files, parse=False)
+    return files
+
+
+def read_agencies():
+    '''Returns the agencies_and_counties auxiliary dataset: standardized agency names and their counties.'''
+    return load_dtw_dataset(DW_PROJECT_AUXILIARY_DATASETS).dataframes[AGENCIES_TABLE]
+
+
+def read_output(filename, dw_project, schema=None, columns=None):
+    '''Reads (only the given columns of) a cleaned dataset written by write_outputs.
+
+    Its intermediate is read if it is recent, and otherwise the CSV on data.world, typed by the schema.
+    '''
+    df = read_intermediate(filename, columns=columns)
+    if df is None:
+        df = read_dtw_file(dw_project, os.path.splitext(filename)[0], schema=schema, usecols=columns)
+    return df
+
+
+def write_outputs(df, filename, dw_project, dataset, schema=None):
+    '''Writes a cleaned dataset to data.world, S3 and the intermediate directory.
+
+    data.world and S3 are only written to when CLEAN_<DATASET>_DW and CLEAN_<DATASET>_S3
+    are 'TRUE'.
+
+    Args:
+        df: The cleaned dataframe
+        filename: The output filename, e.g. 'shot_civilians.csv'
+        dw_project: The data.world project to write to
+        dataset: 'cdr' or 'ois'
+        schema: The output's Schema (see lib/schemas.py), typing the intermediate's categoricals
+    '''
+    env_prefix = 'CLEAN_%s' % dataset.upper()
+    # The S3 upload runs in the background while writing to data.world
+    upload = None
+    if os.environ.get(env_prefix + '_S3') != 'TRUE':
+        print("Not writing to s3. To do so, set %s_S3 to 'TRUE'" % env_prefix)
+    else:
+        print("Writing to s3: %s/%s" % (S3_CLEANED_BUCKET, filename))
+        upload = get_storage().upload_csv(df, S3_CLEANED_BUCKET, filename, background=True)
+
+    if os.environ.get(env_prefix + '_DW') != 'TRUE':
+        print("Not syncing to Data.world. To do so, set %s_DW to 'TRUE'" % env_prefix)
+    else:
+        with dw.open_remote_file(dw_project, filename) as w:
+            print("Writing to data.world: %s/%s" % (dw_project, filename))
+            df.to_csv(w, index=False)
+        get_dtw_cache().forget_version(dw_project)
+    if upload:
+        get_storage().wait([upload])
+
+    # Typed copy of the output for the compression stage (create_datasets_for_website.ipynb) to read
+    write_intermediate(df, filename, schema)
@@ -0,0 +1,143 @@
+'''A local SQLite copy of the cleaned datasets, for deriving datasets from them with SQL.
+
+Derived datasets (e.g. the pre-trial deaths transfer_clean_data.ipynb sends to Tableau) are
+declared as named SQL views in VIEWS, over the tables in TABLES. QueryDB.refresh loads each
+table from its Parquet intermediate if it is recent, and otherwise from its CSV in the
+data.world cache, a chunk at a time, so the full dataset is never held in pandas. Tables are
+only reloaded when their source has changed. The columns in a table's 'indexes' are indexed,
+so views filtering on them only read the matching rows.
+'''
+
+import collections
+import contextlib
+import hashlib
+import io
+import os
+import sqlite3
+
+import pandas as pd
+
+from lib.cleaning_tools import INTERMEDIATE_DIR, get_dtw_cache, has_intermediate, intermediate_path
+from lib.pipelines import DW_PROJECT_CDR
+
+
+QUERY_DB_PATH = os.environ.get('TJI_QUERY_DB', os.path.join(INTERMEDIATE_DIR, 'query.sqlite'))
+# How many rows are read into pandas, and written to SQLite, at a time
+QUERY_CHUNK_ROWS = 10000
+
+# The cleaned datasets that can be queried, by their names on data.world
+TABLES = collections.OrderedDict([
+    ('cleaned_custodial_death_reports', {
+        'dw_project': DW_PROJECT_CDR,
+        'indexes': ['type_of_custody', 'were_the_charges'],
+    }),
+])
+
+# Derived datasets, by name. LIKE is case sensitive (so 'JAIL%' can use the type_of_custody index).
+VIEWS = collections.OrderedDict([
+    # Deaths in jails or private facilities of people who hadn't been convicted (including unknown charges)
+    ('pre_trial_deaths', '''
+        SELECT * FROM cleaned_custodial_death_reports
+        WHERE (type_of_custody LIKE 'JAIL%' OR type_of_custody = 'PRIVATE FACILITY')
+        AND (were_the_charges IS NULL OR were_the_charges != 'CONVICTED')
+    '''),
+])
+
+
+def _intermediate_chunks(name):
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(intermediate_path(name)).iter_batches(batch_size=QUERY_CHUNK_ROWS):
+        yield batch.to_pandas()
+
+
+def table_source(name, dw_project):
+    '''Returns (signature, chunks) for loading a table: a string that changes when the source does,
+    and an iterator of dataframes with its rows.
+    '''
+    if has_intermediate(name):
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            pass
+        else:
+            stat = os.stat(intermediate_path(name))
+            return 'intermediate:%d:%d' % (stat.st_mtime, stat.st_size), _intermediate_chunks(name)
+    data = get_dtw_cache().get(dw_project, name + '.csv')
+    signature = 'dtw:%s' % hashlib.sha256(data).hexdigest()
+    return signature, pd.read_csv(io.BytesIO(data), chunksize=QUERY_CHUNK_ROWS)
+
+
+class QueryDB(object):
+    '''A SQLite database with the cleaned datasets as tables, and the derived datasets as views.
+
+    Args:
+        path: The database file, created if need be
+        tables: See TABLES
+        views: See VIEWS
+    '''
+
+    def __init__(self, path=QUERY_DB_PATH, tables=TABLES, views=VIEWS):
+        self.path = path
+        self.tables = tables
+        self.views = views
+
+    @contextlib.contextmanager
+    def connect(self):
+        '''Yields a connection to the database, committing when done.'''
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute('PRAGMA case_sensitive_like = ON')
+            conn.execute('CREATE TABLE IF NOT EXISTS _sources (name TEXT PRIMARY KEY, signature TEXT)')
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def refresh(self, names=None):
+        '''Reloads the tables (all of them, or those named) whose source has changed, and recreates the views.
+
+        Returns the names of the tables reloaded.
+        '''
+        reloaded = []
+        with self.connect() as conn:
+            for name in names or list(self.tables):
+                signature, chunks = table_source(name, self.tables[name]['dw_project'])
+                stored = conn.execute('SELECT signature FROM _sources WHERE name = ?', (name,)).fetchone()
+                if stored and stored[0] == signature:
+                    continue
+                self._load(conn, name, chunks)
+                conn.execute('INSERT OR REPLACE INTO _sources VALUES (?, ?)', (name, signature))
+                conn.commit()
+                reloaded.append(name)
+            for view, sql in self.views.items():
+                conn.execute('DROP VIEW IF EXISTS "%s"' % view)
+                conn.execute('CREATE VIEW "%s" AS %s' % (view, sql))
+        return reloaded
+
+    def _load(self, conn, name, chunks):
+        conn.execute('DELETE FROM _sources WHERE name = ?', (name,))
+        conn.execute('DROP TABLE IF EXISTS "%s"' % name)
+        rows = 0
+        for chunk in chunks:
+            # Categoricals (from intermediates) are stored as their values
+            chunk = chunk.astype(dict((c, object) for c in chunk.columns if chunk[c].dtype.name == 'category'))
+            chunk.to_sql(name, conn, if_exists='append', index=False)
+            rows += len(chunk)
+        for column in self.tables[name].get('indexes', []):
+            conn.execute('CREATE INDEX "%s_%s" ON "%s" ("%s")' % (name, column, name, column))
+        # Lets the planner know how selective each index is
+        conn.execute('ANALYZE "%s"' % name)
+        print('Loaded %d rows into %s in %s' % (rows, name, self.path))
+
+    def query(self, sql, params=None):
+        '''Returns the result of a SQL query as a dataframe.'''
+        with self.connect() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def materialize(self, view):
+        '''Returns the rows of a view (see VIEWS) as a dataframe.'''
+        if view not in self.views:
+            raise KeyError('Unknown view: %s' % view)
+        return self.query('SELECT * FROM "%s"' % view)
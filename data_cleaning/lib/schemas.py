@@ -0,0 +1,142 @@
+'''Declared column types of each dataset, so readers and cleaning stages are told them rather than guessing.
+
+The raw schemas (CDR_RAW, OIS_CIVILIANS_SHOT_RAW and OIS_OFFICERS_SHOT_RAW) name the columns the
+cleaning stages convert, by the names those columns have at that point: which are dates, ages,
+genders, races and so on. Given them, convert_date_cols and its siblings in cleaning_tools convert
+exactly those columns, instead of picking them by their names.
+
+The output schemas (CDR, OIS_CIVILIANS_SHOT and OIS_OFFICERS_SHOT) declare the cleaned datasets'
+dates, floats and low-cardinality categoricals. They type the Parquet intermediates, and are passed
+to read_csv (as dtype and parse_dates) when the cleaned files are read back from data.world.
+
+Columns with a copy per officer, civilian or report are declared as patterns, e.g. 'officer_age_%d'.
+'''
+
+import re
+
+from lib.cleaning_tools import CleaningError
+
+
+DATE = 'date'
+FLOAT = 'float'
+AGE = 'age'
+GENDER = 'gender'
+RACE = 'race'
+ZIP = 'zip'
+CATEGORY = 'category'
+KINDS = [DATE, FLOAT, AGE, GENDER, RACE, ZIP, CATEGORY]
+
+# What read_csv is told each kind of column holds. Dates are passed as parse_dates instead.
+READ_DTYPES = {FLOAT: 'float64', AGE: 'float64', GENDER: 'category', RACE: 'category', CATEGORY: 'category'}
+
+
+def _pattern(name):
+    return re.compile(r'\d+'.join(re.escape(part) for part in name.split('%d')) + '$')
+
+
+class Schema(object):
+    '''The kinds of a dataset's columns, e.g. Schema(date=['date_incident'], age=['officer_age_%d']).
+
+    Columns of a kind named outright are required: find raises a CleaningError if they're missing.
+    Columns named by a pattern can be absent, or present any number of times.
+    '''
+
+    def __init__(self, **columns):
+        unknown = set(columns) - set(KINDS)
+        if unknown:
+            raise ValueError('Unknown column kinds: %s' % ', '.join(sorted(unknown)))
+        self.columns = columns
+        self.patterns = dict((kind, [_pattern(name) for name in names if '%d' in name])
+                             for kind, names in columns.items())
+
+    def find(self, kind, columns, required=True):
+        '''Returns those of columns (e.g. a dataframe's) that are of the given kind, in their order.'''
+        declared = self.columns.get(kind, [])
+        names = set(name for name in declared if '%d' not in name)
+        missing = sorted(names - set(columns))
+        if missing and required:
+            raise CleaningError('Missing %s columns: %s' % (kind, ', '.join(missing)))
+        patterns = self.patterns.get(kind, [])
+        return [c for c in columns if c in names or any(p.match(c) for p in patterns)]
+
+    def categories(self, columns):
+        '''Returns those of columns stored as categoricals.'''
+        kinds = [kind for kind, dtype in READ_DTYPES.items() if dtype == 'category']
+        found = set(c for kind in kinds for c in self.find(kind, columns, required=False))
+        return [c for c in columns if c in found]
+
+    def read_csv_kwargs(self, header, usecols=None):
+        '''Returns the dtype, parse_dates and usecols arguments to read a CSV with the given header.
+
+        Args:
+            header: The CSV's columns
+            usecols: The columns to read, or None for all of them
+        '''
+        columns = [c for c in header if usecols is None or c in usecols]
+        dtype = {}
+        for kind, kind_dtype in READ_DTYPES.items():
+            for c in self.find(kind, columns, required=False):
+                dtype[c] = kind_dtype
+        kwargs = {'dtype': dtype, 'parse_dates': self.find(DATE, columns, required=False)}
+        if usecols is not None:
+            kwargs['usecols'] = columns
+        return kwargs
+
+
+# Raw data, as each stage sees it
+
+CDR_RAW = Schema(
+    date=['date_of_birth', 'date_time_of_custody_or_incident', 'death_date_and_time', 'entry_date_time',
+          'report_date'],
+    float=['age_at_time_of_death', 'agency_zip', 'custody_date_na', 'entry_date_time_n_a', 'version_number'],
+    gender=['sex'],
+    race=['race'],
+)
+
+OIS_CIVILIANS_SHOT_RAW = Schema(
+    date=['date_ag_received', 'date_incident', 'agency_report_date_%d'],
+    age=['civilian_age', 'officer_age_%d'],
+    gender=['civilian_gender', 'officer_gender_%d'],
+    race=['civilian_race', 'officer_race_%d'],
+)
+
+OIS_OFFICERS_SHOT_RAW = Schema(
+    date=['date_ag_received', 'date_incident'],
+    age=['officer_age', 'civilian_age_%d'],
+    gender=['officer_gender', 'civilian_gender_%d'],
+    race=['officer_race', 'civilian_race_%d'],
+    zip=['incident_zip'],
+)
+
+
+# Cleaned outputs
+
+CDR = Schema(
+    date=['report_date', 'date_time_of_custody_or_incident', 'date_of_birth', 'death_date', 'death_date_and_time',
+          'facility_entry_date_time'],
+    float=['num_revisions', 'age_at_time_of_death', 'days_from_custody_to_death', 'agency_zip'],
+    category=['form_version', 'sex', 'race', 'death_location_type', 'death_from_pre_existing_medical_condition',
+              'manner_of_death', 'means_of_death', 'who_caused_death_in_homicide_or_accident', 'were_the_charges',
+              'type_of_custody', 'specific_type_of_custody_facility'],
+)
+
+OIS_CIVILIANS_SHOT = Schema(
+    date=['date_ag_received', 'date_incident', 'agency_report_date_%d'],
+    float=['civilian_age', 'officer_age_%d', 'num_reports_filed'],
+    category=['civilian_gender', 'civilian_race', 'officer_gender_%d', 'officer_race_%d', 'incident_result_of',
+              'officer_on_duty', 'weapon_reported_by_media_category'],
+)
+
+OIS_OFFICERS_SHOT = Schema(
+    date=['date_ag_received', 'date_incident'],
+    float=['officer_age', 'civilian_age_%d'],
+    category=['officer_gender', 'officer_race', 'officer_harm', 'civilian_harm', 'civilian_gender_%d',
+              'civilian_race_%d'],
+)
+
+# By the cleaned files' names on data.world, as in create_datasets_for_website.ipynb's CONFIGS
+OUTPUT_SCHEMAS = {
+    'cleaned_custodial_death_reports': CDR,
+    'shot_civilians': OIS_CIVILIANS_SHOT,
+    'shot_officers': OIS_OFFICERS_SHOT,
+}
@@ -3,6 +3,12 @@
 Author: Everett Wetchler (everett.wetchler@gmail.com)
 '''
 
+import functools
+import re
+
+import numpy as np
+import pandas as pd
+
 MISSPELLINGS = {
     'ATTYS': 'ATTY',
     'FAMERS': 'FARMERS',
@@ -47,6 +53,9 @@ MULTIWORD_RENAMINGS = {
     'SHERIFFS DEPT': 'SHERIFFS OFFICE',
     'CITY OF': '',
 }
+# All the renamings as a single pass. Longest first, so overlapping keys prefer the longer match.
+MULTIWORD_RENAMINGS_RE = re.compile('|'.join(
+    re.escape(before) for before in sorted(MULTIWORD_RENAMINGS, key=len, reverse=True)))
 
 
 DART = 'DALLAS AREA RAPID TRANSIT POLICE DEPT'
@@ -87,9 +96,19 @@ def clean_punct(word):
     return word
 
 
+# Standardized names are cached across calls (and so across columns and notebooks
+# sharing a kernel), since the same few thousand agencies show up over and over.
+AGENCY_NAME_CACHE_SIZE = 8192
+
+
 def standardize_agency_name(agency):
     if not isinstance(agency, str):
         return None
+    return _standardize_agency_name(agency)
+
+
+@functools.lru_cache(maxsize=AGENCY_NAME_CACHE_SIZE)
+def _standardize_agency_name(agency):
     # Remove whitespace and uppercase
     agency = agency.strip().upper()
     if agency in MANUAL_RENAMINGS:
@@ -102,9 +121,19 @@ def standardize_agency_name(agency):
     parts = ' '.join(parts).split()  # In case any abbreviations are expanded to multiple words.
     parts = reorder_parts(parts)
     agency = ' '.join(parts)
-    for before, after in MULTIWORD_RENAMINGS.items():
-        agency = agency.replace(before, after)
+    agency = MULTIWORD_RENAMINGS_RE.sub(lambda m: MULTIWORD_RENAMINGS[m.group(0)], agency)
     agency = ' '.join([p for p in agency.split() if p and p != '-'])
     if agency.endswith('MARSHALS') or agency.endswith('SHERIFFS'):
         agency = agency + ' OFFICE'
     return agency
+
+
+def standardize_agency_names(agencies):
+    '''Standardizes a series of agency names, normalizing each distinct name only once.
+
+    Equivalent to agencies.apply(standardize_agency_name).
+    '''
+    codes, uniques = pd.factorize(agencies)
+    # The trailing None is what the -1 code that factorize assigns to nulls picks up.
+    lookup = np.array([standardize_agency_name(a) for a in uniques] + [None], dtype=object)
+    return pd.Series(lookup[codes], index=agencies.index, name=agencies.name)
@@ -0,0 +1,179 @@
+'''Shared S3 access for the pipelines and the automation.
+
+Every upload and download goes through one S3Storage (see get_storage), so they share a pooled
+client. Uploads are spooled to a temporary file (on disk past S3_MULTIPART_BYTES) and sent in
+parts when large. They can run in the background on a thread pool, and are skipped when the
+object in S3 already has the same content. That is judged by an MD5 of the body stored in the
+object's metadata, or by its ETag for objects uploaded in a single part.
+
+Set TJI_S3_ENDPOINT_URL to point it at a local S3 stand-in (e.g. a moto server), or pass a
+client of your own to S3Storage.
+'''
+
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+
+S3_ENDPOINT_URL = os.environ.get('TJI_S3_ENDPOINT_URL')
+# How many uploads run at once in the background, and so how many connections the client pools
+S3_MAX_WORKERS = int(os.environ.get('TJI_S3_MAX_WORKERS', 8))
+
+# Objects bigger than this are uploaded in parts, and spooled to disk rather than held in memory.
+S3_MULTIPART_BYTES = 8 * 1024 * 1024
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=S3_MULTIPART_BYTES, multipart_chunksize=S3_MULTIPART_BYTES)
+
+# User metadata key holding the MD5 of an object's body, since multipart ETags aren't MD5s
+MD5_METADATA_KEY = 'content-md5'
+
+
+class S3Storage(object):
+    '''Uploads to and downloads from S3 through a single client.
+
+    Args:
+        client: A boto3 S3 client, or None to create one (pooling max_workers connections)
+        max_workers: How many background uploads run at once
+    '''
+
+    def __init__(self, client=None, max_workers=S3_MAX_WORKERS):
+        self.client = client or boto3.client(
+            's3', endpoint_url=S3_ENDPOINT_URL, config=Config(max_pool_connections=max_workers))
+        self.max_workers = max_workers
+        self._executor = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def upload(self, bucket, key, write, extra_args=None, gzip_encode=False, skip_unchanged=True, background=False):
+        '''Uploads what write(f) writes to the binary file f as an object.
+
+        Args:
+            bucket: The S3 bucket
+            key: The object's key
+            write: Function writing the object's body to a binary file
+            extra_args: e.g. {'ContentType': 'text/csv'} (see boto3's ALLOWED_UPLOAD_ARGS)
+            gzip_encode: Whether to gzip the body, and serve it with Content-Encoding: gzip
+            skip_unchanged: Whether to skip the upload if the object already has this body
+            background: Whether to upload on the thread pool and return right away (see wait)
+
+        Returns:
+            boolean: Whether the object was uploaded (rather than skipped), or with background, a Future
+                of it
+        '''
+        if background:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                future = self._executor.submit(self.upload, bucket, key, write, extra_args=extra_args,
+                                               gzip_encode=gzip_encode, skip_unchanged=skip_unchanged)
+                self._pending.append(future)
+            return future
+
+        extra_args = dict(extra_args or {})
+        if gzip_encode:
+            extra_args['ContentEncoding'] = 'gzip'
+        with tempfile.SpooledTemporaryFile(max_size=S3_MULTIPART_BYTES) as f:
+            if gzip_encode:
+                # mtime=0 keeps the bytes, and so the MD5, the same for the same body
+                with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as out:
+                    write(out)
+            else:
+                write(f)
+            md5 = _file_md5(f)
+            if skip_unchanged and self.stored_md5(bucket, key) == md5:
+                print("Skipping s3://%s/%s, which is unchanged" % (bucket, key))
+                return False
+            extra_args['Metadata'] = dict(extra_args.get('Metadata', {}), **{MD5_METADATA_KEY: md5})
+            f.seek(0)
+            self.client.upload_fileobj(f, bucket, key, ExtraArgs=extra_args, Config=S3_TRANSFER_CONFIG)
+        return True
+
+    def upload_bytes(self, bucket, key, body, **kwargs):
+        '''Uploads bytes as an object. Takes the same keyword arguments as upload.'''
+        return self.upload(bucket, key, lambda f: f.write(body), **kwargs)
+
+    def upload_csv(self, df, bucket, key, **kwargs):
+        '''Uploads a dataframe as a CSV, without its index. Takes the same keyword arguments as upload.'''
+        def write(f):
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            df.to_csv(text, index=False)
+            text.flush()
+            # Leave f open for the upload
+            text.detach()
+
+        extra_args = dict(kwargs.pop('extra_args', None) or {}, ContentType='text/csv')
+        return self.upload(bucket, key, write, extra_args=extra_args, **kwargs)
+
+    def wait(self, futures=None):
+        '''Waits for background uploads, raising the first exception any of them raised.
+
+        Args:
+            futures: The Futures of the uploads to wait for, or None for all of those not waited for yet
+
+        Returns:
+            int: How many objects were uploaded (rather than skipped)
+        '''
+        with self._lock:
+            if futures is None:
+                futures = self._pending
+            self._pending = [f for f in self._pending if f not in futures]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return sum(future.result() for future in futures)
+
+    def download_bytes(self, bucket, key):
+        '''Returns an object's body, decompressed if it was uploaded with gzip_encode.'''
+        response = self.client.get_object(Bucket=bucket, Key=key)
+        body = response['Body'].read()
+        if response.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def stored_md5(self, bucket, key):
+        '''Returns the MD5 (hex) of an object's body as stored, or None if unknown or the object doesn't exist.
+
+        Without s3:ListBucket on the bucket, S3 answers 403 rather than 404 for a missing object, so
+        that counts as unknown too (and the upload goes ahead).
+        '''
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound', '403', 'Forbidden', 'AccessDenied'):
+                return None
+            raise
+        if MD5_METADATA_KEY in head.get('Metadata', {}):
+            return head['Metadata'][MD5_METADATA_KEY]
+        etag = head.get('ETag', '').strip('"')
+        # Multipart ETags look like <md5 of the parts' md5s>-<number of parts>
+        return etag if etag and '-' not in etag else None
+
+
+def _file_md5(f):
+    md5 = hashlib.md5()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    '''Returns the shared S3Storage, configured from the TJI_S3_* environment variables.'''
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = S3Storage()
+    return _storage
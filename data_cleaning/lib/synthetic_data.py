@@ -0,0 +1,188 @@
+'''Seeded synthetic stand-ins for the raw CDR and OIS data, for benchmarking without data.world.
+
+The frames have the real column names (after each notebook's renaming step) and the same
+kinds of mess: inconsistent case and spacing in race, gender and agency strings, ages and
+dates in several formats with the odd unparseable value, and OIS's wide layout with up to
+10 sets of officer_*_N / agency_*_N columns. Values are drawn from pools of distinct values,
+so the number of distinct values per column stays realistic as the row count grows.
+'''
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+AGENCY_WORDS = [
+    'HOUSTON', 'DALLAS', 'harris', 'Travis', 'El Paso', 'Bexar', 'City of', 'County', 'Co.', 'PD', 'SO', 'S.O.',
+    'Police', 'Dept', 'Department', 'Departmnt', "Sheriff's", 'SHERIFFS', 'Office', 'Constable', 'Pct', '1', '2',
+    'Marshal', 'ISD', 'University', 'Dist', '-',
+]
+RACES = [
+    'WHITE', 'White', ' white ', 'W', 'ANGLO', 'Caucasian', 'BLACK', 'Black', 'African American', 'B',
+    'HISPANIC', 'Hispanic or Latino', 'latino', 'Not Hispanic or Latino', 'ASIAN', 'Asian', 'OTHER', 'Other',
+    'American Indian', 'UNKNOWN', '', None,
+]
+GENDERS = ['M', 'm', 'MALE', 'Male', ' male ', 'F', 'f', 'FEMALE', 'Female', 'u', '', None]
+COUNTIES = ['HARRIS', 'DALLAS', 'TARRANT', 'BEXAR', 'TRAVIS', 'EL PASO', 'HIDALGO', 'HARRISON', 'Harris', ' dallas']
+CITIES = ['HOUSTON', 'DALLAS', 'FORT WORTH', 'SAN ANTONIO', 'AUSTIN', 'EL PASO', 'MCALLEN', 'BAYTOWN', 'SPRING']
+FIRST_NAMES = ['JOHN', 'Maria', 'jose', 'JAMES', 'Robert', 'MICHAEL', 'Juan', 'david', 'LINDA', "O'BRIEN", 'Mary-Ann']
+LAST_NAMES = ['SMITH', 'Garcia', 'martinez', 'JOHNSON', 'Rodriguez', 'Williams', 'LOPEZ', 'Brown', 'DE LA CRUZ']
+# None stands for month/day/year without leading zeros, which strftime can't do portably
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', None, '%m/%d/%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%B %d, %Y']
+
+CDR_MANNERS_OF_DEATH = ['NATURAL', 'SUICIDE', 'HOMICIDE', 'ACCIDENTAL', 'PENDING', 'COULD NOT BE DETERMINED']
+CDR_MEANS_OF_DEATH = ['HANGING', 'FIREARM', 'BLUNT INSTRUMENT', 'KNIFE / EDGED INSTRUMENT', 'VEHICLE ACCIDENT',
+                      'NOT APPLICABLE, CAUSE OF DEATH WAS ILLNESS/NATURAL CAUSE', 'OTHER, SPECIFY', None]
+CDR_TYPES_OF_CUSTODY = ['JAIL - COUNTY', 'JAIL - MUNICIPAL', 'PENITENTIARY', 'POLICE CUSTODY (PRE-BOOKING)',
+                        'CUSTODY OF PEACE OFFICER SUBSEQUENT TO ARREST', 'PROBATION/PAROLE', None]
+CDR_DEATH_LOCATIONS = ['COUNTY JAIL', 'MEDICAL FACILITY', 'AT THE CRIME/ARREST SCENE', 'PRISON',
+                       'EN ROUTE TO MEDICAL FACILITY', 'ELSEWHERE, SPECIFY']
+CDR_CHARGES = ['CONVICTED', 'CHARGES PENDING', 'NOT FORMALLY CHARGED', 'CHARGES DROPPED', None]
+OIS_RESULTS = ['DEATH', 'Death', 'INJURY', 'injury ']
+OIS_RESULT_OF = ['EMERGENCY/REQUEST FOR ASSISTANCE', 'TRAFFIC STOP', 'EXECUTION OF A WARRANT',
+                 'HOSTAGE/BARRICADE/OTHER EMERGENCY', 'OTHER']
+MAX_OFFICERS = 10
+
+
+def messy_agency_names(rng, num_distinct=3000):
+    '''Returns num_distinct messy agency names.'''
+    return np.array([' '.join(rng.choice(AGENCY_WORDS, rng.randint(1, 6))) for _ in range(num_distinct)],
+                    dtype=object)
+
+
+def random_agency_names(n, num_distinct=3000, seed=0):
+    '''Returns a series of n messy agency names, drawn from num_distinct distinct ones.'''
+    rng = np.random.RandomState(seed)
+    return pd.Series(rng.choice(messy_agency_names(rng, num_distinct), n))
+
+
+def messy_dates(rng, start, end, num_distinct=5000):
+    '''Returns num_distinct dates between start and end (years), as strings in mixed formats, datetimes, or junk.'''
+    days = rng.randint(0, (datetime.date(end, 1, 1) - datetime.date(start, 1, 1)).days, num_distinct)
+    minutes = rng.randint(0, 24 * 60, num_distinct)
+    formats = rng.choice(np.array(DATE_FORMATS, dtype=object), num_distinct)
+    values = []
+    for day, minute, fmt in zip(days, minutes, formats):
+        dt = datetime.datetime(start, 1, 1) + datetime.timedelta(days=int(day), minutes=int(minute))
+        if rng.rand() < 0.2:
+            values.append(pd.Timestamp(dt))
+        elif fmt is None:
+            values.append('%d/%d/%d' % (dt.month, dt.day, dt.year))
+        else:
+            values.append(dt.strftime(fmt))
+    values[:3] = ['UNKNOWN', 'N/A', None]
+    return np.array(values, dtype=object)
+
+
+def messy_ages(rng):
+    '''Returns a pool of ages: numbers, numeric strings, blanks and the odd unparseable value.'''
+    ages = [int(a) for a in rng.randint(14, 90, 60)]
+    return np.array(ages + [float(a) for a in ages[:20]] + [str(a) for a in ages[:20]] +
+                    [' 45 ', 'UNKNOWN', '', None, np.nan], dtype=object)
+
+
+def messy_names(rng, num_distinct=5000):
+    '''Returns num_distinct full names, with stray punctuation and spacing.'''
+    first = rng.choice(FIRST_NAMES, num_distinct)
+    last = rng.choice(LAST_NAMES, num_distinct)
+    middle = rng.choice(['', 'A.', ' J ', 'Lee,'], num_distinct)
+    return np.array(['%s %s  %s' % (f, m, l) for f, m, l in zip(first, middle, last)], dtype=object)
+
+
+def _choice(rng, pool, n):
+    return rng.choice(np.array(pool, dtype=object), n)
+
+
+def synthetic_cdr(n, seed=0):
+    '''Returns n custodial death reports, as clean_cdr.ipynb has them just after renaming columns.
+
+    Records are split between the 2005 and 2016 form versions, with the columns only one of
+    them has left empty for the other.
+    '''
+    rng = np.random.RandomState(seed)
+    dates = messy_dates(rng, 2005, 2020)
+    names = messy_names(rng)
+    agencies = messy_agency_names(rng)
+    is_2005 = rng.rand(n) < 0.5
+    race = _choice(rng, RACES, n)
+    return pd.DataFrame({
+        'record_id': ['CDR%07d' % i for i in range(n)],
+        'form_version': np.where(is_2005, 'V_2005', 'V_2016'),
+        'report_date': _choice(rng, dates, n),
+        'date_time_of_custody_or_incident': _choice(rng, dates, n),
+        'death_date_and_time': _choice(rng, dates, n),
+        'date_of_birth': _choice(rng, messy_dates(rng, 1930, 2004), n),
+        'name_full': _choice(rng, names, n),
+        'age_at_time_of_death': _choice(rng, messy_ages(rng), n),
+        'sex': _choice(rng, GENDERS, n),
+        # Which of race and ethnicity is filled in depends on the form version
+        'race': np.where(is_2005, race, None),
+        'ethnicity': np.where(is_2005, None, race),
+        'manner_of_death': _choice(rng, CDR_MANNERS_OF_DEATH, n),
+        'means_of_death': _choice(rng, CDR_MEANS_OF_DEATH, n),
+        'type_of_custody': _choice(rng, CDR_TYPES_OF_CUSTODY, n),
+        'death_location_type': _choice(rng, CDR_DEATH_LOCATIONS, n),
+        'death_location_county': _choice(rng, COUNTIES, n),
+        'death_location_city': _choice(rng, CITIES, n),
+        'were_the_charges': _choice(rng, CDR_CHARGES, n),
+        'agency_name': _choice(rng, agencies, n),
+        'agency_county': _choice(rng, COUNTIES + [None], n),
+    })
+
+
+def synthetic_ois(n, seed=0):
+    '''Returns n OIS civilians-shot reports, as clean_ois_civilians_shot.ipynb has them after renaming columns.
+
+    Each report has 1 to MAX_OFFICERS officers, fewer being more likely; the officer_*_N and
+    agency_*_N columns past a report's last officer are empty.
+    '''
+    rng = np.random.RandomState(seed)
+    dates = messy_dates(rng, 2015, 2020)
+    names = messy_names(rng)
+    agencies = messy_agency_names(rng)
+    num_officers = np.minimum(rng.geometric(0.6, n), MAX_OFFICERS)
+    df = pd.DataFrame({
+        'ois_report_no': ['%d-%04d' % (2015 + i % 6, i % 10000) for i in range(n)],
+        'num_reports_filed': num_officers,
+        'date_ag_received': _choice(rng, dates, n),
+        'date_incident': _choice(rng, dates, n),
+        'civilian_name_full': _choice(rng, names, n),
+        'civilian_gender': _choice(rng, GENDERS, n),
+        'civilian_age': _choice(rng, messy_ages(rng), n),
+        'civilian_race': _choice(rng, RACES, n),
+        'incident_address': ['%d MAIN ST' % i for i in rng.randint(1, 5000, n)],
+        'incident_city': _choice(rng, CITIES, n),
+        'incident_county': _choice(rng, COUNTIES, n),
+        'incident_resulted_in': _choice(rng, OIS_RESULTS, n),
+        'incident_result_of': _choice(rng, OIS_RESULT_OF, n),
+        'deadly_weapon': _choice(rng, ['YES', 'Yes', 'NO', 'no '], n),
+    })
+    ages = messy_ages(rng)
+    for i in range(1, MAX_OFFICERS + 1):
+        present = num_officers >= i
+        for col, pool in (('officer_age_%d', ages), ('officer_race_%d', RACES), ('officer_gender_%d', GENDERS),
+                          ('agency_name_%d', agencies), ('agency_city_%d', CITIES),
+                          ('agency_county_%d', COUNTIES), ('agency_report_date_%d', dates)):
+            df[col % i] = np.where(present, _choice(rng, pool, n), None)
+    return df
+
+
+def synthetic_website_frame(n, seed=0):
+    '''Returns n cleaned CDR records with the columns create_datasets_for_website.ipynb keeps.'''
+    rng = np.random.RandomState(seed)
+    ages = rng.randint(14, 90, n).astype(float)
+    ages[rng.rand(n) < 0.05] = np.nan
+    return pd.DataFrame({
+        'record_id': ['CDR%07d' % i for i in range(n)],
+        'year': rng.randint(2005, 2021, n),
+        'race': _choice(rng, ['WHITE', 'BLACK', 'HISPANIC', 'OTHER', None], n),
+        'sex': _choice(rng, ['MALE', 'FEMALE', None], n),
+        'manner_of_death': _choice(rng, CDR_MANNERS_OF_DEATH, n),
+        'age_at_time_of_death': ages,
+        'type_of_custody': _choice(rng, CDR_TYPES_OF_CUSTODY, n),
+        'death_location_type': _choice(rng, CDR_DEATH_LOCATIONS, n),
+        'means_of_death': _choice(rng, CDR_MEANS_OF_DEATH, n),
+        'death_location_county': _choice(rng, COUNTIES, n),
+        'agency_name': _choice(rng, messy_agency_names(rng, 1500), n),
+    })
@@ -0,0 +1,5 @@
+'''Makes lib importable when the tests are run from the repo root or from data_cleaning/.'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,94 @@
+'''Checks the vectorized *_series helpers in lib/cleaning_tools.py against Series.apply of their scalar versions.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.cleaning_tools import (
+    CleaningError, standardize_gender, standardize_gender_series, standardize_name, standardize_name_series,
+    standardize_race, standardize_race_series, upcase_strip_series)
+
+
+CORPUS_SIZE = 5000
+
+# Spellings seen in the raw data, and near misses the scalar versions sort differently
+RACES = ['White', 'WHITE', 'Anglo', 'caucasian', 'AO', 'ao', 'Black', 'African American', 'BLACK/AFRICAN AMERICAN',
+         'Hispanic', 'Latino', 'Hispanic or Latino', 'Non Hispanic', 'not hispanic white', 'Asian', 'Other', 'Unknown']
+GENDERS = ['M', 'F', 'm', 'f', 'Male', 'FEMALE', 'man', 'Woman', 'U', 'u']
+NAMES = ['John', 'JOHN', 'Mary Ann', "O'Brien", 'Smith-Jones', 'J.R.', 'de la Cruz', 'Jr.', '  Lee  ', 'Ng', 'Ramírez']
+AGENCY_WORDS = ['Houston Police Dept', 'harris co sheriff', 'Dallas PD', 'TEXAS DPS', 'Austin  ISD']
+
+
+def upcase_strip(x):
+    return x if not isinstance(x, str) else x.strip().upper()
+
+
+def corpus(pool, seed=0, categorical=False):
+    '''A seeded series drawn from pool, with missing values, stray whitespace and an index that isn't 0..n.'''
+    rng = np.random.RandomState(seed)
+    pool = list(pool) + [None, np.nan, '', '   ']
+    pool += [' %s ' % v for v in pool if isinstance(v, str) and v.strip()]
+    values = rng.choice(np.array(pool, dtype=object), CORPUS_SIZE)
+    series = pd.Series(values, index=rng.permutation(CORPUS_SIZE) + 100, name='col')
+    return series.astype('category') if categorical else series
+
+
+def assert_parity(vectorized, scalar, series):
+    pd.testing.assert_series_equal(vectorized(series), series.apply(scalar))
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_race_parity(categorical):
+    assert_parity(standardize_race_series, standardize_race, corpus(RACES, categorical=categorical))
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_gender_parity(categorical):
+    assert_parity(standardize_gender_series, standardize_gender, corpus(GENDERS, categorical=categorical))
+
+
+def test_name_parity():
+    names = NAMES + ["O'BRIEN", 'Mary-Ann', '---', 3, 4.5]
+    assert_parity(standardize_name_series, standardize_name, corpus(names))
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_upcase_strip_parity(categorical):
+    pool = AGENCY_WORDS + NAMES
+    if not categorical:
+        # Non-strings are left as they are
+        pool = pool + [21, 35.0, -1, 101.5]
+    assert_parity(upcase_strip_series, upcase_strip, corpus(pool, categorical=categorical))
+
+
+def test_upcase_strip_leaves_numbers_and_dates():
+    for series in [pd.Series([1.5, np.nan]), pd.Series(pd.to_datetime(['2020-01-01', None]))]:
+        assert upcase_strip_series(series) is series
+
+
+def test_empty_series():
+    empty = pd.Series([], dtype=object)
+    for vectorized, scalar in [(standardize_race_series, standardize_race),
+                               (standardize_gender_series, standardize_gender),
+                               (standardize_name_series, standardize_name), (upcase_strip_series, upcase_strip)]:
+        assert len(vectorized(empty)) == 0
+
+
+def test_unrecognized_gender_raises_the_same_error():
+    series = corpus(GENDERS + ['Unknown gender', 'x'])
+    with pytest.raises(CleaningError) as scalar_error:
+        series.apply(standardize_gender)
+    with pytest.raises(CleaningError) as vectorized_error:
+        standardize_gender_series(series)
+    assert str(vectorized_error.value) == str(scalar_error.value)
+
+
+def test_non_string_race_raises_like_the_scalar_version():
+    series = pd.Series(['WHITE', 3, 'black'])
+    with pytest.raises(AttributeError):
+        series.apply(standardize_race)
+    with pytest.raises(AttributeError):
+        standardize_race_series(series)
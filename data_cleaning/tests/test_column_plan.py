@@ -0,0 +1,51 @@
+'''Checks that ColumnPlan gives the same columns as insert_col_after, drop and reorder_columns_and_check.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import pandas as pd
+import pytest
+
+from lib.cleaning_tools import CleaningError, ColumnPlan, insert_col_after, reorder_columns_and_check
+
+
+def frame():
+    return pd.DataFrame({'a': [1, 2], 'b': ['x', 'y'], 'c': [3.0, 4.0]}, index=[7, 8])
+
+
+def test_matches_the_step_by_step_functions():
+    df = frame()
+    full = pd.Series([10, 20], index=[7, 8])
+    expected = insert_col_after(frame(), full, 'd', 'a')
+    expected = insert_col_after(expected, full * 2, 'e', 'd')
+    expected = reorder_columns_and_check(expected.drop(['b'], axis=1), ['e', 'a', 'd', 'c'])
+
+    plan = ColumnPlan(df).insert_after(full, 'd', 'a').insert_after(full * 2, 'e', 'd').drop(['b'])
+    result = plan.reorder(['e', 'a', 'd', 'c']).apply()
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_does_not_modify_the_frame():
+    df = frame()
+    result = ColumnPlan(df).insert_after([5, 6], 'd', 'a').apply()
+    pd.testing.assert_frame_equal(df, frame())
+    result['a'] = 0
+    pd.testing.assert_frame_equal(df, frame())
+
+
+def test_insert_overwrites_an_existing_column():
+    df = frame()
+    result = ColumnPlan(df).insert_after([5, 6], 'c', 'a').apply()
+    assert list(result.columns) == ['a', 'c', 'b']
+    assert list(result['c']) == [5, 6]
+    assert list(df['c']) == [3.0, 4.0]
+
+
+def test_reorder_checks_planned_columns():
+    plan = ColumnPlan(frame()).insert_after([5, 6], 'd', 'a').drop(['b'])
+    with pytest.raises(CleaningError):
+        plan.reorder(['a', 'b', 'c', 'd'])
+    with pytest.raises(CleaningError):
+        plan.reorder(['a', 'c'])
+    with pytest.raises(CleaningError):
+        ColumnPlan(frame()).drop(['z'])
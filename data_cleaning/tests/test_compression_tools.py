@@ -0,0 +1,203 @@
+'''Checks the website's compressed datasets against the notebook functions they replaced, and how they're written.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import gzip
+import io
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lib.compression_tools as compression_tools
+from lib.compression_tools import (
+    SIDECAR_MAGIC, SIDECAR_VERSION, compress_new, compress_original, encode_cube, encode_new, encode_original,
+    open_encoded, write_codes_sidecar, write_compact_json
+)
+
+
+def notebook_compress_original(df, id_col=None):
+    '''compress_original as create_datasets_for_website.ipynb used to define it.'''
+    js = {
+        'meta': {
+            'num_columns': len(df.columns),
+            'num_records': len(df),
+            'lookups': {},
+        },
+        'records': {},
+    }
+    if id_col:
+        js['meta']['record_ids'] = {
+            'field_name': id_col,
+            'values': list(df[id_col])
+        }
+        df = df.drop(id_col, axis=1)
+    for col in df.columns:
+        values = sorted(list(set(df[col].dropna())))
+        mapping = dict((v, i) for i, v in enumerate(values))
+        js['meta']['lookups'][col] = values
+        js['records'][col] = df[col].apply(lambda x: -1 if pd.isnull(x) else mapping[x]).tolist()
+
+    return js
+
+
+def notebook_compress_new(df, id_col=None):
+    '''compress_new as create_datasets_for_website.ipynb used to define it.'''
+    def get_age_group(age):
+        if age == 'not given':
+            return age
+        elif age < 18:
+            return 'under 18'
+        elif age < 30:
+            return '18 to 29'
+        elif age < 40:
+            return '30 to 39'
+        elif age < 50:
+            return '40 to 49'
+        elif age < 60:
+            return '50 to 59'
+        else:
+            return '60 and up'
+
+    js = {'records': {}}
+    if id_col:
+        df = df.drop(id_col, axis=1)
+    for col in df.columns:
+        js['records'][col] = df[col].fillna('not given').tolist()
+        if col in ('age_at_time_of_death', 'civilian_age', 'officer_age'):
+            js['records']['age_group'] = df[col].apply(lambda x: get_age_group(x)).tolist()
+
+    return js
+
+
+def slim_frame():
+    '''A frame like create_one compresses: ids, years, strings and ages with missing values.'''
+    return pd.DataFrame({
+        'record_id': [1005, 1001, 1003, 1002, 1004, 1006, 1007],
+        'year': [2019, 2020, 2019, 2021, 2020, 2020, 2018],
+        'race': ['WHITE', np.nan, 'BLACK', 'WHITE', 'HISPANIC', np.nan, 'OTHER'],
+        'age_at_time_of_death': [17.0, 18.0, 60.0, np.nan, 29.0, 59.0, 45.0],
+        'officer_age': [np.nan, 40.0, 30.0, 17.0, 61.0, 18.0, np.nan],
+        'agency_name': ['B PD', 'A PD', 'B PD', np.nan, 'C SO', 'A PD', 'C SO'],
+    }, columns=['record_id', 'year', 'race', 'age_at_time_of_death', 'officer_age', 'agency_name'])
+
+
+def test_compress_original_matches_notebook():
+    df = slim_frame()
+    compressed = compress_original(df, id_col='record_id')
+    assert json.dumps(compressed) == json.dumps(notebook_compress_original(df, id_col='record_id'))
+    assert compressed['meta']['record_ids'] == {'field_name': 'record_id', 'values': list(df['record_id'])}
+    assert compressed['records']['race'] == [3, -1, 0, 3, 1, -1, 2]
+
+
+def test_compress_original_without_ids_matches_notebook():
+    df = slim_frame().drop('record_id', axis=1)
+    assert json.dumps(compress_original(df)) == json.dumps(notebook_compress_original(df))
+
+
+def test_compress_new_matches_notebook():
+    df = slim_frame()
+    compressed = compress_new(df, id_col='record_id')
+    assert json.dumps(compressed) == json.dumps(notebook_compress_new(df, id_col='record_id'))
+    records = compressed['records']
+    assert records['race'][1] == 'not given'
+    # With two age columns, the last one's groups win
+    assert records['age_group'] == ['60 and up', '40 to 49', '30 to 39', 'under 18', '60 and up', '18 to 29',
+                                    '60 and up']
+    assert 'record_id' not in records
+
+
+def test_missing_age_is_60_and_up():
+    df = pd.DataFrame({'civilian_age': [17.0, 18.0, 60.0, np.nan]})
+    compressed = compress_new(df)
+    assert json.dumps(compressed) == json.dumps(notebook_compress_new(df))
+    assert compressed['records']['age_group'] == ['under 18', '18 to 29', '60 and up', '60 and up']
+    assert compressed['records']['civilian_age'] == [17.0, 18.0, 60.0, 'not given']
+
+
+def streamed(obj, encoding=None):
+    f = io.BytesIO()
+    with open_encoded(f, encoding) as out:
+        write_compact_json(obj, out)
+    return f.getvalue()
+
+
+def encoded_outputs():
+    df = slim_frame()
+    return [
+        (encode_original(df, id_col='record_id'), compress_original(df, id_col='record_id')),
+        (encode_new(df, id_col='record_id'), compress_new(df, id_col='record_id')),
+    ]
+
+
+@pytest.mark.parametrize('chunk_size', [2, 100000])
+def test_streamed_json_matches(monkeypatch, chunk_size):
+    monkeypatch.setattr(compression_tools, 'JSON_CHUNK_SIZE', chunk_size)
+    for encoded, compressed in encoded_outputs():
+        data = streamed(encoded)
+        assert json.loads(data.decode('utf-8')) == compressed
+        assert data.decode('utf-8') == json.dumps(compressed, separators=(',', ':'))
+
+
+def test_streamed_cube_matches():
+    cube = encode_cube(slim_frame(), ['year', 'race', 'officer_age'])
+    loaded = json.loads(streamed(cube).decode('utf-8'))
+    assert loaded['meta']['dimensions'] == ['year', 'race', 'age_group']
+    assert loaded['cells'] == dict((k, v.tolist()) for k, v in cube['cells'].items())
+    assert sum(loaded['cells']['count']) == len(slim_frame())
+
+
+def test_streamed_gzip_matches():
+    for encoded, compressed in encoded_outputs():
+        data = streamed(encoded, 'gzip')
+        assert json.loads(gzip.decompress(data).decode('utf-8')) == compressed
+        # The same content always gives the same bytes, so unchanged uploads can be skipped
+        assert streamed(encoded, 'gzip') == data
+
+
+def test_streamed_brotli_matches():
+    brotli = pytest.importorskip('brotli')
+    for encoded, compressed in encoded_outputs():
+        assert json.loads(brotli.decompress(streamed(encoded, 'br')).decode('utf-8')) == compressed
+
+
+def test_unknown_encoding_raises():
+    with pytest.raises(ValueError):
+        streamed({}, 'zip')
+
+
+def read_sidecar(data):
+    '''Reads the output of write_codes_sidecar back into (meta, records), as the website would.'''
+    assert data[:4] == SIDECAR_MAGIC
+    version, header_len = struct.unpack('<II', data[4:12])
+    assert version == SIDECAR_VERSION
+    header = json.loads(data[12:(12 + header_len)].decode('utf-8'))
+    records = {}
+    for column in header.pop('columns'):
+        assert column['offset'] % 8 == 0
+        dtype = np.dtype(column['dtype']).newbyteorder('<')
+        records[column['name']] = (dtype, np.frombuffer(data, dtype=dtype, count=column['length'],
+                                                        offset=column['offset']))
+    return header, records
+
+
+def test_sidecar_round_trips():
+    df = pd.concat([slim_frame()] * 30, ignore_index=True)
+    df['record_id'] = np.arange(len(df))
+    # Enough distinct values to need 16-bit codes
+    df['name'] = ['NAME %d' % i for i in range(len(df))]
+    df.loc[::7, 'name'] = np.nan
+    compressed = compress_original(df, id_col='record_id')
+    f = io.BytesIO()
+    write_codes_sidecar(encode_original(df, id_col='record_id'), f)
+    meta, records = read_sidecar(f.getvalue())
+
+    assert meta == compressed['meta']
+    assert sorted(records) == sorted(compressed['records'])
+    for name, (dtype, codes) in records.items():
+        assert codes.tolist() == compressed['records'][name]
+    assert records['race'][0] == np.int8
+    assert records['name'][0] == np.int16
@@ -0,0 +1,136 @@
+'''Checks DtwCache's revalidation, eviction and offline use against a fake data.world client.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import collections
+
+import pytest
+
+from lib.cleaning_tools import CleaningError, DtwCache
+
+
+FakeDataset = collections.namedtuple('FakeDataset', ['raw_data'])
+
+
+class FakeDtwClient(object):
+    '''Stands in for DtwClient, serving projects from a dict and counting requests.
+
+    version_error: An exception project_version raises, e.g. an OSError for no network
+    '''
+
+    def __init__(self, projects):
+        # project_key -> (version, {filename: bytes})
+        self.projects = dict(projects)
+        self.version_error = None
+        self.version_requests = 0
+        self.downloads = []
+
+    def project_version(self, project_key):
+        self.version_requests += 1
+        if self.version_error is not None:
+            raise self.version_error
+        return self.projects[project_key][0]
+
+    def load_dataset(self, project_key, force_update):
+        self.downloads.append((project_key, force_update))
+        return FakeDataset(dict(self.projects[project_key][1]))
+
+
+def make_cache(tmp_path, client, **kwargs):
+    kwargs.setdefault('revalidate_seconds', 0)
+    return DtwCache(cache_dir=str(tmp_path / 'cache'), client=client, **kwargs)
+
+
+def test_downloads_only_when_the_version_changes(tmp_path):
+    client = FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1', 'y.csv': b'2'})})
+    cache = make_cache(tmp_path, client)
+    assert cache.get('tji/a', 'x.csv') == b'1'
+    assert cache.get('tji/a', 'y.csv') == b'2'
+    assert cache.get('tji/a', 'x.csv') == b'1'
+    assert client.downloads == [('tji/a', True)]
+    assert client.version_requests == 3
+
+    client.projects['tji/a'] = ('v2', {'x.csv': b'11', 'y.csv': b'2'})
+    assert cache.get('tji/a', 'x.csv') == b'11'
+    assert len(client.downloads) == 2
+    # Another process sharing the cache directory sees the new version too
+    assert make_cache(tmp_path, client).get('tji/a', 'x.csv') == b'11'
+    assert len(client.downloads) == 2
+
+
+def test_versions_are_remembered_for_revalidate_seconds(tmp_path):
+    client = FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1'})})
+    cache = make_cache(tmp_path, client, revalidate_seconds=3600)
+    cache.get('tji/a', 'x.csv')
+    cache.get('tji/a', 'x.csv')
+    assert client.version_requests == 1
+
+    client.projects['tji/a'] = ('v2', {'x.csv': b'2'})
+    assert cache.get('tji/a', 'x.csv') == b'1'
+    cache.forget_version('tji/a')
+    assert cache.get('tji/a', 'x.csv') == b'2'
+    assert client.version_requests == 2
+
+
+def test_missing_file_raises(tmp_path):
+    cache = make_cache(tmp_path, FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1'})}))
+    with pytest.raises(CleaningError, match='No file'):
+        cache.get('tji/a', 'nope.csv')
+
+
+def test_evicts_least_recently_used_files(tmp_path):
+    client = FakeDtwClient({
+        'tji/a': ('v1', {'a.csv': b'a' * 6}),
+        'tji/b': ('v1', {'b.csv': b'b' * 6}),
+    })
+    cache = make_cache(tmp_path, client, max_bytes=10)
+    cache.get('tji/a', 'a.csv')
+    cache.get('tji/b', 'b.csv')
+    index = cache._read_index()
+    assert sorted(index['files']) == ['tji/b/b.csv']
+    assert len(list((tmp_path / 'cache' / 'blobs').iterdir())) == 1
+
+    assert cache.get('tji/a', 'a.csv') == b'a' * 6
+    assert client.downloads == [('tji/a', True), ('tji/b', True), ('tji/a', True)]
+
+
+def test_offline_reads_only_the_cache(tmp_path):
+    client = FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1'})})
+    make_cache(tmp_path, client).get('tji/a', 'x.csv')
+    client.projects['tji/a'] = ('v2', {'x.csv': b'2'})
+    offline = make_cache(tmp_path, client, offline=True)
+    assert offline.get('tji/a', 'x.csv') == b'1'
+    with pytest.raises(CleaningError, match='Offline'):
+        offline.get('tji/b', 'x.csv')
+    assert client.version_requests == 1
+    assert len(client.downloads) == 1
+
+
+def test_network_errors_fall_back_to_cached_files(tmp_path):
+    client = FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1'})})
+    cache = make_cache(tmp_path, client)
+    cache.get('tji/a', 'x.csv')
+    client.version_error = OSError('Connection refused')
+    with pytest.warns(UserWarning, match='Could not reach data.world'):
+        assert cache.get('tji/a', 'x.csv') == b'1'
+    assert len(client.downloads) == 1
+
+
+def test_other_errors_revalidating_are_raised(tmp_path):
+    client = FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1'})})
+    cache = make_cache(tmp_path, client)
+    cache.get('tji/a', 'x.csv')
+    client.version_error = KeyError('updated')
+    with pytest.raises(KeyError):
+        cache.get('tji/a', 'x.csv')
+
+
+def test_load_dataset_forces_an_update_only_when_changed(tmp_path):
+    client = FakeDtwClient({'tji/a': ('v1', {'x.csv': b'1'})})
+    cache = make_cache(tmp_path, client)
+    cache.load_dataset('tji/a')
+    cache.load_dataset('tji/a')
+    client.projects['tji/a'] = ('v2', {'x.csv': b'2'})
+    cache.load_dataset('tji/a')
+    assert client.downloads == [('tji/a', True), ('tji/a', False), ('tji/a', True)]
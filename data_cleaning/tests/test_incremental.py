@@ -0,0 +1,105 @@
+'''Checks that incremental cleaning reuses only unchanged rows, and gives the same result as cleaning everything.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import pandas as pd
+import pytest
+
+import lib.incremental as incremental
+from lib.incremental import merge_incremental, plan_incremental, with_raw_index
+
+
+NAME = 'cleaned.csv'
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(incremental, 'INCREMENTAL_DIR', str(tmp_path))
+
+
+def raw_rows():
+    return pd.DataFrame({
+        'report': ['A', 'B', 'B', 'C', 'D'],
+        'name': ['ann', 'bob', 'bea', 'cal', ''],
+        'age': ['20', '31', '32', '43', '54'],
+    }, index=[10, 11, 12, 13, 14])
+
+
+def clean(rows, calls):
+    '''A stand-in for a pipeline's row-local steps, recording which rows it was given. Drops empty names.'''
+    calls.append(list(rows['name']))
+    rows = rows[rows['name'] != '']
+    return rows.assign(name=rows['name'].str.upper(), age=rows['age'].astype(int))
+
+
+def run(raw, context='ctx', enabled=True):
+    calls = []
+    plan = plan_incremental(raw, 'report', NAME, context=context, enabled=enabled)
+    return merge_incremental(clean(plan.to_clean, calls), plan), plan, calls
+
+
+def test_first_run_cleans_everything():
+    merged, plan, calls = run(raw_rows())
+    assert calls == [['ann', 'bob', 'bea', 'cal', '']]
+    assert list(merged.index) == ['A#0', 'B#0', 'B#1', 'C#0']
+    assert list(merged['name']) == ['ANN', 'BOB', 'BEA', 'CAL']
+    assert len(plan.reused) == 0
+
+
+def test_unchanged_rows_are_reused():
+    run(raw_rows())
+    raw = raw_rows()
+    raw.loc[12, 'age'] = '33'  # changed: the second row keyed 'B'
+    raw = raw.drop(13)  # deleted
+    raw = pd.concat([raw, pd.DataFrame({'report': ['B', 'E'], 'name': ['ben', 'eve'], 'age': ['60', '70']},
+                                       index=[15, 16])])  # new: a third 'B' row, and a new key
+    merged, plan, calls = run(raw)
+
+    assert calls == [['bea', 'ben', 'eve']]
+    assert sorted(plan.reused.index) == ['A#0', 'B#0']
+    assert plan.deleted == ['C#0']
+    # The dropped empty row isn't reused, and isn't cleaned again as it hasn't changed
+    assert 'D#0' not in merged.index
+    full, _, _ = run(raw, enabled=False)
+    pd.testing.assert_frame_equal(merged, full)
+    assert list(merged.index) == ['A#0', 'B#0', 'B#1', 'B#2', 'E#0']
+    assert list(merged['age']) == [20, 31, 33, 60, 70]
+
+
+def test_reordered_duplicate_keys_are_changed_rows():
+    run(raw_rows())
+    raw = raw_rows().loc[[10, 12, 11, 13, 14]]
+    merged, _, calls = run(raw)
+    assert calls == [['bea', 'bob']]
+    assert list(merged.loc[['B#0', 'B#1'], 'name']) == ['BEA', 'BOB']
+
+
+def test_context_change_cleans_everything():
+    run(raw_rows())
+    _, plan, calls = run(raw_rows(), context='other')
+    assert calls == [['ann', 'bob', 'bea', 'cal', '']]
+    assert len(plan.reused) == 0
+
+
+def test_raw_column_change_cleans_everything():
+    run(raw_rows())
+    _, _, calls = run(raw_rows().assign(extra=1))
+    assert len(calls[0]) == 5
+
+
+def test_disabled_cleans_everything_but_saves_state():
+    run(raw_rows(), enabled=False)
+    _, plan, calls = run(raw_rows())
+    # At least one row is always cleaned
+    assert calls == [['ann']]
+    assert len(plan.reused) == 3
+
+
+def test_with_raw_index():
+    run(raw_rows())
+    raw = raw_rows()
+    raw.loc[11, 'age'] = '35'
+    merged, plan, _ = run(raw)
+    assert list(with_raw_index(merged, plan).index) == [10, 11, 12, 13]
+    assert list(merged.index) == ['A#0', 'B#0', 'B#1', 'C#0']
@@ -0,0 +1,76 @@
+'''Checks that a Parquet intermediate holds the same values as the CSV output it stands in for.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.cleaning_tools import to_intermediate_frame
+from lib.schemas import Schema
+
+pytest.importorskip('pyarrow')
+
+
+SCHEMA = Schema(date=['date_incident'], float=['civilian_age'], race=['civilian_race'], category=['agency_county'])
+
+
+def cleaned_frame():
+    '''A cleaned dataset as a stage might leave it: blanks, NA-like strings and mixed types in object columns.'''
+    return pd.DataFrame({
+        'date_incident': pd.to_datetime(['2020-01-01', None, '2020-03-04', '2021-12-31', '2019-07-04', None]),
+        'civilian_age': [21.0, np.nan, 35.0, 40.0, 18.0, 60.0],
+        'civilian_race': ['WHITE', '', 'BLACK', None, 'WHITE', 'HISPANIC'],
+        'agency_county': ['HARRIS', 'HARRIS', 77, '', 'DALLAS', np.nan],
+        'civilian_name_full': ['A B', '', 'NA', 'C D', 'E F', None],
+        'agency_zip': [77001, '77002', None, 77003, 'N/A', 77004],
+        'notes': ['x', 'x', 'x', '', 'y', 'y'],
+    }, index=[5, 4, 3, 2, 1, 0])
+
+
+def from_csv(df, schema):
+    buf = io.StringIO()
+    df.to_csv(buf, index=False)
+    kwargs = schema.read_csv_kwargs(list(df.columns)) if schema is not None else {'parse_dates': ['date_incident']}
+    buf.seek(0)
+    return pd.read_csv(buf, **kwargs)
+
+
+def from_parquet(df, schema):
+    buf = io.BytesIO()
+    to_intermediate_frame(df, schema).to_parquet(buf, index=False)
+    buf.seek(0)
+    return pd.read_parquet(buf)
+
+
+def as_objects(df):
+    '''Compares categoricals by their values, and missing strings as NaN (Parquet reads them back as None).'''
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == object or isinstance(df[c].dtype, pd.api.types.CategoricalDtype):
+            df[c] = df[c].astype(object).where(df[c].notnull(), np.nan)
+    return df
+
+
+def test_parquet_matches_csv_with_schema():
+    df = cleaned_frame()
+    parquet = from_parquet(df, SCHEMA)
+    csv = from_csv(df, SCHEMA)
+    pd.testing.assert_frame_equal(as_objects(parquet), as_objects(csv))
+    for c in SCHEMA.categories(df.columns):
+        assert isinstance(parquet[c].dtype, pd.api.types.CategoricalDtype)
+        assert sorted(parquet[c].cat.categories) == sorted(csv[c].cat.categories)
+
+
+def test_parquet_matches_csv_without_schema():
+    df = cleaned_frame()
+    pd.testing.assert_frame_equal(as_objects(from_parquet(df, None)), as_objects(from_csv(df, None)))
+
+
+def test_does_not_modify_the_frame():
+    df = cleaned_frame()
+    to_intermediate_frame(df, SCHEMA)
+    pd.testing.assert_frame_equal(df, cleaned_frame())
@@ -0,0 +1,137 @@
+'''Checks S3Storage's uploads, skipping of unchanged objects and background uploads against a fake S3 client.
+
+Run from the repo root or data_cleaning/ with: python -m pytest data_cleaning/tests
+'''
+
+import gzip
+import hashlib
+import io
+import threading
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+from lib.storage import MD5_METADATA_KEY, S3Storage  # noqa: E402
+
+
+BUCKET = 'bucket'
+
+
+class FakeS3Client(object):
+    '''The parts of a boto3 S3 client S3Storage uses, keeping objects in a dict.
+
+    head_error: An error code head_object answers with for every key, e.g. '403'
+    '''
+
+    def __init__(self, head_error=None):
+        self.objects = {}
+        self.uploads = []
+        self.head_error = head_error
+        self.lock = threading.Lock()
+
+    def upload_fileobj(self, f, bucket, key, ExtraArgs=None, Config=None):
+        with self.lock:
+            self.objects[(bucket, key)] = (f.read(), dict(ExtraArgs or {}))
+            self.uploads.append(key)
+
+    def _get(self, bucket, key, operation):
+        if (bucket, key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+        return self.objects[(bucket, key)]
+
+    def head_object(self, Bucket, Key):
+        if self.head_error:
+            raise ClientError({'Error': {'Code': self.head_error, 'Message': 'Error'}}, 'HeadObject')
+        body, args = self._get(Bucket, Key, 'HeadObject')
+        head = {'ETag': '"%s"' % hashlib.md5(body).hexdigest(), 'Metadata': args.get('Metadata', {})}
+        if 'ContentEncoding' in args:
+            head['ContentEncoding'] = args['ContentEncoding']
+        return head
+
+    def get_object(self, Bucket, Key):
+        body, args = self._get(Bucket, Key, 'GetObject')
+        response = {'Body': io.BytesIO(body)}
+        if 'ContentEncoding' in args:
+            response['ContentEncoding'] = args['ContentEncoding']
+        return response
+
+
+def test_upload_and_skip_unchanged():
+    client = FakeS3Client()
+    storage = S3Storage(client=client)
+    assert storage.upload_bytes(BUCKET, 'a.json', b'{"a":1}', extra_args={'ContentType': 'application/json'})
+    body, args = client.objects[(BUCKET, 'a.json')]
+    assert body == b'{"a":1}'
+    assert args['ContentType'] == 'application/json'
+    assert args['Metadata'][MD5_METADATA_KEY] == hashlib.md5(body).hexdigest()
+
+    assert not storage.upload_bytes(BUCKET, 'a.json', b'{"a":1}')
+    assert storage.upload_bytes(BUCKET, 'a.json', b'{"a":2}')
+    assert storage.upload_bytes(BUCKET, 'a.json', b'{"a":2}', skip_unchanged=False)
+    assert client.uploads == ['a.json'] * 3
+    assert storage.download_bytes(BUCKET, 'a.json') == b'{"a":2}'
+
+
+def test_skip_by_etag_without_metadata():
+    client = FakeS3Client()
+    client.objects[(BUCKET, 'old.csv')] = (b'a,b\n1,2\n', {})
+    assert not S3Storage(client=client).upload_bytes(BUCKET, 'old.csv', b'a,b\n1,2\n')
+    assert client.uploads == []
+
+
+def test_gzip_encode():
+    client = FakeS3Client()
+    storage = S3Storage(client=client)
+    assert storage.upload_bytes(BUCKET, 'a.csv', b'x,y\n' * 1000, gzip_encode=True)
+    body, args = client.objects[(BUCKET, 'a.csv')]
+    assert args['ContentEncoding'] == 'gzip'
+    assert gzip.decompress(body) == b'x,y\n' * 1000
+    assert storage.download_bytes(BUCKET, 'a.csv') == b'x,y\n' * 1000
+    # The gzipped bytes are the same every time, so an unchanged body is still skipped
+    assert not storage.upload_bytes(BUCKET, 'a.csv', b'x,y\n' * 1000, gzip_encode=True)
+
+
+@pytest.mark.parametrize('code', ['403', 'AccessDenied'])
+def test_forbidden_head_uploads_anyway(code):
+    client = FakeS3Client(head_error=code)
+    storage = S3Storage(client=client)
+    assert storage.upload_bytes(BUCKET, 'a.json', b'{}')
+    assert storage.upload_bytes(BUCKET, 'a.json', b'{}')
+    assert client.uploads == ['a.json', 'a.json']
+
+
+def test_other_head_errors_raise():
+    storage = S3Storage(client=FakeS3Client(head_error='500'))
+    with pytest.raises(ClientError):
+        storage.upload_bytes(BUCKET, 'a.json', b'{}')
+
+
+def test_background_uploads_and_wait():
+    client = FakeS3Client()
+    storage = S3Storage(client=client, max_workers=2)
+    client.objects[(BUCKET, 'same')] = (b'same', {})
+    futures = [storage.upload_bytes(BUCKET, key, key.encode('utf-8'), background=True)
+               for key in ('k1', 'k2', 'same')]
+    assert storage.wait() == 2
+    assert all(future.done() for future in futures)
+    assert sorted(client.uploads) == ['k1', 'k2']
+    assert storage.wait() == 0
+
+
+def test_wait_raises_background_errors():
+    client = FakeS3Client()
+    storage = S3Storage(client=client, max_workers=2)
+
+    def fail(f):
+        raise ValueError('write failed')
+
+    storage.upload(BUCKET, 'bad', fail, background=True)
+    storage.upload_bytes(BUCKET, 'good', b'ok', background=True)
+    with pytest.raises(ValueError, match='write failed'):
+        storage.wait()
+    # The other uploads still ran, and failed ones aren't waited for again
+    assert client.uploads == ['good']
+    assert storage.wait() == 0